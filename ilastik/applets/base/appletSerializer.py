@@ -340,8 +340,30 @@ class SerialListSlot(SerialSlot):
                 self.inslot.setValue(self._iterable(map(self.transform, subgroup[()])))
         self.dirty = False
 
+def _intersecting(rois, regions):
+    """Return a boolean array that tells which of the rois (a list of
+    (start, stop)) intersect any of the regions (also (start, stop))."""
+    if len(rois) == 0:
+        return numpy.zeros((0,), dtype=bool)
+    starts = numpy.array([roi[0] for roi in rois])
+    stops = numpy.array([roi[1] for roi in rois])
+    result = numpy.zeros((len(rois),), dtype=bool)
+    for start, stop in regions:
+        result |= ((starts < stop) & (stops > start)).all(axis=1)
+    return result
+
 class SerialBlockSlot(SerialSlot):
-    """A slot which only saves nonzero blocks."""
+    """A slot which only saves nonzero blocks.
+
+    The blocks are stored as chunked, compressed datasets. Once the slot
+    was saved to (or loaded from) a group, the rois that are set dirty
+    on its lanes are remembered and the next save into the same group
+    only rewrites the blocks which intersect them. Everything else
+    (lanes added or removed, another file) causes a full rewrite.
+    """
+    # Options for storing blocks
+    COMPRESSION = {'chunks': True, 'compression': 'gzip', 'compression_opts': 1, 'shuffle': True}
+
     def __init__(self, slot, inslot, blockslot, name=None, subname=None,
                  default=None, depends=None, selfdepends=True, shrink_to_bb=False):
         """
@@ -351,13 +373,69 @@ class SerialBlockSlot(SerialSlot):
 
         """
         assert isinstance(slot, OutputSlot), "slot is of wrong type: '{}' is not an OutputSlot".format( slot.name )
+        # lane index -> list of (start, stop) that were set dirty since the last save
+        self._dirtyRois = {}
+        self._fullRewrite = True
+        # For each lane, a dict of the stored datasets: name -> (start, stop),
+        # or None if we don't know what is stored.
+        self._stored = None
+        # (file name, group name) of the group self._stored refers to
+        self._storedIn = None
         super(SerialBlockSlot, self).__init__(
             slot, inslot, name, subname, default, depends, selfdepends
         )
         self.blockslot = blockslot
-        self._bind(slot)
         self._shrink_to_bb = shrink_to_bb
 
+    def setDirty(self, *args, **kwargs):
+        super(SerialBlockSlot, self).setDirty(*args, **kwargs)
+        if not self.ignoreDirty:
+            self._fullRewrite = True
+
+    def _setBlocksDirty(self, slot, roi, **kwargs):
+        if self.ignoreDirty:
+            return
+        index = self.slot.index(slot)
+        self._dirtyRois.setdefault(index, []).append( (tuple(roi.start), tuple(roi.stop)) )
+        self.dirty = True
+
+    def _bind(self, slot=None):
+        slot = maybe(slot, self.slot)
+        if slot.level == 0:
+            super(SerialBlockSlot, self)._bind(slot)
+            return
+
+        def bindLane(slot, index):
+            slot[index].notifyDirty(self._setBlocksDirty)
+            slot[index].notifyValueChanged(self.setDirty)
+
+        def doMulti(slot, index, size):
+            bindLane(slot, index)
+            self.setDirty()
+
+        # Changes to lanes that existed before we were bound must not be missed
+        for index in range(len(slot)):
+            bindLane(slot, index)
+        slot.notifyInserted(doMulti)
+        slot.notifyRemoved(self.setDirty)
+
+    @staticmethod
+    def _location(group):
+        return (group.file.filename, group.name)
+
+    def _storedIntact(self, mygroup):
+        """Whether mygroup still holds the blocks we stored into it.
+        Only the number of datasets of each lane is checked."""
+        if self._stored is None or self._storedIn != self._location(mygroup):
+            return False
+        if len(self._stored) != len(self.blockslot) or len(mygroup) != len(self._stored):
+            return False
+        for index, stored in enumerate(self._stored):
+            subname = self.subname.format(index)
+            if subname not in mygroup or len(mygroup[subname]) != len(stored):
+                return False
+        return True
+
     def shouldSerialize(self, group):
         # Should this be a docstring?
         #
@@ -383,6 +461,12 @@ class SerialBlockSlot(SerialSlot):
 
         # Just because the group was serialized doesn't mean that the relevant data was.
         mygroup = group[self.name]
+        if self._stored is not None:
+            # We know what we stored, so there's no need to look at every block.
+            intact = self._storedIntact(mygroup)
+            logger.debug("BlockSlot \"" + self.name + "\" is " + ("" if intact else "not ") + "intact in \"" + repr(mygroup) + "\".")
+            return not intact
+
         num = len(self.blockslot)
         for index in range(num):
             subname = self.subname.format(index)
@@ -410,55 +494,137 @@ class SerialBlockSlot(SerialSlot):
 
         return False
 
+    def serialize(self, group):
+        if not self.shouldSerialize(group):
+            return
+        if self.slot.ready() and not self._fullRewrite and self.name in group \
+                and self._storedIntact(group[self.name]):
+            self._updateBlocks(group[self.name])
+        else:
+            deleteIfPresent(group, self.name)
+            self._stored = None
+            if self.slot.ready():
+                self._serialize(group, self.name, self.slot)
+            if self._stored is not None:
+                self._storedIn = self._location(group[self.name])
+        self._dirtyRois = {}
+        self._fullRewrite = False
+        self.dirty = False
+
+    def deserialize(self, group):
+        self._stored = None
+        super(SerialBlockSlot, self).deserialize(group)
+        if self._stored is not None:
+            # Loading the blocks set them dirty
+            self._dirtyRois = {}
+            self._fullRewrite = False
+
+    @staticmethod
+    def _blockRoi(slicing):
+        if isinstance(slicing[0], slice):
+            slicing = sliceToRoi( slicing, (0,)*len(slicing) )
+        return tuple(map(tuple, slicing))
+
+    def _writeBlock(self, subgroup, blockName, index, blockRoi):
+        """Write the block at blockRoi of lane index into subgroup[blockName],
+        in place if the existing dataset fits. Returns the roi of the
+        stored data, which is smaller than blockRoi with shrink_to_bb."""
+        slicing = roiToSlice(*blockRoi)
+        block = self.slot[index][slicing].wait()
+
+        if self._shrink_to_bb:
+            nonzero_coords = numpy.nonzero(block)
+            if len(nonzero_coords[0]) > 0:
+                block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
+                block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
+                block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
+                block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
+                bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
+                bounding_box_roi += block_start
+                
+                # Overwrite the vars that are written to the file
+                slicing = roiToSlice(*bounding_box_roi)
+                block = block[block_slicing]
+
+        # If we have a masked array, convert it to a structured array so that h5py can handle it.
+        if self.slot[index].meta.has_mask:
+            subgroup.parent.attrs["meta.has_mask"] = True
+
+            deleteIfPresent(subgroup, blockName)
+            block_group = subgroup.create_group(blockName)
+
+            block_group.create_dataset("data", data=block.data, **self.COMPRESSION)
+            block_group.create_dataset(
+                "mask",
+                data=block.mask,
+                compression="gzip",
+                compression_opts=2
+            )
+            block_group.create_dataset("fill_value", data=block.fill_value)
+
+            block_group.attrs['blockSlice'] = slicingToString(slicing)
+        else:
+            dataset = subgroup.get(blockName)
+            if isinstance(dataset, h5py.Dataset) and dataset.shape == block.shape and dataset.dtype == block.dtype:
+                dataset[...] = block
+            else:
+                deleteIfPresent(subgroup, blockName)
+                dataset = subgroup.create_dataset(blockName, data=block, **self.COMPRESSION)
+            dataset.attrs['blockSlice'] = slicingToString(slicing)
+        return self._blockRoi(slicing)
+
     @timeLogged(logger, logging.DEBUG)
     def _serialize(self, group, name, slot):
         logger.debug("Serializing BlockSlot: {}".format( self.name ))
         mygroup = group.create_group(name)
         num = len(self.blockslot)
+        stored = []
         for index in range(num):
             subname = self.subname.format(index)
             subgroup = mygroup.create_group(subname)
+            stored.append({})
             nonZeroBlocks = self.blockslot[index].value
             for blockIndex, slicing in enumerate(nonZeroBlocks):
-                if not isinstance(slicing[0], slice):
-                    slicing = roiToSlice(*slicing)
-
-                block = self.slot[index][slicing].wait()
                 blockName = 'block{:04d}'.format(blockIndex)
+                stored[index][blockName] = self._writeBlock(subgroup, blockName, index, self._blockRoi(slicing))
+        self._stored = stored
 
-                if self._shrink_to_bb:
-                    nonzero_coords = numpy.nonzero(block)
-                    if len(nonzero_coords[0]) > 0:
-                        block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
-                        block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
-                        block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
-                        block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
-                        bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
-                        bounding_box_roi += block_start
-                        
-                        # Overwrite the vars that are written to the file
-                        slicing = roiToSlice(*bounding_box_roi)
-                        block = block[block_slicing]
-
-                # If we have a masked array, convert it to a structured array so that h5py can handle it.
-                if slot[index].meta.has_mask:
-                    mygroup.attrs["meta.has_mask"] = True
-
-                    block_group = subgroup.create_group(blockName)
-
-                    block_group.create_dataset("data", data=block.data)
-                    block_group.create_dataset(
-                        "mask",
-                        data=block.mask,
-                        compression="gzip",
-                        compression_opts=2
-                    )
-                    block_group.create_dataset("fill_value", data=block.fill_value)
-
-                    block_group.attrs['blockSlice'] = slicingToString(slicing)
+    @timeLogged(logger, logging.DEBUG)
+    def _updateBlocks(self, mygroup):
+        """Rewrite the blocks that intersect the dirty rois, and remove
+        the ones that are no longer nonzero."""
+        logger.debug("Updating BlockSlot: {}".format( self.name ))
+        for index, dirtyRois in sorted(self._dirtyRois.items()):
+            subgroup = mygroup[self.subname.format(index)]
+            stored = self._stored[index]
+
+            nonZeroBlocks = map(self._blockRoi, self.blockslot[index].value)
+            dirtyBlocks = [blockRoi for blockRoi, dirty in zip(nonZeroBlocks, _intersecting(nonZeroBlocks, dirtyRois))
+                           if dirty]
+
+            # The datasets of the blocks that changed. Blocks don't overlap, so
+            # every dataset belongs to the block it intersects.
+            storedNames = stored.keys()
+            storedRois = [stored[blockName] for blockName in storedNames]
+            outdated = set( blockName for blockName, hit in
+                            zip(storedNames, _intersecting(storedRois, dirtyRois + dirtyBlocks)) if hit )
+
+            nextIndex = len(stored)
+            for blockRoi in dirtyBlocks:
+                previous = [blockName for blockName in outdated if _intersecting([stored[blockName]], [blockRoi])[0]]
+                if previous:
+                    blockName = previous[0]
+                    outdated.remove(blockName)
                 else:
-                    subgroup.create_dataset(blockName, data=block)
-                    subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
+                    while 'block{:04d}'.format(nextIndex) in subgroup:
+                        nextIndex += 1
+                    blockName = 'block{:04d}'.format(nextIndex)
+                stored[blockName] = self._writeBlock(subgroup, blockName, index, blockRoi)
+
+            for blockName in outdated:
+                del subgroup[blockName]
+                del stored[blockName]
+            logger.debug("Lane {}: wrote {} blocks, removed {}".format(index, len(dirtyBlocks), len(outdated)))
 
     @timeLogged(logger, logging.DEBUG)
     def _deserialize(self, mygroup, slot):
@@ -466,6 +632,7 @@ class SerialBlockSlot(SerialSlot):
         num = len(mygroup)
         if len(self.inslot) < num:
             self.inslot.resize(num)
+        stored = []
         # Annoyingly, some applets store their groups with names like, img0,img1,img2,..,img9,img10,img11
         # which means that sorted() needs a special key to avoid sorting img10 before img2
         # We have to find the index and sort according to its numerical value.
@@ -474,8 +641,10 @@ class SerialBlockSlot(SerialSlot):
             return int(index_capture.match(s).groups()[0])
         for index, t in enumerate(sorted(mygroup.items(), key=lambda (k,v): extract_index(k))):
             groupName, labelGroup = t
-            for blockData in labelGroup.values():
+            stored.append({})
+            for blockName, blockData in labelGroup.items():
                 slicing = stringToSlicing(blockData.attrs['blockSlice'])
+                stored[index][blockName] = self._blockRoi(slicing)
 
                 # If it is suppose to be a masked array,
                 # deserialize the pieces and rebuild the masked array.
@@ -499,6 +668,9 @@ class SerialBlockSlot(SerialSlot):
 
                 self.inslot[index][slicing] = blockArray
 
+        self._stored = stored
+        self._storedIn = self._location(mygroup)
+
 class SerialHdf5BlockSlot(SerialBlockSlot):
 
     def _serialize(self, group, name, slot):
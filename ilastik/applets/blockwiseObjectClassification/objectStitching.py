@@ -0,0 +1,129 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Objects that cross block borders, stitched together.
+
+Each block is labeled on its own, without a halo, and the region
+features of its objects are computed. Objects that touch at a block
+face are merged with a union-find, which gives every object one global
+id, and their features are merged with a RegionFeatureAccumulator, so
+only features that can be combined exactly are supported (see
+blockwise_supported). Only the features and the labels on the block
+faces are kept for the whole volume; the object ids of a block are
+computed from the block alone, by labeling it again and applying a
+lookup table.
+"""
+import numpy
+import vigra
+
+from ilastik.utility.blockStitching import labelComponents, blockFaces, BlockStitcher
+from ilastik.applets.objectExtraction.blockwiseRegionFeatures import extract_block_features, \
+                                                                    RegionFeatureAccumulator
+
+def labelObjects(binary):
+    """Label the connected components (6-neighborhood) of a binary
+    (x,y,z) block."""
+    return labelComponents(binary)
+
+class BlockObjects(object):
+    """
+    What StitchedObjects needs to know about one block: the number of
+    objects, their features (indexed by block-local label) and the
+    labels on the first and last plane along each axis.
+    """
+    def __init__(self, labels, raw, featureNames, ndim=3):
+        """
+        labels: the (x,y,z) labels of the block, from labelObjects()
+        raw: the raw data of the block, as handed to extract_block_features()
+        featureNames: the names of the features to compute
+        ndim: the number of spatial axes of raw, 2 for (x,y) data (z must
+            be a singleton axis of labels then)
+        """
+        self.nobjects = int(labels.max())
+        self.firstFaces, self.lastFaces = blockFaces(labels)
+        self.features = None
+        if self.nobjects > 0:
+            featureLabels = labels if ndim == 3 else labels[..., 0]
+            featureLabels = vigra.taggedView(featureLabels, 'xyz'[:ndim])
+            self.features = extract_block_features(raw, featureLabels, featureNames)
+
+class StitchedObjects(object):
+    """
+    The objects of a volume, assembled from the BlockObjects of every
+    block.
+
+    Block-local labels are made global by adding the block's offset
+    (see relabel()). objects maps global labels to consecutive object
+    ids, and features holds the merged features with one row per object
+    id (row 0 is the background), as returned by
+    RegionFeatureAccumulator.result().
+    """
+    def __init__(self, blockShape, blocks, featureNames, ndim=3):
+        """
+        blockShape: the (x,y,z) block shape
+        blocks: dict of (x,y,z) block start -> BlockObjects, for all blocks
+        featureNames: the names of the features in the BlockObjects
+        ndim: the number of spatial axes the features were computed on
+        """
+        stitcher = BlockStitcher(blockShape, dict((start, block.nobjects)
+                                                  for start, block in blocks.iteritems()))
+        stitcher.mergeFaces(lambda start, axis: blocks[start].firstFaces[axis],
+                            lambda start, axis: blocks[start].lastFaces[axis])
+        starts = stitcher.starts
+        self.offsets = stitcher.offsets
+        self.objects = stitcher.consecutive_lut()
+
+        accumulator = RegionFeatureAccumulator(featureNames)
+        for start in starts:
+            block = blocks[start]
+            if block.features is None:
+                continue
+            blockObjects = self.objects[self.offsets[start]:self.offsets[start] + block.nobjects + 1].copy()
+            blockObjects[0] = 0
+            # A block may hold several parts of the same object (which are
+            # connected through other blocks). Each call to add_block()
+            # must only merge distinct objects.
+            remaining = numpy.arange(1, block.nobjects + 1)
+            while len(remaining) > 0:
+                _, first = numpy.unique(blockObjects[remaining], return_index=True)
+                rows = remaining[first]
+                rowFeatures = dict((name, value[rows]) for name, value in block.features.iteritems())
+                accumulator.add_block(rowFeatures, start[:ndim], labels=blockObjects[rows])
+                remaining = numpy.delete(remaining, first)
+        self.features = accumulator.result()
+
+    @property
+    def nobjects(self):
+        """The number of objects, including the background."""
+        return int(self.objects.max()) + 1
+
+    def relabel(self, blockStart, labels, lut=None):
+        """
+        Apply a lookup table from object ids (e.g. the predicted class of
+        each object) to the labels of a block. Without a lookup table,
+        return the object ids.
+        """
+        offset = self.offsets[tuple(blockStart)]
+        blockLut = self.objects[offset:offset + labels.max() + 1].copy()
+        blockLut[0] = 0
+        if lut is not None:
+            blockLut = lut[blockLut]
+        return blockLut[labels]
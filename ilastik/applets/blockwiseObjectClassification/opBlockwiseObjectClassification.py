@@ -20,24 +20,33 @@
 ###############################################################################
 # Built-in
 import logging
+import threading
+import collections
+from functools import partial
 
 # Third-party
 import numpy
+import vigra
 
 # lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.request import RequestLock, RequestPool
+from lazyflow.request import Request, RequestLock, RequestPool
 from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice, TinyVector
-from lazyflow.operators import OpSubRegion, OpMultiArrayStacker, OpArrayCache
+from lazyflow.operators import OpSubRegion, OpArrayCache
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List
 
 # ilastik
 from ilastik.utility import bind
-from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
+from ilastik.utility.lruCache import LruCache
+from ilastik.utility.ramBudget import ramBudgetBytes
+from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction, default_features, default_features_key
+from ilastik.applets.objectExtraction.blockwiseRegionFeatures import blockwise_supported
 from ilastik.applets.objectClassification.opObjectClassification import OpObjectPredict, OpRelabelSegmentation, OpMaxLabel, OpMultiRelabelSegmentation
 from ilastik.applets.base.applet import DatasetConstraintError
 
+from objectStitching import labelObjects, BlockObjects, StitchedObjects
+
 logger = logging.getLogger(__name__)
 traceLogger = logging.getLogger("TRACE." + __name__)
 
@@ -138,11 +147,8 @@ class OpSingleBlockObjectPrediction( Operator ):
         self._opProbabilityChannelsToImage.ObjectMaps.connect( self._opPredict.ProbabilityChannels )
         self._opProbabilityChannelsToImage.Features.connect( self._opExtract.RegionFeatures )
         
-        self._opProbabilityChannelStacker = OpMultiArrayStacker( parent=self )
-        self._opProbabilityChannelStacker.Images.connect( self._opProbabilityChannelsToImage.Output )
-        self._opProbabilityChannelStacker.AxisFlag.setValue('c')
-        
-        self.ProbabilityChannelImage.connect( self._opProbabilityChannelStacker.Output )
+        # All channels are relabeled in one pass over the label image
+        self.ProbabilityChannelImage.connect( self._opProbabilityChannelsToImage.StackedOutput )
 
     def setupOutputs(self):
         tagged_input_shape = self.RawImage.meta.getTaggedShape()
@@ -221,9 +227,148 @@ class OpSingleBlockObjectPrediction( Operator ):
         return halo_roi
 
 
+class OpStitchedObjectFeatures( Operator ):
+    """
+    Labels the objects of the binary image block by block (without halo),
+    stitches the objects that cross block borders together and merges
+    their features (see objectStitching).  Only features that can be
+    merged across blocks are supported.
+
+    RegionFeatures has the format of OpObjectExtraction.RegionFeatures,
+    indexed by the stitched object ids.  getStitchedObjects(t) provides
+    the StitchedObjects of a time step, which relabels the blocks.
+    """
+    RawImage = InputSlot()
+    BinaryImage = InputSlot()
+    SelectedFeatures = InputSlot(rtype=List, stype=Opaque)
+    BlockShape = InputSlot() # (x,y,z) block shape
+
+    RegionFeatures = OutputSlot(stype=Opaque, rtype=List)
+
+    # Fraction of the RAM budget that the blocks in flight may use
+    RAM_FRACTION = 0.25
+
+    def __init__(self, *args, **kwargs):
+        super( OpStitchedObjectFeatures, self ).__init__( *args, **kwargs )
+        self._lock = RequestLock()
+        # t -> StitchedObjects
+        self._stitched = {}
+        self._configuration = None
+
+    def setupOutputs(self):
+        for slot in (self.RawImage, self.BinaryImage):
+            assert slot.meta.getAxisKeys() == list('txyzc'), "Input must be in txyzc order"
+        shape = self.RawImage.meta.shape
+        self._blockShape = tuple(map(int, numpy.minimum(self.BlockShape.value, shape[1:4])))
+
+        self.RegionFeatures.meta.shape = (shape[0],)
+        self.RegionFeatures.meta.dtype = object
+
+        configuration = (shape, self._blockShape)
+        if configuration != self._configuration:
+            self._stitched = {}
+            self._configuration = configuration
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.RegionFeatures, "Unknown output slot"
+        # Special case: An empty roi list means "request everything"
+        if len(roi) == 0:
+            roi = range(self.RegionFeatures.meta.shape[0])
+
+        feature_names = self.SelectedFeatures([]).wait()
+        result = {}
+        for t in roi:
+            merged = self.getStitchedObjects(t).features
+            all_features = {}
+            for plugin_name, feature_dict in feature_names.iteritems():
+                all_features[plugin_name] = dict((k, merged[k]) for k in feature_dict)
+            all_features[default_features_key] = dict((k, merged[k]) for k in default_features)
+            result[t] = all_features
+        return result
+
+    def getStitchedObjects(self, t):
+        with self._lock:
+            stitched = self._stitched.get(t)
+            if stitched is None:
+                stitched = self._stitchObjects(t)
+                logger.debug( "Stitched {} objects of time step {}".format( stitched.nobjects - 1, t ) )
+                self._stitched[t] = stitched
+            return stitched
+
+    def _stitchObjects(self, t):
+        feature_names = set(default_features.keys())
+        for feature_dict in self.SelectedFeatures([]).wait().itervalues():
+            feature_names |= set(feature_dict.keys())
+
+        spatialShape = self.RawImage.meta.shape[1:4]
+        ndim = 3 if spatialShape[2] > 1 else 2
+        nchannels = self.RawImage.meta.shape[4]
+        blocks = {}
+
+        def processBlock(blockStart):
+            start, stop = self.blockBounds(blockStart)
+            labels = self.labelBlock(t, start, stop)
+            raw = self.RawImage( (t,) + start + (0,), (t+1,) + stop + (nchannels,) ).wait()[0]
+            raw = raw.astype(numpy.float32)
+            if ndim == 2:
+                raw = raw[:, :, 0]
+            if nchannels == 1:
+                raw = vigra.taggedView(raw[..., 0], 'xyz'[:ndim])
+            else:
+                raw = vigra.taggedView(raw, 'xyz'[:ndim] + 'c')
+            blocks[start] = BlockObjects(labels, raw, feature_names, ndim)
+
+        # Only keep as many blocks in flight as fit into the RAM budget
+        bytes_per_voxel = nchannels * (numpy.dtype(self.RawImage.meta.dtype).itemsize + 4) + 9
+        max_blocks = ramBudgetBytes(self.RAM_FRACTION) / (numpy.prod(self._blockShape) * bytes_per_voxel)
+        n_in_flight = int(max(1, min(Request.global_thread_pool.num_workers, max_blocks)))
+        starts = getIntersectingBlocks( self._blockShape, ((0,0,0), spatialShape) )
+        for batch_start in range(0, len(starts), n_in_flight):
+            pool = RequestPool()
+            for blockStart in starts[batch_start:batch_start + n_in_flight]:
+                pool.add( Request( partial(processBlock, blockStart) ) )
+            pool.wait()
+
+        return StitchedObjects(self._blockShape, blocks, feature_names, ndim)
+
+    def blockBounds(self, blockStart):
+        start, stop = getBlockBounds( self.RawImage.meta.shape[1:4], self._blockShape, blockStart )
+        return tuple(map(int, start)), tuple(map(int, stop))
+
+    def labelBlock(self, t, start, stop):
+        """Label the objects of a whole block, so that the labels match its BlockObjects."""
+        binary = self.BinaryImage( (t,) + start + (0,), (t+1,) + stop + (1,) ).wait()
+        return labelObjects( binary[0, ..., 0] )
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.RawImage or slot == self.BinaryImage:
+            times = range(roi.start[0], roi.stop[0])
+        else:
+            times = range(self.RegionFeatures.meta.shape[0])
+        with self._lock:
+            for t in times:
+                self._stitched.pop(t, None)
+        self.RegionFeatures.setDirty( List(self.RegionFeatures, times) )
+
+# The results of a block pipeline that are kept after the pipeline is deleted
+BlockResults = collections.namedtuple( 'BlockResults', 'region_features objectwise_predictions' )
+
 class OpBlockwiseObjectClassification( Operator ):
     """
     Handles prediction ONLY.  Training must be provided externally and loaded via the serializer.
+
+    Block pipelines are kept in a pool that is limited to a fraction of the
+    RAM budget.  The least recently used pipelines are deleted when the pool
+    is full, but their region features and objectwise predictions are kept
+    (see BlockResults), so BlockwiseRegionFeatures can still be requested for
+    all blocks that were processed.
+
+    With StitchObjects, the blocks are processed without halo instead.  Objects
+    that cross block borders are stitched together and classified once, with
+    their features merged from all blocks (see OpStitchedObjectFeatures).  This
+    is only possible if all selected features can be merged across blocks.
+    BlockwiseRegionFeatures then provides the features of all objects of the
+    time step for each block.
     """
     RawImage = InputSlot()
     BinaryImage = InputSlot()
@@ -232,16 +377,46 @@ class OpBlockwiseObjectClassification( Operator ):
     SelectedFeatures = InputSlot(rtype=List, stype=Opaque)
     BlockShape3dDict = InputSlot( value={'x' : 512, 'y' : 512, 'z' : 512} ) # A dict of SPATIAL block dims
     HaloPadding3dDict = InputSlot( value={'x' : 64, 'y' : 64, 'z' : 64} ) # A dict of spatial block dims
+    StitchObjects = InputSlot( value=False )
 
     PredictionImage = OutputSlot()
     ProbabilityChannelImage = OutputSlot()
     BlockwiseRegionFeatures = OutputSlot()
-    
+
+    # Fraction of the RAM budget the block pipelines may use, and the
+    # estimated memory of a pipeline per voxel of its halo roi
+    PIPELINE_RAM_FRACTION = 0.25
+    PIPELINE_BYTES_PER_VOXEL = 16
+
     def __init__(self, *args, **kwargs):
         super( self.__class__, self ).__init__(*args, **kwargs)
-        self._blockPipelines = {} # indexed by blockstart
+        # indexed by blockstart
+        self._blockPipelines = LruCache( sizeof=self._pipelineBytes, on_evict=self._handleEvictedPipeline )
+        self._blockResults = {} # BlockResults of all processed blocks, indexed by blockstart
         self._lock = RequestLock()
-        
+
+        # self._poolLock guards the bookkeeping below and all changes to the pool
+        # that can evict pipelines (insertions and set_max_bytes)
+        self._poolLock = threading.Lock()
+        self._pipelineUsers = collections.defaultdict(int) # number of requests using a pipeline
+        # Evicted pipelines that may still be in use: pipeline -> blockstart.
+        # A block's pipeline may be recreated and evicted again before the
+        # old one is retired, so the pipelines themselves are the keys.
+        self._evictedPipelines = {}
+
+        # Used with StitchObjects only
+        self._stitch = False
+        self._opStitch = OpStitchedObjectFeatures( parent=self )
+        self._opStitch.RawImage.connect( self.RawImage )
+        self._opStitch.BinaryImage.connect( self.BinaryImage )
+        self._opStitch.SelectedFeatures.connect( self.SelectedFeatures )
+
+        self._opStitchedPredict = OpObjectPredict( parent=self )
+        self._opStitchedPredict.Features.connect( self._opStitch.RegionFeatures )
+        self._opStitchedPredict.SelectedFeatures.connect( self.SelectedFeatures )
+        self._opStitchedPredict.Classifier.connect( self.Classifier )
+        self._opStitchedPredict.LabelsCount.connect( self.LabelsCount )
+
     def setupOutputs(self):
         # Check for preconditions.
         if self.RawImage.ready() and self.BinaryImage.ready():
@@ -283,10 +458,25 @@ class OpBlockwiseObjectClassification( Operator ):
         self.BlockwiseRegionFeatures.meta.dtype = object
         self.BlockwiseRegionFeatures.meta.axistags = self.PredictionImage.meta.axistags
 
+        with self._poolLock:
+            self._blockPipelines.set_max_bytes( ramBudgetBytes( self.PIPELINE_RAM_FRACTION ) )
+
+        self._stitch = self.StitchObjects.value and blockwise_supported( self.SelectedFeatures([]).wait() )
+        if self._stitch:
+            self._opStitch.BlockShape.setValue( tuple( self._block_shape_dict[k] for k in 'xyz' ) )
+        else:
+            if self.StitchObjects.value:
+                logger.warning( "The selected features can't be merged across blocks. "
+                                "Objects are classified block by block, without stitching." )
+            self._opStitch.BlockShape.disconnect()
         
     def execute(self, slot, subindex, roi, destination):
-        if slot == self.PredictionImage or slot == self.ProbabilityChannelImage:
+        if (slot == self.PredictionImage or slot == self.ProbabilityChannelImage) and self._stitch:
+            return self._executeStitchedPrediction( slot, roi, destination )
+        elif slot == self.PredictionImage or slot == self.ProbabilityChannelImage:
             return self._executePredictionImage( slot, roi, destination )
+        elif slot == self.BlockwiseRegionFeatures and self._stitch:
+            return self._executeStitchedRegionFeatures( roi, destination )
         elif slot == self.BlockwiseRegionFeatures:
             return self._executeBlockwiseRegionFeatures( roi, destination )
         else:
@@ -300,14 +490,21 @@ class OpBlockwiseObjectClassification( Operator ):
         block_starts = getIntersectingBlocks( block_shape, roi_one_channel )
         block_starts = map( tuple, block_starts )
 
-        # Ensure that block pipelines exist (create first if necessary)
-        for block_start in block_starts:
-            self._ensurePipelineExists(block_start)
+        # Get the block pipelines (create first if necessary)
+        block_pipelines = []
+        try:
+            for block_start in block_starts:
+                block_pipelines.append( self._acquirePipeline(block_start) )
+            self._predictBlocks( slot, roi, roi_one_channel, block_pipelines, destination )
+        finally:
+            for opBlockPipeline in block_pipelines:
+                self._releasePipeline(opBlockPipeline)
+        return destination
 
+    def _predictBlocks(self, slot, roi, roi_one_channel, block_pipelines, destination):
         # Retrieve result from each block, and write into the appropriate region of the destination
         pool = RequestPool()
-        for block_start in block_starts:
-            opBlockPipeline = self._blockPipelines[block_start]
+        for opBlockPipeline in block_pipelines:
             block_roi = opBlockPipeline.block_roi
             block_intersection = getIntersection( block_roi, roi_one_channel )
             block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
@@ -329,6 +526,46 @@ class OpBlockwiseObjectClassification( Operator ):
             pool.add( req )
         pool.wait()
 
+    def _executeStitchedPrediction(self, slot, roi, destination):
+        spatial_roi = ( roi.start[1:4], roi.stop[1:4] )
+        pool = RequestPool()
+        for i, t in enumerate( xrange( roi.start[0], roi.stop[0] ) ):
+            stitched = self._opStitch.getStitchedObjects(t)
+            if slot == self.PredictionImage:
+                lut = self._opStitchedPredict.Predictions([t]).wait()[t]
+                lut = lut.astype( numpy.uint8 )[:, None]
+            else:
+                lut = self._opStitchedPredict.Probabilities([t]).wait()[t]
+                lut = lut[:, roi.start[4]:roi.stop[4]].astype( numpy.float32 )
+            if len(lut) == 0:
+                # no classifier
+                lut = numpy.zeros( (stitched.nobjects, roi.stop[4] - roi.start[4]), dtype=destination.dtype )
+            for block_start in getIntersectingBlocks( self._opStitch.BlockShape.value, spatial_roi ):
+                pool.add( Request( partial( self._relabelStitchedBlock, t, block_start, stitched, lut,
+                                            spatial_roi, destination[i] ) ) )
+        pool.wait()
+        return destination
+
+    def _relabelStitchedBlock(self, t, block_start, stitched, lut, spatial_roi, destination):
+        start, stop = self._opStitch.blockBounds( block_start )
+        labels = self._opStitch.labelBlock( t, start, stop )
+        values = stitched.relabel( start, labels, lut )
+
+        intersection_start = numpy.maximum( start, spatial_roi[0] )
+        intersection_stop = numpy.minimum( stop, spatial_roi[1] )
+        destination[ roiToSlice( intersection_start - spatial_roi[0], intersection_stop - spatial_roi[0] ) ] = \
+            values[ roiToSlice( intersection_start - start, intersection_stop - start ) ]
+
+    def _executeStitchedRegionFeatures(self, roi, destination):
+        """
+        Provide data for the BlockwiseRegionFeatures slot with StitchObjects:
+        each block gets the features of all objects of its time step.
+        """
+        t_index = self.RawImage.meta.getAxisKeys().index('t')
+        times = range( roi.start[t_index], roi.stop[t_index] )
+        features = self._opStitch.RegionFeatures( times ).wait()
+        for index in numpy.ndindex( *destination.shape ):
+            destination[index] = features[ times[ index[t_index] ] ]
         return destination
 
     def _executeBlockwiseRegionFeatures(self, roi, destination):
@@ -340,6 +577,7 @@ class OpBlockwiseObjectClassification( Operator ):
         
         Note: It is assumed that you will request these features for debug purposes, AFTER requesting the prediction image.
               Therefore, it is considered an error to request features that are not already computed.
+              The features of blocks whose pipeline was deleted are taken from their BlockResults.
         """
         axiskeys = self.RawImage.meta.getAxisKeys()
         # Find the corresponding block start coordinates
@@ -350,27 +588,53 @@ class OpBlockwiseObjectClassification( Operator ):
         
         # TODO: Parallelize this?
         for block_start in block_starts:
-            assert block_start in self._blockPipelines, "Not allowed to request region features for blocks that haven't yet been processed." # See note above
+            opBlockPipeline = self._blockPipelines.get(block_start)
+            assert opBlockPipeline is not None or block_start in self._blockResults, \
+                "Not allowed to request region features for blocks that haven't yet been processed." # See note above
 
             # Discard spatial axes to get (t,c) index for region slot roi
             tagged_block_start = zip( axiskeys, block_start )
             tagged_block_start_tc = filter( lambda (k,v): k in 'tc', tagged_block_start )
             block_start_tc = map( lambda (k,v): v, tagged_block_start_tc )
             block_roi_tc = ( block_start_tc, block_start_tc + numpy.array([1,1]) )
-            block_roi_t = (block_roi_tc[0][:-1], block_roi_tc[1][:-1])
 
             destination_start = numpy.array(block_start) / block_shape - roi.start
             destination_stop = destination_start + numpy.array( [1]*len(axiskeys) )
 
-            opBlockPipeline = self._blockPipelines[block_start]
-            req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_t )
             destination_without_channel = destination[ roiToSlice( destination_start, destination_stop ) ]
             destination_with_channel = destination_without_channel[ ...,block_roi_tc[0][-1] : block_roi_tc[1][-1] ]
-            req.writeInto( destination_with_channel )
-            req.wait()
+            if opBlockPipeline is not None:
+                req = opBlockPipeline.BlockwiseRegionFeatures( *self._blockRoiT(block_start) )
+                req.writeInto( destination_with_channel )
+                req.wait()
+            else:
+                destination_with_channel[...] = self._blockResults[block_start].region_features
         
         return destination
 
+    def _blockRoiT(self, block_start):
+        """The roi of a block's BlockwiseRegionFeatures, which are indexed by t only."""
+        t_index = self.RawImage.meta.getAxisKeys().index('t')
+        return ( [block_start[t_index]], [block_start[t_index]+1] )
+
+    def get_objectwise_predictions(self, block_start):
+        """
+        The objectwise predictions of a processed block, as a dict indexed by t
+        (see OpSingleBlockObjectPrediction.ObjectwisePredictions).
+        """
+        opBlockPipeline = self._blockPipelines.get(block_start)
+        if opBlockPipeline is not None:
+            return opBlockPipeline.ObjectwisePredictions([]).wait()
+        assert block_start in self._blockResults, \
+            "Not allowed to request predictions for blocks that haven't yet been processed."
+        return self._blockResults[block_start].objectwise_predictions
+
+    def get_halo_roi(self, block_start):
+        """The roi (including the halo) that a block's objects are computed from."""
+        halo_padding = self._getFullShape( self._halo_padding_dict )
+        tagged_input_shape = self.RawImage.meta.getTaggedShape()
+        return OpSingleBlockObjectPrediction.computeHaloRoi( tagged_input_shape, halo_padding, self.get_block_roi(block_start) )
+
     def _ensurePipelineExists(self, block_start):
         if block_start in self._blockPipelines:
             return
@@ -398,7 +662,60 @@ class OpBlockwiseObjectClassification( Operator ):
             # Forward dirtyness
             opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
             
-            self._blockPipelines[block_start] = opBlockPipeline
+            with self._poolLock:
+                self._blockPipelines[block_start] = opBlockPipeline
+        self._retireEvictedPipelines()
+
+    def _acquirePipeline(self, block_start):
+        """
+        Return the pipeline of a block, creating it first if necessary.
+        The pipeline won't be deleted before _releasePipeline() is called.
+        """
+        while True:
+            self._ensurePipelineExists(block_start)
+            with self._poolLock:
+                opBlockPipeline = self._blockPipelines.get(block_start)
+                if opBlockPipeline is not None:
+                    self._pipelineUsers[opBlockPipeline] += 1
+                    return opBlockPipeline
+            # Evicted right after it was created. Try again.
+
+    def _releasePipeline(self, opBlockPipeline):
+        with self._poolLock:
+            self._pipelineUsers[opBlockPipeline] -= 1
+            if self._pipelineUsers[opBlockPipeline] == 0:
+                del self._pipelineUsers[opBlockPipeline]
+        self._retireEvictedPipelines()
+
+    def _pipelineBytes(self, opBlockPipeline):
+        """Estimate the memory used by a block pipeline (for the pool)."""
+        halo_start, halo_stop = self.get_halo_roi( opBlockPipeline.block_roi[0] )
+        return numpy.prod( numpy.subtract( halo_stop, halo_start ) ) * self.PIPELINE_BYTES_PER_VOXEL
+
+    def _handleEvictedPipeline(self, block_start, opBlockPipeline):
+        # Called by the pool, with self._poolLock held by whoever inserted into
+        # the pool or shrank it.  The pipeline may still be in use, so it is
+        # only deleted by _retireEvictedPipelines().
+        logger.debug( "Evicting pipeline for block: {}".format( block_start ) )
+        self._evictedPipelines[opBlockPipeline] = block_start
+
+    def _retireEvictedPipelines(self):
+        """
+        Keep the BlockResults of all evicted pipelines that are no longer in
+        use, then delete them.
+        """
+        with self._poolLock:
+            retired = filter( lambda (op, block_start): op not in self._pipelineUsers,
+                              self._evictedPipelines.items() )
+            for opBlockPipeline, _ in retired:
+                del self._evictedPipelines[opBlockPipeline]
+
+        for opBlockPipeline, block_start in retired:
+            if opBlockPipeline.BlockwiseRegionFeatures.ready() and opBlockPipeline.ObjectwisePredictions.ready():
+                region_features = opBlockPipeline.BlockwiseRegionFeatures( *self._blockRoiT(block_start) ).wait()
+                objectwise_predictions = opBlockPipeline.ObjectwisePredictions([]).wait()
+                self._blockResults[block_start] = BlockResults( region_features, objectwise_predictions )
+            opBlockPipeline.cleanUp()
 
     def get_blockshape(self):
         return self._getFullShape(self.BlockShape3dDict.value)
@@ -438,10 +755,13 @@ class OpBlockwiseObjectClassification( Operator ):
     
     def _deleteAllPipelines(self):
         logger.debug("Deleting all pipelines.")
-        oldBlockPipelines = self._blockPipelines
-        self._blockPipelines = {}
         with self._lock:
-            for opBlockPipeline in oldBlockPipelines.values():
+            with self._poolLock:
+                oldBlockPipelines = [op for _, op in self._blockPipelines.items()] + self._evictedPipelines.keys()
+                self._blockPipelines.clear()
+                self._evictedPipelines = {}
+                self._blockResults = {}
+            for opBlockPipeline in oldBlockPipelines:
                 opBlockPipeline.cleanUp()
     
     
@@ -449,6 +769,32 @@ class OpBlockwiseObjectClassification( Operator ):
         if slot == self.BlockShape3dDict or slot == self.HaloPadding3dDict:
             self._deleteAllPipelines()
             self.PredictionImage.setDirty( slice(None) )
+        elif (slot == self.RawImage or slot == self.BinaryImage) and not self._stitch:
+            # The pipelines of the affected blocks forward the dirty
+            # notification themselves, but deleted pipelines can't.
+            self._dropBlockResults( roi )
+        else:
+            self._blockResults = {}
+            self.PredictionImage.setDirty( slice(None) )
+
+    def _dropBlockResults(self, roi):
+        """
+        Forget the results of the blocks whose halo intersects the given
+        input roi, and set their prediction dirty.
+        """
+        if not self._blockResults:
+            return
+        channel_index = self.RawImage.meta.getAxisKeys().index('c')
+        halo_padding = numpy.array( self._getFullShape( self._halo_padding_dict ) )
+        halo_padding[channel_index] = 0
+        dirty_start = numpy.maximum( numpy.subtract( roi.start, halo_padding ), 0 )
+        dirty_stop = numpy.minimum( numpy.add( roi.stop, halo_padding ), self.RawImage.meta.shape )
+        dirty_start[channel_index], dirty_stop[channel_index] = 0, 1
+
+        block_shape = self._getFullShape( self._block_shape_dict )
+        for block_start in map( tuple, getIntersectingBlocks( block_shape, (dirty_start, dirty_stop) ) ):
+            if self._blockResults.pop( block_start, None ) is not None:
+                self.PredictionImage.setDirty( *self.get_block_roi(block_start) )
     
     
     def _handleDirtyBlock(self, block_start, slot, roi):
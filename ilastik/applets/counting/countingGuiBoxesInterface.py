@@ -43,21 +43,16 @@ import vigra
 
 from lazyflow.operator import InputSlot
 from lazyflow.graph import Operator, OutputSlot, Graph
-from lazyflow.operators.generic import OpSubRegion
+from ilastik.applets.counting.opCounting import OpDensityIntegral
 ##add tot hte pos model
 from ilastik.widgets.boxListModel import BoxLabel, BoxListModel
 
 import warnings
 import threading
 
-import time
-
 import logging
 logger = logging.getLogger(__name__)
 
-DELAY=10 #In millisec,delay in updating the text in the handles, needed because lazy flow cannot stay back the
-         #user shuffling the boxes
-
 class Tool():
 
     Navigation = 0 # Arrow
@@ -533,8 +528,8 @@ class RedRubberBand(QRubberBand):
 class CoupledRectangleElement(object):
     def __init__(self,x,y,h,w,inputSlot,editor = None, scene=None,parent=None,qcolor=QColor(0,0,255)):
         '''
-        Couples the functionality of the lazyflow operator OpSubRegion which gets a subregion of interest
-        and the functionality of the resizable rectangle Item.
+        Couples the integral image of the density, which gives the statistics of a subregion of interest
+        in constant time, and the functionality of the resizable rectangle Item.
         Keeps the two functionality separated
 
 
@@ -542,7 +537,7 @@ class CoupledRectangleElement(object):
         :param y: initial position scene coordinates
         :param h: initial height
         :param w: initial width
-        :param inputSlot: Should be the output slot of another operator from which you would like monitor a subregion
+        :param inputSlot: Should be the Integral slot of an OpDensityIntegral connected to the density you would like to monitor
         :param scene: the scene where to put the graphics item
         :param parent: the parent object if any
         :param qcolor: initial color of the rectangle
@@ -550,10 +545,8 @@ class CoupledRectangleElement(object):
 
 
         self._rectItem=QGraphicsResizableRect(x,y,h,w,scene,parent,editor)
-        self._opsub = OpSubRegion(graph=inputSlot.operator.graph, parent = inputSlot.operator.parent) #sub region correspondig to the rectangle region
-        #self.opsum = OpSumAll(graph=inputSlot.operator.graph)
         self._graph=inputSlot.operator.graph
-        self._inputSlot=inputSlot #input slot which connect to the sub array
+        self._inputSlot=inputSlot #integral image of the density
 
 
         self.boxLabel=None #a reference to the label in the labellist model
@@ -565,8 +558,6 @@ class CoupledRectangleElement(object):
         #print "initializing ...", self.getStart(),self.getStop()
 
         #Operator changes
-        self._opsub.Input.connect(self._inputSlot)
-        self._opsub.Roi.setValue( [self.getStart(), self.getStop()] )
         self._inputSlot.notifyDirty(self._updateTextWhenChanges)
 
 
@@ -583,18 +574,10 @@ class CoupledRectangleElement(object):
         or the rectangle is moved or resized
         '''
 
-        time.sleep(DELAY*0.001)
-
-
         #FIXME: Workaround: when the array is resized over the border of the image scene the
         # region get a wrong size
         try:
-            subarray=self.getSubRegion()
-
-            #self.current_sum= self.opsum.outputs["Output"][:].wait()[0]
-            value=0
-            if subarray!=None:
-                value=np.sum(subarray)
+            value=self.getStatistics()[0]
 
             #print "Resetting to a new value ",value,self.boxLabel
 
@@ -609,15 +592,11 @@ class CoupledRectangleElement(object):
 
 
 
-    def getOpsub(self):
-        return self._opsub
-
     def getRectItem(self):
         return self._rectItem
 
     def disconnectInput(self):
         self._inputSlot.unregisterDirty(self._updateTextWhenChanges)
-        self._opsub.Input.disconnect()
 
     def getStart(self):
         '''
@@ -638,30 +617,23 @@ class CoupledRectangleElement(object):
         stop=(1,newstop[0],newstop[1],1,1)
         return stop
 
-    def getSubRegion(self):
+    def getStatistics(self):
         '''
-        Gets the sub region of interest in the array input Slot
+        Gets the sum, mean and standard deviation of the density in the region of interest
 
         '''
-        oldstart=self.getStart()
-        oldstop=self.getStop()
-
-        # print "Start = %s , Stop = %s"%(oldstart,oldstop)
-
         start=[]
         stop=[]
-        for s1,s2 in zip(oldstart,oldstop):
+        for s1,s2 in zip(self.getStart()[1:3],self.getStop()[1:3]):
             if (s1-s2) == 0: #means that the region is squeezed to zero
-                           # thus return None
-                return None
-            start.append(int(np.minimum(s1,s2)))
-            stop.append(int(np.maximum(s1,s2)))
-
-        self._opsub.Roi.disconnect()
-        self._opsub.Roi.setValue([ tuple(start), tuple(stop)] )
-
+                return 0.0, 0.0, 0.0
+            start.append(int(min(s1,s2)))
+            stop.append(int(max(s1,s2)))
 
-        return self._opsub.outputs["Output"][:].wait()
+        integral=self._inputSlot[:].wait()
+        start=np.clip(start,0,integral.shape)
+        stop=np.clip(stop,0,integral.shape)
+        return integral.statistics(start,stop)
 
     @property
     def color(self):
@@ -904,6 +876,9 @@ class BoxController(QObject):
         self._setUpRandomColors()
         self.scene=scene
         self.connectionInput=connectionInput
+        # all boxes query the same integral image of the density
+        self._opIntegral=OpDensityIntegral(graph=connectionInput.operator.graph, parent=connectionInput.operator.parent)
+        self._opIntegral.Input.connect(connectionInput)
         self._currentBoxesList=[]
         #self._currentActiveItem=[]
         #self.counter=1000
@@ -956,7 +931,7 @@ class BoxController(QObject):
         w=stop[0]-start[0]
         if h*w<9: return #too small
 
-        rect=CoupledRectangleElement(start[0],start[1],h,w,self.connectionInput,editor = self._editor, scene=self.scene,parent=self.scene.parent())
+        rect=CoupledRectangleElement(start[0],start[1],h,w,self._opIntegral.Integral,editor = self._editor, scene=self.scene,parent=self.scene.parent())
         rect.setZValue(len(self._currentBoxesList))
         rect.setColor(self.currentColor)
         #self.counter-=1
@@ -1087,10 +1062,7 @@ class BoxController(QObject):
                 for k,box in enumerate(self._currentBoxesList):
                     start=box.getStart()
                     stop=box.getStop()
-                    region = box.getSubRegion()
-                    count = np.sum(region)
-                    averagedens = np.mean(region)
-                    stddensity = np.std(region)
+                    count, averagedens, stddensity = box.getStatistics()
 
 
                     line=["%5.5d"%k, "%5.5d"%start[1], "%5.5d"%start[2], "%5.5d"%stop[1],\
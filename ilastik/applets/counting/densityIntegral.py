@@ -0,0 +1,148 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Summed-area tables (integral images) of a 2D density, kept per block.
+
+Each block holds the summed-area table of its own pixels. The last row
+and column of these tables are combined across blocks by a few small
+prefix sums, which gives the integral image at any point from four
+lookups. When the density changes, only the affected blocks have to be
+recomputed.
+"""
+import numpy
+
+class BlockwiseIntegralImage(object):
+    """
+    Sums and sums of squares of a 2D image over arbitrary rectangles,
+    in constant time.
+
+    Blocks are marked dirty when the image changes (markDirty) and are
+    recomputed from the new image data with setBlock. Queries require
+    that no block is dirty.
+
+    >>> image = numpy.arange(12.).reshape((4, 3))
+    >>> integral = BlockwiseIntegralImage(image.shape, (2, 2))
+    >>> for block in integral.dirtyBlocks():
+    ...     integral.setBlock(block, image[integral.blockSlicing(block)])
+    >>> integral.sums((1, 1), (4, 3))
+    (45.0, 375.0)
+
+    """
+    def __init__(self, shape, blockShape):
+        self.shape = tuple(shape)
+        self.blockShape = tuple(min(b, s) for b, s in zip(blockShape, shape))
+        self.gridShape = tuple((s + b - 1)//b for s, b in zip(self.shape, self.blockShape))
+        # summed-area tables of the pixel values (0) and their squares (1),
+        # each block region holding the table of that block
+        self._local = numpy.zeros((2,) + self.shape, dtype=numpy.float64)
+        self._dirty = numpy.ones(self.gridShape, dtype=bool)
+        self._tables = None
+
+    def blockSlicing(self, block):
+        """The slicing of the image that corresponds to a block index."""
+        return tuple(slice(i*b, min((i+1)*b, s))
+                     for i, b, s in zip(block, self.blockShape, self.shape))
+
+    def markDirty(self, start, stop):
+        """Mark the blocks that intersect the roi [start, stop) dirty."""
+        start = numpy.maximum(start, 0)//self.blockShape
+        stop = (numpy.minimum(stop, self.shape) + self.blockShape - 1)//self.blockShape
+        self._dirty[start[0]:stop[0], start[1]:stop[1]] = True
+        self._tables = None
+
+    def dirtyBlocks(self):
+        """The indices of all dirty blocks."""
+        return map(tuple, numpy.transpose(numpy.nonzero(self._dirty)))
+
+    def setBlock(self, block, data):
+        """Recompute a block from its pixels."""
+        data = numpy.asarray(data, dtype=numpy.float64)
+        local = self._local[(slice(None),) + self.blockSlicing(block)]
+        local[0] = data.cumsum(0).cumsum(1)
+        local[1] = (data**2).cumsum(0).cumsum(1)
+        self._dirty[block] = False
+        self._tables = None
+
+    @property
+    def nbytes(self):
+        return self._local.nbytes
+
+    def _combine(self):
+        # For block (i, j) and local coordinates (u, v):
+        #  - corners[i, j]: sum of the blocks above and left of it
+        #  - columns[i, j, v]: sum of the blocks above it, up to local column v
+        #  - rows[i, j, u]: sum of the blocks left of it, up to local row u
+        bx, by = self.blockShape
+        gx, gy = self.gridShape
+        lastRows = numpy.zeros((2, gx, gy, by))
+        lastCols = numpy.zeros((2, gx, gy, bx))
+        for i in range(gx):
+            for j in range(gy):
+                local = self._local[(slice(None),) + self.blockSlicing((i, j))]
+                lastRows[:, i, j, :local.shape[2]] = local[:, -1, :]
+                lastRows[:, i, j, local.shape[2]:] = local[:, -1, -1:]
+                lastCols[:, i, j, :local.shape[1]] = local[:, :, -1]
+                lastCols[:, i, j, local.shape[1]:] = local[:, -1:, -1]
+        totals = lastRows[..., -1]
+
+        corners = numpy.zeros((2, gx + 1, gy + 1))
+        corners[:, 1:, 1:] = totals.cumsum(1).cumsum(2)
+        columns = numpy.zeros((2, gx + 1, gy, by))
+        columns[:, 1:] = lastRows.cumsum(1)
+        rows = numpy.zeros((2, gx, gy + 1, bx))
+        rows[:, :, 1:] = lastCols.cumsum(2)
+        self._tables = (corners, columns, rows)
+
+    def _integral(self, x, y):
+        # sums over [0, x) x [0, y)
+        if x == 0 or y == 0:
+            return numpy.zeros((2,))
+        x -= 1
+        y -= 1
+        i, u = divmod(x, self.blockShape[0])
+        j, v = divmod(y, self.blockShape[1])
+        corners, columns, rows = self._tables
+        return corners[:, i, j] + columns[:, i, j, v] + rows[:, i, j, u] + self._local[:, x, y]
+
+    def sums(self, start, stop):
+        """
+        Return (sum, sum of squares) of the image over the roi [start, stop).
+        """
+        assert not self._dirty.any(), "Integral image has dirty blocks"
+        if self._tables is None:
+            self._combine()
+        (x0, y0), (x1, y1) = map(int, start), map(int, stop)
+        total = self._integral(x1, y1) - self._integral(x0, y1) \
+                - self._integral(x1, y0) + self._integral(x0, y0)
+        return total[0], total[1]
+
+    def statistics(self, start, stop):
+        """
+        Return the sum, mean and standard deviation of the image over the
+        roi [start, stop).
+        """
+        total, squares = self.sums(start, stop)
+        count = numpy.prod(numpy.subtract(stop, start))
+        if count == 0:
+            return 0.0, 0.0, 0.0
+        mean = total/count
+        variance = max(squares/count - mean**2, 0.0)
+        return total, mean, numpy.sqrt(variance)
@@ -36,10 +36,12 @@ from lazyflow.operators import OpValueCache, \
                                OpReorderAxes
 from lazyflow.operators.opDenseLabelArray import OpDenseLabelArray
 
-from lazyflow.request import Request, RequestPool
+from lazyflow.request import Request, RequestPool, RequestLock
 from lazyflow.roi     import roiToSlice, sliceToRoi
+from lazyflow.stype import Opaque
                                
 from ilastik.applets.counting.countingOperators import OpTrainCounter, OpPredictCounter, OpLabelPreviewer
+from ilastik.applets.counting.densityIntegral import BlockwiseIntegralImage
 
 #ilastik
 
@@ -108,6 +110,81 @@ class OpVolumeOperator(Operator):
             self.outputs["Output"].setDirty( slice(None) )
         self.cache = None
 
+class OpDensityIntegral(Operator):
+    """
+    Keeps a BlockwiseIntegralImage of a 2D density (all axes other than x
+    and y must be singletons), so that box counts and the total count are
+    constant time queries. When the density becomes dirty, only the dirty
+    blocks are requested again.
+
+    Integral provides the up-to-date BlockwiseIntegralImage, with x,y
+    coordinates. OutputSum is the sum of the whole density.
+    """
+    name = "OpDensityIntegral"
+    Input = InputSlot()
+    Integral = OutputSlot(stype=Opaque)
+    OutputSum = OutputSlot()
+
+    DefaultBlockSize = 256
+
+    def __init__(self, *args, **kwargs):
+        super( OpDensityIntegral, self ).__init__( *args, **kwargs )
+        self._integral = None
+        self._lock = RequestLock()
+
+    def setupOutputs(self):
+        taggedShape = self.Input.meta.getTaggedShape()
+        for key, size in taggedShape.items():
+            assert key in 'xy' or size == 1, \
+                "Density must be 2D, got shape {}".format(taggedShape)
+        shape = (taggedShape['x'], taggedShape['y'])
+        with self._lock:
+            if self._integral is None or self._integral.shape != shape:
+                self._integral = BlockwiseIntegralImage(shape, (self.DefaultBlockSize,)*2)
+            else:
+                self._integral.markDirty((0, 0), shape)
+
+        self.Integral.meta.shape = (1,)
+        self.Integral.meta.dtype = object
+        self.OutputSum.meta.shape = (1,)
+        self.OutputSum.meta.dtype = numpy.float64
+
+    def execute(self, slot, subindex, roi, result):
+        integral = self._update()
+        if slot == self.Integral:
+            return integral
+        result[0] = integral.sums((0, 0), integral.shape)[0]
+        return result
+
+    def _update(self):
+        with self._lock:
+            integral = self._integral
+            axisKeys = self.Input.meta.getAxisKeys()
+
+            def updateBlock(block):
+                slicing = dict(zip('xy', integral.blockSlicing(block)))
+                key = tuple(slicing.get(k, slice(None)) for k in axisKeys)
+                data = self.Input[key].wait()
+                data = vigra.taggedView(data, axistags=self.Input.meta.axistags)
+                integral.setBlock(block, data.withAxes('x', 'y'))
+
+            pool = RequestPool()
+            for block in integral.dirtyBlocks():
+                pool.add(Request(partial(updateBlock, block)))
+            pool.wait()
+            pool.clean()
+            return integral
+
+    def propagateDirty(self, slot, subindex, roi):
+        if self._integral is not None:
+            axisKeys = self.Input.meta.getAxisKeys()
+            start = [roi.start[axisKeys.index(k)] for k in 'xy']
+            stop = [roi.stop[axisKeys.index(k)] for k in 'xy']
+            with self._lock:
+                self._integral.markDirty(start, stop)
+        self.Integral.setDirty(slice(None))
+        self.OutputSum.setDirty(slice(None))
+
 class OpUpperBound(Operator):
     name = "OpUpperBound"
     description = "Calculate the upper bound of the data for correct normalization of the output"
@@ -519,10 +596,9 @@ class OpPredictionPipelineNoCache(Operator):
         self.meaner.Input.connect(self.cacheless_predict.PMaps)
         self.HeadlessPredictionProbabilities.connect(self.meaner.Output)
 
-        self.opVolumeSum = OpVolumeOperator(parent=self)
+        self.opVolumeSum = OpDensityIntegral(parent=self)
         self.opVolumeSum.Input.connect(self.meaner.Output)
-        self.opVolumeSum.Function.setValue(numpy.sum)
-        self.OutputSum.connect( self.opVolumeSum.Output )
+        self.OutputSum.connect( self.opVolumeSum.OutputSum )
 
         # Alternate headless output: uint8 instead of float.
         # Note that drange is automatically updated.        
@@ -83,6 +83,7 @@ class DataExportApplet( Applet ):
         arg_parser.add_argument( '--output_format', help='Export file format', choices=all_format_names, required=False )
         arg_parser.add_argument( '--output_filename_format', help='Output file path, including special placeholders, e.g. /tmp/results_t{t_start}-t{t_stop}.h5', required=False )
         arg_parser.add_argument( '--output_internal_path', help='Specifies dataset name within an hdf5 dataset (applies to hdf5 output only), e.g. /volume/data', required=False )
+        arg_parser.add_argument( '--parallel_exports', help='Headless batch mode: The maximum number of images to export at the same time (default: one per lazyflow thread)', type=int, required=False )
 
         return arg_parser
 
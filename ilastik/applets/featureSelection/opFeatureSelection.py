@@ -36,6 +36,7 @@ from lazyflow.operators.imgFilterOperators import OpPixelFeaturesPresmoothed as
 from lazyflow.operators import OpReorderAxes, OperatorWrapper
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from opPersistentFeatureCache import OpPersistentFeatureCache, getFeatureCacheStore
 
 logger = logging.getLogger(__name__)
 
@@ -98,6 +99,15 @@ class OpFeatureSelectionNoCache(Operator):
                                                broadcastingSlotNames=["AxisOrder"])
         self.opReorderLayers.Input.connect(self.opPixelFeatures.Features)
 
+        # Optionally, keep the features on disk for later sessions (see ilastik.config)
+        self.filter_implementation = filter_implementation
+        self.opPersistentCache = None
+        store = getFeatureCacheStore()
+        if store is not None:
+            self.opPersistentCache = OpPersistentFeatureCache(store, parent=self)
+            self.opPersistentCache.Input.connect(self.opReorderOut.Output)
+            self.opPersistentCache.RawImage.connect(self.InputImage)
+
         # We don't connect SelectionMatrix here because we want to 
         #  check it for errors (See setupOutputs)
         # self.opPixelFeatures.SelectionMatrix.connect( self.SelectionMatrix )
@@ -158,9 +168,33 @@ class OpFeatureSelectionNoCache(Operator):
                 raise DatasetConstraintError( "Feature Selection", msg )
             
             # Connect our external outputs to our internal operators
-            self.OutputImage.connect( self.opReorderOut.Output )
+            if self.opPersistentCache is not None:
+                self.opPersistentCache.CacheKey.setValue( self._featureCacheKey( selections ) )
+                self.opPersistentCache.Halo.setValue( self._featureHalo( selections ) )
+                self.OutputImage.connect( self.opPersistentCache.Output )
+            else:
+                self.OutputImage.connect( self.opReorderOut.Output )
             self.FeatureLayers.connect( self.opReorderLayers.Output )
 
+    def _featureCacheKey(self, selections):
+        """
+        A string that identifies the features we compute, for the persistent cache.
+        """
+        return "{}|{}|{}|{}".format( self.filter_implementation,
+                                     list(self.FeatureIds.value),
+                                     list(self.Scales.value),
+                                     numpy.asarray(selections).tolist() )
+
+    def _featureHalo(self, selections):
+        """
+        A (generous) upper bound for the distance up to which the selected features depend on the input.
+        """
+        selected_scales = [ scale for scale, column in zip( self.Scales.value, numpy.asarray(selections).T ) if column.any() ]
+        if not selected_scales:
+            return 0
+        # Structure tensor features use an outer scale on top of the inner scale, hence the factor 2.
+        return int( numpy.ceil( 2 * self.WINDOW_SIZE * max(selected_scales) ) ) + 1
+
     def propagateDirty(self, slot, subindex, roi):
         # Output slots are directly connected to internal operators
         pass
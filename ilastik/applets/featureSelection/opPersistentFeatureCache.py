@@ -0,0 +1,145 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import hashlib
+import threading
+from functools import partial
+
+import numpy
+
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.roi import determineBlockShape, getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice
+from lazyflow.request import Request, RequestPool
+
+from ilastik.config import cfg as ilastik_config
+from ilastik.utility.diskBlockStore import DiskBlockStore
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def getFeatureCacheStore():
+    """
+    Return the DiskBlockStore configured in the [feature cache] section 
+    of the ilastik config, or None if the persistent feature cache is disabled.
+    All operators share one store per directory.
+    """
+    if not ilastik_config.has_section('feature cache'):
+        return None
+    directory = ilastik_config.get('feature cache', 'directory')
+    if not directory:
+        return None
+    directory = os.path.expanduser( directory )
+    max_bytes = ilastik_config.getint('feature cache', 'max_size_mb') * 1024**2
+    with _stores_lock:
+        if directory not in _stores:
+            _stores[directory] = DiskBlockStore( directory, max_bytes )
+        return _stores[directory]
+
+class OpPersistentFeatureCache(Operator):
+    """
+    Caches the feature image in a DiskBlockStore, so features can be reused 
+    across sessions and processes (e.g. between interactive training and 
+    headless batch prediction of the same data).
+
+    Blocks are addressed by content: the key of each block is a hash of the 
+    CacheKey (which describes the feature computation), the block's position 
+    and the raw data in the block and its halo.  Changed raw data or 
+    feature settings thus never hit stale entries, and no explicit 
+    invalidation is needed.
+    """
+    Input = InputSlot()     # The feature image
+    RawImage = InputSlot()  # The image the features are computed from (same axes as Input)
+    CacheKey = InputSlot()  # A string that identifies the feature computation
+    Halo = InputSlot()      # Spatial distance up to which features depend on the raw data
+
+    Output = OutputSlot()
+
+    BLOCK_VOXELS = 2**21
+
+    def __init__(self, store, *args, **kwargs):
+        super( OpPersistentFeatureCache, self ).__init__( *args, **kwargs )
+        self._store = store
+
+    def setupOutputs(self):
+        assert self.Input.meta.getAxisKeys() == self.RawImage.meta.getAxisKeys()
+        self.Output.meta.assignFrom( self.Input.meta )
+
+        tagged_shape = self.Input.meta.getTaggedShape()
+        max_shape = [ 1 if k in 'tc' else s for k, s in tagged_shape.items() ]
+        block_shape = list( determineBlockShape( max_shape, self.BLOCK_VOXELS ) )
+        block_shape[ self.Input.meta.axistags.index('c') ] = tagged_shape['c']
+        self._block_shape = tuple(block_shape)
+
+    def execute(self, slot, subindex, roi, result):
+        shape = self.Input.meta.shape
+        block_starts = getIntersectingBlocks( self._block_shape, (roi.start, roi.stop) )
+
+        def copyBlock(block_start):
+            block_roi = getBlockBounds( shape, self._block_shape, block_start )
+            block = self._getBlock( block_roi )
+            intersection = getIntersection( block_roi, (roi.start, roi.stop) )
+            source = roiToSlice( numpy.subtract(intersection[0], block_roi[0]), numpy.subtract(intersection[1], block_roi[0]) )
+            dest = roiToSlice( numpy.subtract(intersection[0], roi.start), numpy.subtract(intersection[1], roi.start) )
+            result[dest] = block[source]
+
+        pool = RequestPool()
+        for block_start in block_starts:
+            pool.add( Request( partial( copyBlock, block_start ) ) )
+        pool.wait()
+        return result
+
+    def _blockKey(self, block_roi):
+        """
+        Hash everything the features in block_roi depend on.
+        """
+        raw_meta = self.RawImage.meta
+        halo = self.Halo.value
+        start, stop = list(block_roi[0]), list(block_roi[1])
+        for i, k in enumerate( raw_meta.getAxisKeys() ):
+            if k == 'c':
+                start[i], stop[i] = 0, raw_meta.shape[i]
+            elif k != 't':
+                start[i] = max( 0, start[i] - halo )
+                stop[i] = min( raw_meta.shape[i], stop[i] + halo )
+        raw = self.RawImage( start, stop ).wait()
+
+        sha = hashlib.sha1()
+        sha.update( self.CacheKey.value )
+        sha.update( str( (tuple(block_roi[0]), tuple(block_roi[1]), raw_meta.shape, raw_meta.getAxisKeys(), self.Input.meta.dtype) ) )
+        sha.update( numpy.ascontiguousarray(raw).data )
+        return sha.hexdigest()
+
+    def _getBlock(self, block_roi):
+        key = self._blockKey( block_roi )
+        block = self._store.get( key )
+        if block is None or block.shape != tuple(numpy.subtract(block_roi[1], block_roi[0])):
+            block = self.Input( *block_roi ).wait()
+            self._store.put( key, block )
+        return block
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input:
+            self.Output.setDirty( roi )
+        elif slot == self.RawImage:
+            # The features are dirty, too.
+            pass
+        else:
+            self.Output.setDirty( slice(None) )
@@ -22,8 +22,8 @@ import numpy
 import numpy.lib.recfunctions as rfn
 import vigra
 import time
+import threading
 import warnings
-import itertools
 from collections import defaultdict
 from functools import partial
 
@@ -37,6 +37,8 @@ from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory, Paral
 
 from ilastik.utility import OperatorSubView, MultiLaneOperatorABC, OpMultiLaneWrapper
 from ilastik.utility.exportingOperator import ExportingOperator
+from ilastik.utility.lruCache import LruCache
+from ilastik.utility.ramBudget import ramBudgetBytes
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
 from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
 
@@ -466,93 +468,70 @@ class OpObjectClassification(Operator, ExportingOperator,MultiLaneOperatorABC):
     def transferLabels(old_labels, old_bboxes, new_bboxes, axistags = None):
         #transfer labels from old segmentation to new segmentation
 
-        mins_old = old_bboxes["Coord<Minimum>"]
-        maxs_old = old_bboxes["Coord<Maximum>"]
-        mins_new = new_bboxes["Coord<Minimum>"]
-        maxs_new = new_bboxes["Coord<Maximum>"]
-        nobj_old = mins_old.shape[0]
+        mins_old = numpy.asarray(old_bboxes["Coord<Minimum>"], dtype=numpy.float64)
+        maxs_old = numpy.asarray(old_bboxes["Coord<Maximum>"], dtype=numpy.float64)
+        mins_new = numpy.asarray(new_bboxes["Coord<Minimum>"], dtype=numpy.float64)
+        maxs_new = numpy.asarray(new_bboxes["Coord<Maximum>"], dtype=numpy.float64)
         nobj_new = mins_new.shape[0]
         if axistags is None:
             axistags = "xyz"
-        
+
         data2D = False
         if mins_old.shape[1]==2:
             data2D = True
-        class bbox():
-            def __init__(self, minmaxs, axistags):
-                self.xmin = minmaxs[0][axistags.index('x')]
-                self.ymin = minmaxs[0][axistags.index('y')]
-                if not data2D:
-                    self.zmin = minmaxs[0][axistags.index('z')]
-                else:
-                    self.zmin = 0
-                self.xmax = minmaxs[1][axistags.index('x')]
-                self.ymax = minmaxs[1][axistags.index('y')]
-                if not data2D:
-                    self.zmax = minmaxs[1][axistags.index('z')]
-                else:
-                    self.zmax = 0
-                self.rad_x = 0.5*(self.xmax - self.xmin)
-                self.cent_x = self.xmin+self.rad_x
-                self.rad_y = 0.5*(self.ymax-self.ymin)
-                self.cent_y = self.ymin+self.rad_y
-                self.rad_z = 0.5*(self.zmax-self.zmin)
-                self.cent_z = self.zmin+self.rad_z
-
-            @staticmethod
-            def overlap(bbox_tuple):
-                this = bbox_tuple[0]
-                that = bbox_tuple[1]
-                over_x = this.rad_x+that.rad_x - (abs(this.cent_x-that.cent_x))
-                over_y = this.rad_y+that.rad_y - (abs(this.cent_y-that.cent_y))
-                over_z = this.rad_z+that.rad_z - (abs(this.cent_z-that.cent_z))
-                if not data2D:
-                    if over_x>0 and over_y>0 and over_z>0:
-                        return over_x*over_y*over_z
-                else:
-                    if over_x>0 and over_y>0:
-                        return over_x*over_y
-                return 0
+        spatial = ['x', 'y'] if data2D else ['x', 'y', 'z']
+        columns = [axistags.index(k) for k in spatial]
 
+        old_labels = numpy.asarray(old_labels)
         nonzeros = numpy.nonzero(old_labels)[0]
-        bboxes_old = [bbox(x, axistags) for x in zip(mins_old[nonzeros], maxs_old[nonzeros])]
-        bboxes_new = [bbox(x, axistags) for x in zip(mins_new, maxs_new)]
+        mins_old = mins_old[nonzeros][:, columns]
+        maxs_old = maxs_old[nonzeros][:, columns]
 
         #remove background
         #FIXME: assuming background is 0 again
-        bboxes_new = bboxes_new[1:]
+        mins_new = mins_new[1:][:, columns]
+        maxs_new = maxs_new[1:][:, columns]
 
-        double_for_loop = itertools.product(bboxes_old, bboxes_new)
-        overlaps = map(bbox.overlap, double_for_loop)
+        def centers(mins, maxs):
+            # (cent_x, cent_y, cent_z) of each box, cent_z is 0 for 2D data
+            cents = mins + 0.5*(maxs - mins)
+            if data2D:
+                cents = numpy.hstack((cents, numpy.zeros((cents.shape[0], 1))))
+            return cents
+
+        cents_old = centers(mins_old, maxs_old)
+        cents_new = centers(mins_new, maxs_new)
+
+        nold = len(nonzeros)
+        nnew = max(nobj_new - 1, 0)
+        iold, inew, overlaps = _bbox_overlaps(mins_old, maxs_old, mins_new, maxs_new)
 
-        overlaps = numpy.asarray(overlaps)
-        overlaps = overlaps.reshape((len(bboxes_old), len(bboxes_new)))
         new_labels = numpy.zeros((nobj_new,), dtype=numpy.uint32)
         old_labels_lost = dict()
-        old_labels_lost["full"]=[]
-        old_labels_lost["partial"]=[]
         new_labels_lost = dict()
-        new_labels_lost["conflict"]=[]
-        for iobj in range(overlaps.shape[0]):
-            #take the object with maximum overlap
-            overlapsum = numpy.sum(overlaps[iobj, :])
-            if overlapsum==0:
-                old_labels_lost["full"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
-                continue
-            newindex = numpy.argmax(overlaps[iobj, :])
-            if overlapsum-overlaps[iobj,newindex]>0:
-                #this object overlaps with more than one new object
-                old_labels_lost["partial"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
-
-            overlaps[iobj, :] = 0
-            overlaps[iobj, newindex] = 1 #doesn't matter what number>0
 
-        for iobj in range(overlaps.shape[1]):
-            labels = numpy.where(overlaps[:, iobj]>0)[0]
-            if labels.shape[0]==1:
-                new_labels[iobj+1]=old_labels[nonzeros[labels[0]]] #iobj+1 because of the background
-            elif labels.shape[0]>1:
-                new_labels_lost["conflict"].append((bboxes_new[iobj].cent_x, bboxes_new[iobj].cent_y, bboxes_new[iobj].cent_z))
+        #take the new object with maximum overlap (the first one, if there are several)
+        overlapsum = numpy.bincount(iold, weights=overlaps, minlength=max(nold, 1))[:nold]
+        order = numpy.lexsort((inew, -overlaps, iold))
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = iold[order][1:] != iold[order][:-1]
+        best = order[first]
+        best_old = iold[best]
+        best_new = inew[best]
+        best_overlap = numpy.zeros((nold,))
+        best_overlap[best_old] = overlaps[best]
+
+        lost_full = numpy.nonzero(overlapsum == 0)[0]
+        #these objects overlap with more than one new object
+        lost_partial = numpy.nonzero(overlapsum - best_overlap > 0)[0]
+        old_labels_lost["full"] = [tuple(cents_old[i]) for i in lost_full]
+        old_labels_lost["partial"] = [tuple(cents_old[i]) for i in lost_partial]
+
+        nassigned = numpy.bincount(best_new, minlength=max(nnew, 1))[:nnew]
+        unique = nassigned[best_new] == 1
+        #+1 because of the background
+        new_labels[best_new[unique]+1] = old_labels[nonzeros[best_old[unique]]]
+        new_labels_lost["conflict"] = [tuple(cents_new[j]) for j in numpy.nonzero(nassigned > 1)[0]]
 
         new_labels = new_labels
         new_labels[0]=0 #FIXME: hardcoded background value again
@@ -725,13 +704,13 @@ class OpObjectClassification(Operator, ExportingOperator,MultiLaneOperatorABC):
         :param progress_slot:
         :return:
         """
-        from ilastik.utility.exportFile import objects_per_frame, ExportFile, ilastik_ids, Mode, Default
+        from ilastik.utility.exportFile import objects_per_frame, StreamingExportFile, ilastik_ids, Mode, Default
 
         label_image = self.SegmentationImages[0]
         obj_count = list(objects_per_frame(label_image))
         ids = ilastik_ids(obj_count)
 
-        export_file = ExportFile(settings["file path"])
+        export_file = StreamingExportFile(settings["file path"])
         export_file.ExportProgress.subscribe(progress_slot)
         export_file.InsertionProgress.subscribe(progress_slot)
 
@@ -775,6 +754,79 @@ def _concatenate(arrays, axis):
     return numpy.concatenate(arrays, axis=axis)
 
 
+def _bbox_overlaps(mins_a, maxs_a, mins_b, maxs_b):
+    """Find all pairs of overlapping bounding boxes of two sets.
+
+    Boxes are hashed into a regular grid, so only boxes sharing a
+    grid cell are compared. The overlap of two boxes is the product of
+    (rad_a + rad_b - |cent_a - cent_b|) over all axes, as used by
+    OpObjectClassification.transferLabels.
+
+    :returns: (index_a, index_b, overlap) arrays for all pairs with
+        positive overlap
+
+    """
+    empty = (numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,)))
+    if len(mins_a) == 0 or len(mins_b) == 0:
+        return empty
+
+    ndim = mins_a.shape[1]
+    origin = numpy.minimum(mins_a.min(axis=0), mins_b.min(axis=0))
+    cell_size = max(numpy.median(maxs_b - mins_b), 1.0)
+    ncells = numpy.floor((numpy.maximum(maxs_a.max(axis=0), maxs_b.max(axis=0)) - origin) / cell_size).astype(numpy.int64) + 1
+
+    def cell_entries(mins, maxs):
+        # one (cell id, box index) entry for every grid cell a box touches
+        lo = numpy.floor((mins - origin) / cell_size).astype(numpy.int64)
+        hi = numpy.floor((maxs - origin) / cell_size).astype(numpy.int64)
+        extent = hi - lo + 1
+        ncovered = numpy.prod(extent, axis=1)
+        boxes = numpy.repeat(numpy.arange(len(mins)), ncovered)
+        # position of each entry within the cells covered by its box
+        offsets = numpy.arange(len(boxes)) - numpy.repeat(numpy.cumsum(ncovered) - ncovered, ncovered)
+        cells = numpy.zeros(len(boxes), dtype=numpy.int64)
+        for d in range(ndim):
+            coord = lo[boxes, d] + offsets % extent[boxes, d]
+            offsets = offsets // extent[boxes, d]
+            cells = cells * ncells[d] + coord
+        return cells, boxes
+
+    cells_a, boxes_a = cell_entries(mins_a, maxs_a)
+    cells_b, boxes_b = cell_entries(mins_b, maxs_b)
+    order = numpy.argsort(cells_b, kind='mergesort')
+    cells_b = cells_b[order]
+    boxes_b = boxes_b[order]
+
+    # join the entries of both sets on the cell id
+    start = numpy.searchsorted(cells_b, cells_a, side='left')
+    stop = numpy.searchsorted(cells_b, cells_a, side='right')
+    nmatches = stop - start
+    index_a = numpy.repeat(boxes_a, nmatches)
+    positions = numpy.arange(nmatches.sum()) - numpy.repeat(numpy.cumsum(nmatches) - nmatches, nmatches)
+    index_b = boxes_b[numpy.repeat(start, nmatches) + positions]
+
+    # boxes sharing several cells give duplicate pairs
+    pairs = numpy.unique(index_a.astype(numpy.int64) * len(mins_b) + index_b)
+    index_a = pairs // len(mins_b)
+    index_b = pairs % len(mins_b)
+    if len(pairs) == 0:
+        return empty
+
+    rad_a = 0.5*(maxs_a - mins_a)
+    rad_b = 0.5*(maxs_b - mins_b)
+    over = rad_a[index_a] + rad_b[index_b] - numpy.abs((mins_a + rad_a)[index_a] - (mins_b + rad_b)[index_b])
+    positive = numpy.all(over > 0, axis=1)
+    return index_a[positive], index_b[positive], numpy.prod(over[positive], axis=1)
+
+def get_num_objects(extracted_features):
+    """Return the number of objects (including background) in the
+    feature dict of a single time step."""
+    n = 0
+    for group, feature_dict in extracted_features.items():
+        for feature_name, feature_matrix in feature_dict.items():
+            n = max(n, len(feature_matrix))
+    return n
+
 def make_feature_array(feats, selected, labels=None):
     featlist = []
     labellist = []
@@ -1004,6 +1056,23 @@ class OpObjectPredict(Operator):
 
     #SegmentationThreshold = 0.5
 
+    # Probabilities and bad objects of this fraction of the RAM budget
+    # are cached, the least recently used time steps are dropped first.
+    CACHE_RAM_FRACTION = 0.05
+
+    def __init__(self, *args, **kwargs):
+        super(OpObjectPredict, self).__init__(*args, **kwargs)
+        # self._lock only guards the bookkeeping below, never the computation.
+        self._lock = threading.Lock()
+        # Time step -> (probabilities, bad objects). The bad objects are None
+        #  for probabilities that were loaded from the project file.
+        self.prediction_cache = LruCache()
+        # Time steps currently being predicted: t -> Request
+        self._pending = dict()
+        # Incremented whenever the caches are invalidated, so that
+        #  predictions started before don't end up in the cache
+        self._generation = 0
+
     def setupOutputs(self):
         self.Predictions.meta.shape = self.Features.meta.shape
         self.Predictions.meta.dtype = object
@@ -1030,9 +1099,96 @@ class OpObjectPredict(Operator):
                 oslot.meta.axistags = None
                 oslot.meta.mapping_dtype = numpy.float32
 
-        self.lock = RequestLock()
-        self.prob_cache = dict()
-        self.bad_objects = dict()
+        self._invalidateCaches()
+
+    def _invalidateCaches(self, probabilities=None):
+        """Drop all cached and pending predictions, optionally
+        replacing the cache contents with the given probabilities."""
+        with self._lock:
+            self._generation += 1
+            self._pending = dict()
+            self.prediction_cache.clear()
+            self.prediction_cache.set_max_bytes(ramBudgetBytes(self.CACHE_RAM_FRACTION))
+            if probabilities is not None:
+                for t, probs in probabilities.iteritems():
+                    self.prediction_cache[t] = (probs, None)
+
+    def _predict_time_step(self, t, classifier, selected, generation):
+        """Predict the probabilities of all objects in time step t.
+
+        Returns (probabilities, bad_objects).
+        """
+        try:
+            # Initialize with a single value for the 'background object '
+            probs = numpy.zeros( (1, len(self.ProbabilityChannels)), dtype=numpy.float32 )
+            bad_objects = numpy.zeros((1,))
+            tmpfeats = self.Features([t]).wait()
+            num_objects = get_num_objects(tmpfeats[t])
+
+            # Apparently self.Features always returns a background object,
+            #  so we expect at least 1 object in the list, even if there's nothing to predict.
+            assert num_objects > 0
+            if num_objects > 1:
+                ftmatrix, _, col_names = make_feature_array(tmpfeats, selected)
+                rows, cols = replace_missing(ftmatrix)
+                bad_objects = numpy.zeros((ftmatrix.shape[0],))
+                bad_objects[rows] = 1
+
+                # Note: We can't use RandomForest.predictLabels() here because we're training in parallel,
+                #        and we have to average the PROBABILITIES from all forests.
+                #       Averaging the label predictions from each forest is NOT equivalent.
+                #       For details please see wikipedia:
+                #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
+                #       (^-^)
+                logger.debug("Predicting object probabilities for time step: {}".format( t ))
+                probs = classifier.predict_probabilities(ftmatrix.astype(numpy.float32))
+
+            # probs is indexed as follows: probs[object_index, class_index]
+            probs[0] = 0 # Background probability is always zero
+
+            with self._lock:
+                if generation == self._generation:
+                    self.prediction_cache[t] = (probs, bad_objects)
+            return probs, bad_objects
+        finally:
+            with self._lock:
+                if generation == self._generation:
+                    del self._pending[t]
+
+    def _get_probabilities(self, times, classifier):
+        """Return (probabilities, bad_objects) dicts for the given time steps.
+
+        Each missing time step is predicted exactly once: concurrent
+        requests for the same time step wait for the same prediction,
+        and different time steps are predicted in parallel.
+        """
+        probs = {}
+        bad_objects = {}
+        waiting = {}
+        new_requests = []
+        selected = self.SelectedFeatures([]).wait()
+        with self._lock:
+            for t in times:
+                if t in self.prediction_cache:
+                    probs[t], bad_objects[t] = self.prediction_cache[t]
+                elif t in self._pending:
+                    waiting[t] = self._pending[t]
+                else:
+                    req = Request( partial(self._predict_time_step, t, classifier, selected, self._generation) )
+                    self._pending[t] = req
+                    waiting[t] = req
+                    new_requests.append(req)
+
+        for req in new_requests:
+            req.submit()
+        for t, req in waiting.iteritems():
+            probs[t], bad_objects[t] = req.wait()
+
+        for t in times:
+            if bad_objects[t] is None:
+                # Loaded from the project file, without bad objects
+                bad_objects[t] = numpy.zeros((probs[t].shape[0],))
+        return probs, bad_objects
 
     def execute(self, slot, subindex, roi, result):
         assert slot in [self.Predictions,
@@ -1047,112 +1203,48 @@ class OpObjectPredict(Operator):
             times = range(self.Predictions.meta.shape[0])
 
         if slot is self.CachedProbabilities:
-            return {t: self.prob_cache[t] for t in times if t in self.prob_cache}
+            with self._lock:
+                return {t: self.prediction_cache[t][0] for t in times if t in self.prediction_cache}
 
         classifier = self.Classifier.value
         if classifier is None:
             # this happens if there was no data to train with
             return dict((t, numpy.array([])) for t in times)
 
-        feats = {}
-        prob_predictions = {}
-
-        selected = self.SelectedFeatures([]).wait()
-
-        def get_num_objects(extracted_features):
-            n = 0
-            for group, feature_dict in extracted_features.items():
-                for feature_name, feature_matrix in feature_dict.items():
-                    n = max(n, len(feature_matrix))
-            return n
+        prob_cache, bad_objects = self._get_probabilities(times, classifier)
 
-        # FIXME: self.prob_cache is shared, so we need to block.
-        # However, this makes prediction single-threaded.
-        with self.lock:
+        if slot == self.Probabilities:
+            return { t : prob_cache[t] for t in times }
+        elif slot == self.Predictions:
+            # FIXME: Support SegmentationThreshold again...
+            labels = dict()
             for t in times:
-                if t in self.prob_cache:
-                    continue
+                labels[t] = 1 + numpy.argmax(prob_cache[t], axis=1)
+                labels[t][0] = 0 # Background gets the zero label
 
-                # Initialize with a single value for the 'background object '
-                prob_predictions[t] = numpy.zeros( (1, len(self.ProbabilityChannels)), dtype=numpy.float32 )
-                tmpfeats = self.Features([t]).wait()
-                num_objects = get_num_objects(tmpfeats[t])
+            return labels
 
-                # Apparently self.Features always returns a background object, 
-                #  so we expect at least 1 object in the list, even if there's nothing to predict.
-                assert num_objects > 0
-                if num_objects == 1:
-                    continue
-                    
-                ftmatrix, _, col_names = make_feature_array(tmpfeats, selected)
-                rows, cols = replace_missing(ftmatrix)
-                self.bad_objects[t] = numpy.zeros((ftmatrix.shape[0],))
-                self.bad_objects[t][rows] = 1
-                feats[t] = ftmatrix
-
-            # Are there any objects to predict?
-            if len(feats) > 0:
-                def predict_forest(_t):
-                    # Note: We can't use RandomForest.predictLabels() here because we're training in parallel,
-                    #        and we have to average the PROBABILITIES from all forests.
-                    #       Averaging the label predictions from each forest is NOT equivalent.
-                    #       For details please see wikipedia:
-                    #       http://en.wikipedia.org/wiki/Electoral_College_%28United_States%29#Irrelevancy_of_national_popular_vote
-                    #       (^-^)
-                    prob_predictions[_t] = classifier.predict_probabilities(feats[_t].astype(numpy.float32))
-    
-                # predict the data with all the forests in parallel
-                pool = RequestPool()
-                for t in times:
-                    if t in self.prob_cache:
-                        continue
-                    logger.debug("Predicting object probabilities for time step: {}".format( t ))
-                    req = Request( partial(predict_forest, t) )
-                    pool.add(req)
-    
-                pool.wait()
-                pool.clean()
+        elif slot == self.ProbabilityChannels:
+            try:
+                prob_single_channel = {t: prob_cache[t][:, subindex[0]]
+                                       for t in times}
+            except:
+                # no probabilities available for this class; return zeros
+                prob_single_channel = {t: numpy.zeros((prob_cache[t].shape[0], 1))
+                                       for t in times}
+            return prob_single_channel
 
-            for t in times:
-                if t not in self.prob_cache:
-                    # prob_predictions is a dict-of-arrays, indexed as follows:
-                    # prob_predictions[t][object_index, class_index]
-                    self.prob_cache[t] = prob_predictions[t]
-                    self.prob_cache[t][0] = 0 # Background probability is always zero
-
-
-            if slot == self.Probabilities:
-                return { t : self.prob_cache[t] for t in times }
-            elif slot == self.Predictions:
-                # FIXME: Support SegmentationThreshold again...
-                labels = dict()
-                for t in times:
-                    prob_sum = numpy.sum(self.prob_cache[t], axis=1)
-                    labels[t] = 1 + numpy.argmax(self.prob_cache[t], axis=1)
-                    labels[t][0] = 0 # Background gets the zero label
-                
-                return labels
-
-            elif slot == self.ProbabilityChannels:
-                try:
-                    prob_single_channel = {t: self.prob_cache[t][:, subindex[0]]
-                                           for t in times}
-                except:
-                    # no probabilities available for this class; return zeros
-                    prob_single_channel = {t: numpy.zeros((self.prob_cache[t].shape[0], 1))
-                                           for t in times}
-                return prob_single_channel
+        elif slot == self.BadObjects:
+            return { t : bad_objects[t] for t in times }
 
-            elif slot == self.BadObjects:
-                return { t : self.bad_objects[t] for t in times }
-
-            else:
-                assert False, "Unknown input slot"
+        else:
+            assert False, "Unknown input slot"
 
     def propagateDirty(self, slot, subindex, roi):
-        self.prob_cache = {}
+        probabilities = None
         if slot is self.InputProbabilities:
-            self.prob_cache = self.InputProbabilities([]).wait()
+            probabilities = self.InputProbabilities([]).wait()
+        self._invalidateCaches(probabilities)
         self.Predictions.setDirty(())
         self.Probabilities.setDirty(())
         self.ProbabilityChannels.setDirty(())
@@ -1203,6 +1295,63 @@ class OpObjectPredict(Operator):
 
 
 
+def _object_map_lut(tmap, dtype):
+    """Make a lookup table from the object map of a single time step.
+
+    The table has one trailing zero entry, so that labels beyond the
+    map can be mapped to zero with numpy.take(..., mode='clip').
+    """
+    # FIXME: necessary because predictions are returned
+    # enclosed in a list.
+    if isinstance(tmap, list):
+        tmap = tmap[0]
+    tmap = numpy.asarray(tmap).squeeze()
+    if tmap.ndim == 0:
+        # no objects, nothing to paint
+        return numpy.zeros((1,), dtype=dtype)
+    lut = numpy.zeros((len(tmap) + 1,), dtype=dtype)
+    lut[:len(tmap)] = tmap
+    return lut
+
+def _dirty_time_steps(roi):
+    """Return the time steps of a dirty List roi on an object map,
+    or None if everything is dirty."""
+    if len(roi._l) == 0:
+        return None
+    if isinstance(roi._l[0], int):
+        return set(roi._l)
+    # (time, object) pairs
+    return set(t for t, _ in roi._l)
+
+class _LookupTableCache(object):
+    """Thread-safe cache of per-time-step lookup tables."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._luts = {}
+        # Incremented on every invalidation, so that tables computed
+        #  from outdated maps are not stored
+        self._generation = 0
+
+    def get(self, t, make_lut):
+        with self._lock:
+            lut = self._luts.get(t)
+            generation = self._generation
+        if lut is None:
+            lut = make_lut()
+            with self._lock:
+                if generation == self._generation:
+                    self._luts[t] = lut
+        return lut
+
+    def invalidate(self, time_steps=None):
+        with self._lock:
+            self._generation += 1
+            if time_steps is None:
+                self._luts = {}
+            else:
+                for t in time_steps:
+                    self._luts.pop(t, None)
+
 class OpRelabelSegmentation(Operator):
     """Takes a segmentation image and a mapping and returns the
     mapped image.
@@ -1219,9 +1368,20 @@ class OpRelabelSegmentation(Operator):
     loggingName = __name__ + ".OpRelabelSegmentation"
     logger = logging.getLogger(loggingName)
 
+    def __init__(self, *args, **kwargs):
+        super(OpRelabelSegmentation, self).__init__(*args, **kwargs)
+        self._luts = _LookupTableCache()
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.Image.meta)
         self.Output.meta.dtype = self.ObjectMap.meta.mapping_dtype
+        self._luts.invalidate()
+
+    def _lookupTable(self, t):
+        def make_lut():
+            map_ = self.ObjectMap([t]).wait()
+            return _object_map_lut(map_[t], self.Output.meta.dtype)
+        return self._luts.get(t, make_lut)
 
     def execute(self, slot, subindex, roi, result):
         tStart = time.time()
@@ -1233,37 +1393,18 @@ class OpRelabelSegmentation(Operator):
         for t in range(roi.start[0], roi.stop[0]):
             
             tMAP = time.time()
-            map_ = self.ObjectMap([t]).wait()
-            tmap = map_[t]
-            # FIXME: necessary because predictions are returned
-            # enclosed in a list.
-            if isinstance(tmap, list):
-                tmap = tmap[0]
-            tmap = tmap.squeeze()
-            if tmap.ndim==0:
-                # no objects, nothing to paint
-                result[t-roi.start[0]][:] = 0
-                return result
-            
+            lut = self._lookupTable(t)
             tMAP = 1000.0*(time.time()-tMAP)
-            #FIXME: This should be cached (and reset when the input becomes dirty)")
-            tMAX = time.time()
-            idx = img.max()
-            
-            if len(tmap) <= idx:
-                newTmap = numpy.zeros((idx + 1,)) # And maybe this should be cached, too?
-                newTmap[:len(tmap)] = tmap[:]
-                tmap = newTmap
-            tMAX = 1000.0*(time.time()-tMAX)
             
             #do the work thing
             tWORK = time.time()
-            result[t-roi.start[0]] = tmap[img[t-roi.start[0]]]
+            # labels beyond the map are clipped to the trailing zero of the lut
+            result[t-roi.start[0]] = numpy.take(lut, img[t-roi.start[0]], mode='clip')
             tWORK = 1000.0*(time.time()-tWORK)
             
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tStart = 1000.0*(time.time()-tStart)
-            self.logger.debug("took %f msec. (img: %f, wait ObjectMap: %f, do work: %f, max: %f)" % (tStart, tIMG, tMAP, tWORK, tMAX))
+            self.logger.debug("took %f msec. (img: %f, wait ObjectMap: %f, do work: %f)" % (tStart, tIMG, tMAP, tWORK))
         
         return result
 
@@ -1272,6 +1413,9 @@ class OpRelabelSegmentation(Operator):
             self.Output.setDirty(roi)
 
         elif slot is self.ObjectMap or slot is self.Features:
+            if slot is self.ObjectMap:
+                self._luts.invalidate(_dirty_time_steps(roi))
+
             # this is hacky. the gui's onClick() function calls
             # setDirty with a (time, object) pair, while elsewhere we
             # call setDirty with ().
@@ -1306,9 +1450,14 @@ class OpMultiRelabelSegmentation(Operator):
     Features = InputSlot(rtype=List, stype=Opaque) #this is needed to limit dirty propagation to the object bbox
     Output = OutputSlot(level=1)
 
+    # All maps applied in a single pass over the segmentation image,
+    # stacked along the (last) channel axis
+    StackedOutput = OutputSlot()
+
     def __init__(self, *args, **kwargs):
         super(OpMultiRelabelSegmentation, self).__init__(*args, **kwargs)
         self._innerOperators = []
+        self._luts = _LookupTableCache()
 
     def setupOutputs(self):
         nmaps = len(self.ObjectMaps)
@@ -1321,10 +1470,55 @@ class OpMultiRelabelSegmentation(Operator):
         self.Output.resize(nmaps)
         for i, oslot in enumerate(self.Output):
             oslot.connect(self._innerOperators[i].Output)
-            
+
+        self.StackedOutput.meta.assignFrom(self.Image.meta)
+        self.StackedOutput.meta.shape = self.Image.meta.shape[:-1] + (nmaps,)
+        dtype = None
+        if nmaps > 0:
+            dtype = self.ObjectMaps[0].meta.mapping_dtype
+        self.StackedOutput.meta.dtype = dtype or numpy.float32
+        self._luts.invalidate()
+
+    def _lookupTable(self, t):
+        def make_lut():
+            dtype = self.StackedOutput.meta.dtype
+            luts = [_object_map_lut(islot([t]).wait()[t], dtype) for islot in self.ObjectMaps]
+            # pad all maps to the same number of objects
+            nobjects = max(len(lut) for lut in luts)
+            stacked = numpy.zeros((nobjects, len(luts)), dtype=dtype)
+            for i, lut in enumerate(luts):
+                stacked[:len(lut) - 1, i] = lut[:-1]
+            return stacked
+        return self._luts.get(t, make_lut)
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot is self.StackedOutput
+        # request the segmentation image once for all channels
+        img_start = tuple(roi.start[:-1]) + (0,)
+        img_stop = tuple(roi.stop[:-1]) + (1,)
+        img = self.Image(img_start, img_stop).wait()
+
+        for t in range(roi.start[0], roi.stop[0]):
+            lut = self._lookupTable(t)[:, roi.start[-1]:roi.stop[-1]]
+            labels = img[t-roi.start[0], ..., 0]
+            # labels beyond the maps are clipped to the trailing zero row of the lut
+            result[t-roi.start[0]] = numpy.take(lut, labels, axis=0, mode='clip')
+        return result
 
     def propagateDirty(self, slot, subindex, roi):
-        pass
+        # The level-1 Output slots are handled by the inner operators.
+        if slot is self.Image:
+            start = tuple(roi.start[:-1]) + (0,)
+            stop = tuple(roi.stop[:-1]) + (self.StackedOutput.meta.shape[-1],)
+            self.StackedOutput.setDirty(start, stop)
+        elif slot is self.ObjectMaps:
+            time_steps = _dirty_time_steps(roi)
+            self._luts.invalidate(time_steps)
+            if time_steps is None:
+                self.StackedOutput.setDirty(slice(None))
+            else:
+                for t in time_steps:
+                    self.StackedOutput.setDirty(slice(t, t+1))
 
 class OpMaxLabel(Operator):
     """Finds the maximum label value in the input labels.
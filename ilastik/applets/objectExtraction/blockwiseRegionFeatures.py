@@ -0,0 +1,201 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Helpers for computing region features block by block.
+
+Each block is handed to vigra separately. The per-block accumulators
+are then merged into the accumulators of the whole volume, which is
+only possible for features that can be combined exactly from partial
+results (counts, sums, extrema and the first two moments).
+"""
+import itertools
+
+import numpy as np
+import vigra
+
+# Features that RegionFeatureAccumulator can merge across blocks
+MERGEABLE_FEATURES = set(['Count', 'Sum', 'Mean', 'Variance',
+                          'Minimum', 'Maximum',
+                          'Coord<Minimum>', 'Coord<Maximum>', 'RegionCenter'])
+
+def blockwise_supported(feature_names):
+    """Return True if all features in the nested feature dictionary
+    can be computed blockwise.
+
+    >>> blockwise_supported({'Standard Object Features': {'Count': {}, 'Mean': {}}})
+    True
+    >>> blockwise_supported({'Standard Object Features': {'Mean in neighborhood': {'margin': 5}}})
+    False
+
+    """
+    for plugin_name, feature_dict in feature_names.iteritems():
+        if plugin_name != 'Standard Object Features':
+            return False
+        for feature_name, params in feature_dict.iteritems():
+            if feature_name not in MERGEABLE_FEATURES or 'margin' in params:
+                return False
+    return True
+
+def determine_block_shape(shape, bytes_per_voxel, max_bytes):
+    """Halve the longest axis of 'shape' until a block needs at most
+    'max_bytes'.
+
+    >>> determine_block_shape((100, 100, 100), 1, 1e6)
+    (100, 100, 100)
+    >>> determine_block_shape((100, 100, 100), 1, 2e5)
+    (50, 50, 50)
+
+    """
+    block_shape = list(shape)
+    while np.prod(block_shape) * bytes_per_voxel > max_bytes and max(block_shape) > 1:
+        i = np.argmax(block_shape)
+        block_shape[i] = (block_shape[i] + 1) // 2
+    return tuple(block_shape)
+
+def block_starts(shape, block_shape):
+    """Iterate over the start coordinates of all blocks."""
+    ranges = [range(0, s, b) for s, b in zip(shape, block_shape)]
+    return itertools.product(*ranges)
+
+def extract_block_features(image, labels, features):
+    """Compute the accumulators needed to merge 'features' on one block.
+
+    :param image: float32 array with spatial axes, and optionally a
+        trailing channel axis
+    :param labels: uint32 array with spatial axes
+    :param features: names of the requested features
+    :returns: a dictionary of 2D arrays, indexed by label
+
+    """
+    needed = set(features) | set(['Count'])
+    if 'Variance' in needed:
+        needed.add('Mean')
+    result = vigra.analysis.extractRegionFeatures(image, labels, list(needed), ignoreLabel=0)
+    block_feats = {}
+    for name in needed:
+        value = np.asarray(result[name], dtype=np.float64)
+        block_feats[name] = value.reshape(value.shape[0], -1)
+    return block_feats
+
+class RegionFeatureAccumulator(object):
+    """Merges the per-block results of extract_block_features().
+
+    Not thread-safe: callers must serialize calls to add_block().
+    """
+    def __init__(self, features):
+        self.features = set(features)
+        assert self.features <= MERGEABLE_FEATURES
+        self._count = np.zeros((1, 1)) # background row
+        self._values = {}
+
+    def _resize(self, nlabels, block_feats):
+        if nlabels <= self._count.shape[0]:
+            return
+        fill = {'Minimum': np.inf, 'Coord<Minimum>': np.inf,
+                'Maximum': -np.inf, 'Coord<Maximum>': -np.inf}
+        old = self._count.shape[0]
+        self._count = np.vstack((self._count, np.zeros((nlabels - old, 1))))
+        for name in self.features | set(['Mean']):
+            if name not in block_feats:
+                continue
+            ncols = block_feats[name].shape[1]
+            if name not in self._values:
+                self._values[name] = np.empty((old, ncols))
+                self._values[name][:] = fill.get(name, 0)
+            extension = np.empty((nlabels - old, ncols))
+            extension[:] = fill.get(name, 0)
+            self._values[name] = np.vstack((self._values[name], extension))
+
+    def add_block(self, block_feats, offset, labels=None):
+        """Merge the results of one block.
+
+        :param block_feats: as returned by extract_block_features()
+        :param offset: start coordinate of the block, in the spatial
+            axis order of the arrays given to extract_block_features()
+        :param labels: optional array of the (distinct) labels that the
+            rows of block_feats are merged into. By default, row i
+            belongs to label i.
+
+        """
+        offset = np.asarray(offset, dtype=np.float64)
+        count_b = block_feats['Count']
+        present = np.nonzero(count_b[:, 0] > 0)[0]
+        rows = present if labels is None else np.asarray(labels)[present]
+        present = present[rows > 0] # ignore background
+        rows = rows[rows > 0]
+        if len(present) == 0:
+            return
+        self._resize(rows.max() + 1, block_feats)
+
+        n_a = self._count[rows]
+        n_b = count_b[present]
+        n = n_a + n_b
+        values = self._values
+
+        if 'Mean' in values:
+            mean_a = values['Mean'][rows]
+            mean_b = block_feats['Mean'][present]
+            delta = mean_b - mean_a
+            if 'Variance' in values:
+                # values['Variance'] holds the sum of squared deviations until result()
+                m2_b = block_feats['Variance'][present] * n_b
+                values['Variance'][rows] += m2_b + delta**2 * n_a * n_b / n
+            values['Mean'][rows] = mean_a + delta * n_b / n
+
+        if 'Sum' in values:
+            values['Sum'][rows] += block_feats['Sum'][present]
+        if 'Minimum' in values:
+            values['Minimum'][rows] = np.minimum(values['Minimum'][rows], block_feats['Minimum'][present])
+        if 'Maximum' in values:
+            values['Maximum'][rows] = np.maximum(values['Maximum'][rows], block_feats['Maximum'][present])
+        if 'Coord<Minimum>' in values:
+            values['Coord<Minimum>'][rows] = np.minimum(values['Coord<Minimum>'][rows],
+                                                        block_feats['Coord<Minimum>'][present] + offset)
+        if 'Coord<Maximum>' in values:
+            values['Coord<Maximum>'][rows] = np.maximum(values['Coord<Maximum>'][rows],
+                                                        block_feats['Coord<Maximum>'][present] + offset)
+        if 'RegionCenter' in values:
+            # values['RegionCenter'] holds the coordinate sums until result()
+            values['RegionCenter'][rows] += (block_feats['RegionCenter'][present] + offset) * n_b
+
+        self._count[rows] = n
+
+    def result(self):
+        """Return the merged features as a dictionary of float32 arrays
+        with one row per label, including the background row 0 (all zeros).
+        """
+        count = self._count
+        empty = (count[:, 0] == 0)
+        safe_count = np.where(count > 0, count, 1)
+        merged = {}
+        for name in self.features:
+            if name == 'Count':
+                value = count.copy()
+            elif name not in self._values:
+                # no object was found in any block
+                value = np.zeros((count.shape[0], 1))
+            elif name in ('Variance', 'RegionCenter'):
+                value = self._values[name] / safe_count
+            else:
+                value = self._values[name].copy()
+            value[empty] = 0
+            merged[name] = value.astype(np.float32)
+        return merged
@@ -21,6 +21,7 @@
 #Python
 from copy import copy, deepcopy
 import collections
+import threading
 from functools import partial
 
 # SciPy
@@ -45,6 +46,9 @@ except:
     logger.warn('could not import pluginManager')
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.utility.ramBudget import ramBudgetBytes
+from blockwiseRegionFeatures import blockwise_supported, determine_block_shape, block_starts, \
+                                    extract_block_features, RegionFeatureAccumulator
 
 # These features are always calculated, but not used for prediction.
 # They are needed by our gui, or by downstream applets.
@@ -524,6 +528,13 @@ class OpRegionFeatures(Operator):
 
     Output = OutputSlot()
 
+    # Local features are computed for this many objects per request
+    LOCAL_FEATURES_CHUNK_SIZE = 256
+
+    # If a time slice needs more than this fraction of the RAM budget,
+    # mergeable features are computed block by block
+    BLOCKWISE_RAM_FRACTION = 0.25
+
     def setupOutputs(self):
         if self.LabelVolume.meta.axistags != self.RawVolume.meta.axistags:
             raise Exception('raw and label axis tags do not match')
@@ -550,7 +561,13 @@ class OpRegionFeatures(Operator):
         t_ind = self.RawVolume.meta.axistags.index('t')
         assert t_ind < len(self.RawVolume.meta.shape)
 
+        block_shape = self._blockwiseBlockShape()
+
         def compute_features_for_time_slice(res_t_ind, t):
+            if block_shape is not None:
+                result[res_t_ind] = self._extract_blockwise(t, block_shape)
+                return
+
             # Process entire spatial volume
             s = [slice(None) for i in range(len(self.RawVolume.meta.shape))]
             s[t_ind] = slice(t, t+1)
@@ -588,6 +605,107 @@ class OpRegionFeatures(Operator):
         pool.wait()
         return result
 
+    def _spatialAxes(self):
+        """The spatial axes in the order vigra sees them in _extract()."""
+        taggedShape = self.RawVolume.meta.getTaggedShape()
+        return [k for k in taggedShape.keys()
+                if k in 'xy' or (k == 'z' and taggedShape[k] > 1)]
+
+    def _bytesPerVoxel(self):
+        """Memory needed per voxel while computing features of a block."""
+        nchannels = self.RawVolume.meta.getTaggedShape()['c']
+        raw_bytes = np.dtype(self.RawVolume.meta.dtype).itemsize
+        label_bytes = np.dtype(self.LabelVolume.meta.dtype).itemsize
+        # input data plus the float32/uint32 copies handed to vigra
+        return nchannels * (raw_bytes + 4) + label_bytes + 4
+
+    def _blockwiseBlockShape(self):
+        """Return the spatial block shape for computing features blockwise.
+
+        Returns None if a time slice fits into the RAM budget, or if the
+        selected features can't be merged across blocks.
+        """
+        if not blockwise_supported(self.Features([]).wait()):
+            return None
+
+        taggedShape = self.RawVolume.meta.getTaggedShape()
+        shape = [taggedShape[k] for k in self._spatialAxes()]
+        bytes_per_voxel = self._bytesPerVoxel()
+        max_bytes = ramBudgetBytes(self.BLOCKWISE_RAM_FRACTION)
+        if np.prod(shape) * bytes_per_voxel <= max_bytes:
+            return None
+
+        # Every worker thread may hold one block
+        n_workers = max(1, Request.global_thread_pool.num_workers)
+        block_shape = determine_block_shape(shape, bytes_per_voxel, max_bytes / n_workers)
+        logger.debug("Computing region features blockwise with block shape {}".format(block_shape))
+        return block_shape
+
+    def _extract_blockwise(self, t, block_shape):
+        """Compute mergeable features of time slice t block by block.
+
+        Returns the same nested dictionary as _extract().
+        """
+        feature_names = self.Features([]).wait()
+        requested = set(default_features.keys())
+        for feature_dict in feature_names.itervalues():
+            requested |= set(feature_dict.keys())
+        accumulator = RegionFeatureAccumulator(requested)
+        lock = threading.Lock()
+
+        spatial = self._spatialAxes()
+        taggedShape = self.RawVolume.meta.getTaggedShape()
+        spatial_shape = [taggedShape[k] for k in spatial]
+        nchannels = taggedShape['c']
+
+        def block_roi(slot, block_start):
+            slotShape = slot.meta.getTaggedShape()
+            axes = slotShape.keys()
+            start = [0] * len(axes)
+            stop = slotShape.values()
+            start[axes.index('t')] = t
+            stop[axes.index('t')] = t + 1
+            for k, bstart, bsize, size in zip(spatial, block_start, block_shape, spatial_shape):
+                start[axes.index(k)] = bstart
+                stop[axes.index(k)] = min(bstart + bsize, size)
+            return start, stop
+
+        def process_block(block_start):
+            raw_req = self.RawVolume(*block_roi(self.RawVolume, block_start))
+            label_req = self.LabelVolume(*block_roi(self.LabelVolume, block_start))
+            raw_req.submit()
+            label_req.submit()
+
+            rawBlock = vigra.taggedView(raw_req.wait(), axistags=self.RawVolume.meta.axistags)
+            labelBlock = vigra.taggedView(label_req.wait(), axistags=self.LabelVolume.meta.axistags)
+            if nchannels > 1:
+                rawBlock = rawBlock.withAxes(*(spatial + ['c']))
+            else:
+                rawBlock = rawBlock.withAxes(*spatial)
+            labelBlock = labelBlock.withAxes(*spatial)
+
+            block_feats = extract_block_features(rawBlock.astype(np.float32),
+                                                 labelBlock.astype(np.uint32),
+                                                 accumulator.features)
+            with lock:
+                accumulator.add_block(block_feats, block_start)
+
+        # Only keep as many blocks in flight as there are workers
+        n_workers = max(1, Request.global_thread_pool.num_workers)
+        starts = list(block_starts(spatial_shape, block_shape))
+        for batch_start in range(0, len(starts), n_workers):
+            pool = RequestPool()
+            for block_start in starts[batch_start:batch_start + n_workers]:
+                pool.add( Request( partial(process_block, block_start) ) )
+            pool.wait()
+
+        merged = accumulator.result()
+        all_features = {}
+        for plugin_name, feature_dict in feature_names.iteritems():
+            all_features[plugin_name] = dict((k, merged[k]) for k in feature_dict)
+        all_features[default_features_key] = dict((k, merged[k]) for k in default_features)
+        return all_features
+
     def compute_extent(self, i, image, mincoords, maxcoords, axes, margin):
         """Make a slicing to extract object i from the image."""
         #find the bounding box (margin is always 'xyz' order)
@@ -620,6 +738,54 @@ class OpRegionFeatures(Operator):
         key.insert(axes.c, slice(None))
         return image[tuple(key)]
 
+    def _extract_local(self, image, labels, mincoords, maxcoords, axes, margin, feature_names):
+        """Compute the local features of all objects.
+
+        The objects are split into chunks of consecutive labels, which
+        are processed in parallel. All objects of a chunk share one
+        crop of the raw and label images and are handed to the plugins'
+        compute_local_batch() together.
+
+        Returns a list with one entry per chunk, in object order:
+        result[chunk][plugin_name] = list of per-object feature dicts
+
+        """
+        nobj = mincoords.shape[0]
+        chunk_size = self.LOCAL_FEATURES_CHUNK_SIZE
+        chunks = [(start, min(start + chunk_size, nobj))
+                  for start in range(0, nobj, chunk_size)]
+        chunk_results = [None] * len(chunks)
+
+        def compute_chunk(chunk_index, start, stop):
+            logger.debug("processing objects {} to {}".format(start, stop))
+            #starting from 0, we stripped 0th background object in global computation
+            extents = [self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
+                       for i in range(start, stop)]
+
+            # crop to the union of the bounding boxes in this chunk
+            crop = [slice(min(e[a].start for e in extents),
+                          max(e[a].stop for e in extents)) for a in range(3)]
+            rawcrop = self.compute_rawbbox(image, crop, axes)
+            labelcrop = labels[tuple(crop)]
+            crop_extents = [[slice(e[a].start - crop[a].start, e[a].stop - crop[a].start)
+                             for a in range(3)] for e in extents]
+
+            #it's i+1 here, because the background has label 0
+            label_ids = range(start + 1, stop + 1)
+
+            result = {}
+            for plugin_name, feature_dict in feature_names.iteritems():
+                plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
+                result[plugin_name] = plugin.plugin_object.compute_local_batch(
+                    rawcrop, labelcrop, label_ids, crop_extents, feature_dict, axes)
+            chunk_results[chunk_index] = result
+
+        pool = RequestPool()
+        for chunk_index, (start, stop) in enumerate(chunks):
+            pool.add( Request( partial(compute_chunk, chunk_index, start, stop) ) )
+        pool.wait()
+        return chunk_results
+
     def _extract(self, image, labels):
         if not (image.ndim == labels.ndim == 4):
             raise Exception("both images must be 4D. raw image shape: {}"
@@ -705,19 +871,14 @@ class OpRegionFeatures(Operator):
             
                             
         if np.any(margin) > 0:
-            #starting from 0, we stripped 0th background object in global computation
-            for i in range(0, nobj):
-                logger.debug("processing object {}".format(i))
-                extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
-                rawbbox = self.compute_rawbbox(image, extent, axes)
-                #it's i+1 here, because the background has label 0
-                binary_bbox = np.where(labels[tuple(extent)] == i+1, 1, 0).astype(np.bool)
-                for plugin_name, feature_dict in feature_names.iteritems():
-                    if not has_local_features[plugin_name]:
-                        continue
-                    plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
-                    feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
-                    local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
+            local_feature_names = dict((plugin_name, feature_dict)
+                                       for plugin_name, feature_dict in feature_names.iteritems()
+                                       if has_local_features[plugin_name])
+            chunk_results = self._extract_local(image, labels, mincoords, maxcoords, axes, margin, local_feature_names)
+            for chunk_result in chunk_results:
+                for plugin_name, feats_list in chunk_result.iteritems():
+                    for feats in feats_list:
+                        local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
 
         logger.debug("computing done, removing failures")
         # remove local features that failed
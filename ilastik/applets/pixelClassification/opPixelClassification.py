@@ -20,20 +20,22 @@
 ###############################################################################
 #Python
 import copy
+import collections
+import threading
 from functools import partial
 
 #SciPy
 import numpy
-import vigra
 
 #lazyflow
-from lazyflow.roi import determineBlockShape
+from lazyflow.roi import determineBlockShape, roiToSlice
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators import OpValueCache, OpTrainClassifierBlocked, OpClassifierPredict,\
                                OpSlicedBlockedArrayCache, OpMultiArraySlicer2, \
                                OpPixelOperator, OpMaxChannelIndicatorOperator, OpCompressedUserLabelArray
 
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
+from lazyflow.utility import BigRequestStreamer
 
 #ilastik
 from ilastik.applets.base.applet import DatasetConstraintError
@@ -429,6 +431,14 @@ class OpPredictionPipelineNoCache(Operator):
         self.opUncertaintyEstimator.Input.connect( self.cacheless_predict.PMaps )
         self.HeadlessUncertaintyEstimate.connect( self.opUncertaintyEstimator.Output )
 
+    def exportProducts(self, h5group, product_names, roi=None, progress_callback=None):
+        """
+        Export several of the headless outputs at once, running the classifier only once per block.
+        See export_prediction_products() for details.
+        """
+        export_prediction_products( self.HeadlessPredictionProbabilities, h5group, product_names, roi, 
+                                    progress_callback=progress_callback )
+
     def setupOutputs(self):
         pass
 
@@ -568,6 +578,107 @@ class OpPredictionPipeline(OpPredictionPipelineNoCache):
         self.opUncertaintyCache.inputs["outerBlockShape"].setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
 
 
+def ensemble_margin(pmap, chanAxis, out=None):
+    """
+    Compute 1 - (highest - second highest probability) along the channel axis.
+
+    Uses a single pass over the channels that keeps the two largest
+    values seen so far, so the probability map is neither sorted nor copied.
+
+    pmap: Probability map with at least 2 channels
+    chanAxis: Index of the channel axis in pmap
+    out: Optional result array, with a singleton channel axis
+    """
+    def channel(c):
+        slicing = [slice(None)] * pmap.ndim
+        slicing[chanAxis] = slice(c, c+1)
+        return pmap[tuple(slicing)]
+
+    first = numpy.maximum(channel(0), channel(1))
+    second = numpy.minimum(channel(0), channel(1))
+    tmp = numpy.empty_like(first)
+    for c in range(2, pmap.shape[chanAxis]):
+        # second = max(second, min(first, x)), first = max(first, x)
+        x = channel(c)
+        numpy.minimum(first, x, out=tmp)
+        numpy.maximum(second, tmp, out=second)
+        numpy.maximum(first, x, out=first)
+
+    # Subtract from 1 to make this an "uncertainty" measure, not a "certainty" measure
+    # e.g. predictions of .99 and .01 -> low uncertainty (0.98)
+    # e.g. predictions of .51 and .49 -> high uncertainty (0.02)
+    numpy.subtract(first, second, out=first)
+    if out is None:
+        out = first
+    numpy.subtract(1, first, out=out)
+    return out
+
+def _uncertainty(pmap):
+    if pmap.shape[-1] <= 1:
+        # If there's only 1 channel, there's zero uncertainty
+        return numpy.zeros( pmap.shape[:-1] + (1,), dtype=numpy.float32 )
+    return ensemble_margin(pmap, pmap.ndim-1)
+
+# The products that export_prediction_products() can derive from a block of predictions.
+# Each entry is (dtype, number of channels or None to keep the prediction channels, function)
+PREDICTION_PRODUCTS = collections.OrderedDict([
+    ('Probabilities',         (numpy.float32, None, lambda pmap: pmap)),
+    ('Probabilities (uint8)', (numpy.uint8, None, lambda pmap: (255*pmap).astype(numpy.uint8))),
+    ('Simple Segmentation',   (numpy.uint8, 1, lambda pmap: (numpy.argmax(pmap, axis=-1) + 1).astype(numpy.uint8)[...,numpy.newaxis])),
+    ('Uncertainty',           (numpy.float32, 1, _uncertainty)) ])
+
+EXPORT_BLOCK_VOXELS = 2**20
+
+def export_prediction_products(pmap_slot, h5group, product_names, roi=None, blockshape=None, progress_callback=None):
+    """
+    Request the prediction map block by block and write all requested 
+    products of each block (see PREDICTION_PRODUCTS) before moving on, 
+    so every block is predicted exactly once no matter how many products are exported.
+    
+    pmap_slot: The prediction map slot (channels last)
+    h5group: The hdf5 group (or file) in which one dataset per product is created, named after the product
+    product_names: Keys of PREDICTION_PRODUCTS
+    roi: Optional (start, stop) of the region to export.  The channel range is ignored.
+    blockshape: Optional spatial block shape (without channels)
+    progress_callback: Optional function that is called with the progress (0-100)
+    """
+    assert pmap_slot.meta.getAxisKeys()[-1] == 'c', "Channel axis must be last"
+    unknown = set(product_names) - set(PREDICTION_PRODUCTS.keys())
+    assert not unknown, "Unknown prediction products: {}".format( list(unknown) )
+
+    shape = pmap_slot.meta.shape
+    if roi is None:
+        roi = ( (0,)*len(shape), shape )
+    start = numpy.array( tuple(roi[0][:-1]) + (0,) )
+    stop = numpy.array( tuple(roi[1][:-1]) + (shape[-1],) )
+    if blockshape is None:
+        blockshape = determineBlockShape( tuple(stop - start)[:-1], EXPORT_BLOCK_VOXELS )
+    blockshape = tuple(blockshape) + (shape[-1],)
+
+    datasets = collections.OrderedDict()
+    for name in product_names:
+        dtype, nchannels, _ = PREDICTION_PRODUCTS[name]
+        dataset_shape = tuple(stop - start)[:-1] + (nchannels or shape[-1],)
+        datasets[name] = h5group.create_dataset( name, shape=dataset_shape, dtype=dtype )
+        datasets[name].attrs['axistags'] = pmap_slot.meta.axistags.toJSON()
+
+    # h5py is not thread-safe, but the products are computed in parallel
+    write_lock = threading.Lock()
+    def writeBlock(block_roi, pmap):
+        pmap = numpy.asarray(pmap)
+        products = [ (name, PREDICTION_PRODUCTS[name][2](pmap)) for name in datasets ]
+        block_start, block_stop = numpy.asarray(block_roi[0]) - start, numpy.asarray(block_roi[1]) - start
+        slicing = roiToSlice( block_start[:-1], block_stop[:-1] ) + (slice(None),)
+        with write_lock:
+            for name, data in products:
+                datasets[name][slicing] = data
+
+    streamer = BigRequestStreamer( pmap_slot, (start, stop), blockshape )
+    streamer.resultSignal.subscribe( writeBlock )
+    if progress_callback is not None:
+        streamer.progressSignal.subscribe( progress_callback )
+    streamer.execute()
+
 class OpEnsembleMargin(Operator):
     """
     Produces a pixelwise measure of the uncertainty of the pixelwise predictions.
@@ -597,19 +708,7 @@ class OpEnsembleMargin(Operator):
         roi.stop[chanAxis] = taggedShape['c']
         pmap = self.Input.get(roi).wait()
 
-        # Sort along channel axis so the every pixel's channels are sorted lowest to highest.
-        pmap.sort(axis=self.Input.meta.axistags.index('c'))
-        pmap = pmap.view(vigra.VigraArray)
-        pmap.axistags = self.Input.meta.axistags
-
-        # Subtract the highest channel from the second-highest channel.
-        res = pmap.bindAxis('c', -1) - pmap.bindAxis('c', -2)
-        res = res.withAxes( *taggedShape.keys() ).view(numpy.ndarray)
-        
-        # Subtract from 1 to make this an "uncertainty" measure, not a "certainty" measure
-        # e.g. predictions of .99 and .01 -> low uncertainty (0.98)
-        # e.g. predictions of .51 and .49 -> high uncertainty (0.02)
-        result[...] = (1-res)
+        ensemble_margin(pmap, chanAxis, out=result)
         return result 
 
     def propagateDirty(self, inputSlot, subindex, roi):
@@ -38,12 +38,26 @@ from lazyflow.slot import InputSlot, OutputSlot
 from lazyflow.rtype import SubRegion
 from lazyflow.stype import Opaque
 from lazyflow.request import Request, RequestPool
+from lazyflow.roi import determineBlockShape, getIntersectingBlocks,\
+    getBlockBounds, roiFromShape, roiToSlice
 
 # required lazyflow operators
 from lazyflow.operators.opLabelVolume import OpLabelVolume
 from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.operators.opReorderAxes import OpReorderAxes
 
+from ilastik.utility.ramBudget import ramBudgetBytes
+
+# approximate memory used by the OpenGM model and the inference, per voxel
+GC_BYTES_PER_VOXEL = 300
+# fraction of the available RAM that graph-cut computations may use
+GC_RAM_FRACTION = 0.25
+# context (in voxels) that each tile of a tiled graph cut sees beyond its
+# borders
+GC_TILE_HALO = 10
+# number of variables whose factors are added to the model at once
+_FACTOR_CHUNK_SIZE = 2**20
+
 
 # This operator implements an interface to compute Graph Cut segmentations
 # via the OpenGM library (http://hci.iwr.uni-heidelberg.de/opengm2/).
@@ -54,6 +68,8 @@ from lazyflow.operators.opReorderAxes import OpReorderAxes
 #  - this operator assumes txyzc axis order
 #  - only ROIs with 1 channel, 1 time slice are valid for slot Output
 #  - requests to slot CachedOutput are guaranteed to be consistent
+#  - volumes that are too large for one OpenGM model are segmented in
+#    overlapping tiles (see segmentGCTiled)
 class OpGraphCut(Operator):
     name = "OpGraphCut"
 
@@ -63,6 +79,10 @@ class OpGraphCut(Operator):
     # graph cut parameter, usually called lambda
     Beta = InputSlot(value=.2)
 
+    # xyz shape of the tiles for a tiled graph cut, determined from the RAM
+    # budget if not given
+    TileShape = InputSlot(optional=True)
+
     # labeled segmentation image
     #     i=0: background
     #     i>0: connected foreground object i
@@ -121,7 +141,7 @@ class OpGraphCut(Operator):
         resView = resView.withAxes(*'xyz')
 
         logger.info("Executing graph cut ... (this might take a while)")
-        tmp = segmentGC(pred, self.Beta.value)
+        tmp = segmentGCTiled(pred, self.Beta.value, self._tileShape(pred.shape))
         logger.info("Graph-cut done")
 
         # label the segmentation so that this operator is consistent with
@@ -129,10 +149,15 @@ class OpGraphCut(Operator):
         vigra.analysis.labelVolumeWithBackground(tmp.astype(np.uint32),
                                                  out=resView)
 
+    def _tileShape(self, shape):
+        if self.TileShape.ready():
+            return tuple(self.TileShape.value)
+        return graphCutTileShape(shape)
+
     def propagateDirty(self, slot, subindex, roi):
         # all input slots affect the (global) graph cut computation
 
-        if slot == self.Beta:
+        if slot == self.Beta or slot == self.TileShape:
             # beta value affects the whole volume
             self.Output.setDirty(slice(None))
         elif slot == self.Prediction:
@@ -159,11 +184,13 @@ def segmentGC(pred, beta):
        for 3D data to define the pairwise terms.
        Parameters:
        -- pred - the unary terms, used directly (no Log applied, do it outside if needed)
-          This input is assumed to be 3D! 
+          This input is assumed to be 3D! uint8 input is scaled to [0, 1).
        -- beta - the weight of the pairwise potentials, usually called lambda
        Return:
        -- binary volume, as produced by OpenGM
 
+       The unary tables (float32) and the factor indices are built in chunks
+       of variables, so the temporary arrays stay small compared to the model.
     '''
     nx, ny, nz = pred.shape
 
@@ -174,38 +201,38 @@ def segmentGC(pred, beta):
     gm = opengm.graphicalModel(numberOfStates, operator='adder')
 
     #Adding unary function and factors
-    functions = np.zeros((numVar, 2))
-    predflat = pred.reshape((numVar, 1))
-    if (predflat.dtype == np.uint8):
-        predflat = predflat.astype(np.float32)
-        predflat = predflat/256.
-
-    functions[:, 0] = predflat[:, 0]
-    functions[:, 1] = 1-predflat[:, 0]
-
-    fids = gm.addFunctions(functions)
-    gm.addFactors(fids, np.arange(0, numVar))
+    predflat = np.asarray(pred).reshape((numVar,))
+    for start in xrange(0, numVar, _FACTOR_CHUNK_SIZE):
+        chunk = predflat[start:start + _FACTOR_CHUNK_SIZE]
+        if chunk.dtype == np.uint8:
+            chunk = chunk.astype(np.float32)/256.
+        functions = np.empty((chunk.size, 2), dtype=np.float32)
+        functions[:, 0] = chunk
+        functions[:, 1] = 1 - chunk
+        fids = gm.addFunctions(functions)
+        gm.addFactors(fids, np.arange(start, start + chunk.size,
+                                      dtype=opengm.index_type))
 
     #add one binary function (potts fuction)
     potts = opengm.PottsFunction([2, 2], 0.0, beta)
     fid = gm.addFunction(potts)
 
-    #add binary factors
+    #add binary factors, for a slab of x-planes at a time
     nyz = ny*nz
-    indices = np.arange(numVar,
-                        dtype=np.uint32).reshape((nx, ny, nz))
-    arg1 = np.concatenate([indices[:nx - 1, :, :], indices[1:, :, :]]
-                            ).reshape((2, numVar - nyz)).transpose()
-
-    arg2 = np.concatenate([indices[:, :ny - 1, :], indices[:, 1:, :]]
-                            ).reshape((2, numVar - nx*nz)).transpose()
-
-    arg3 = np.concatenate([indices[:, :, :nz - 1], indices[:, :, 1:]]
-                            ).reshape((2, numVar - nx*ny)).transpose()
-
-    gm.addFactors(fid, arg1)
-    gm.addFactors(fid, arg2)
-    gm.addFactors(fid, arg3)
+    slab = max(1, _FACTOR_CHUNK_SIZE//nyz)
+    for x in xrange(0, nx, slab):
+        xstop = min(x + slab, nx)
+        indices = np.arange(x*nyz, xstop*nyz,
+                            dtype=opengm.index_type).reshape((xstop - x, ny, nz))
+        # the last x-plane has no neighbor along x
+        lastx = xstop if xstop < nx else xstop - 1
+        neighbors = ((indices[:lastx - x, :, :], nyz),
+                     (indices[:, :ny - 1, :], nz),
+                     (indices[:, :, :nz - 1], 1))
+        for first, offset in neighbors:
+            first = first.ravel()
+            if first.size > 0:
+                gm.addFactors(fid, np.column_stack((first, first + offset)))
 
     grcut = opengm.inference.GraphCut(gm)
     grcut.infer()
@@ -213,3 +240,51 @@ def segmentGC(pred, beta):
 
     res = argmin.reshape((nx, ny, nz))
     return res
+
+
+def graphCutTileShape(shape, halo=GC_TILE_HALO):
+    '''
+       Return the tile shape for segmentGCTiled() of a volume with the
+       given (x,y,z) shape: the whole volume if its model fits into the
+       graph-cut RAM budget, otherwise tiles that fit into the budget
+       together with their halo.
+    '''
+    maxVoxels = max(1, ramBudgetBytes(GC_RAM_FRACTION)//GC_BYTES_PER_VOXEL)
+    if np.prod(shape) <= maxVoxels:
+        return tuple(shape)
+    tileShape = np.asarray(determineBlockShape(shape, maxVoxels))
+    # leave room for the halo
+    tileShape = np.where(tileShape < shape,
+                         np.maximum(tileShape - 2*halo, halo), tileShape)
+    return tuple(map(int, tileShape))
+
+
+def segmentGCTiled(pred, beta, tileShape, halo=GC_TILE_HALO):
+    '''
+       Graph Cut segmentation (see segmentGC) in overlapping tiles.
+       Each tile is segmented together with 'halo' voxels of context on
+       each side, but only the result inside the tile is kept. This way,
+       the segmentation at a seam is decided by the tile that owns the
+       seam voxels, with context from both sides of the seam.
+       If the tile shape covers the whole volume, this is just segmentGC.
+       Parameters:
+       -- pred, beta - see segmentGC
+       -- tileShape - xyz shape of the tiles
+       -- halo - context around each tile, in voxels
+       Return:
+       -- binary volume
+    '''
+    shape = pred.shape
+    if all(t >= s for t, s in zip(tileShape, shape)):
+        return segmentGC(pred, beta)
+
+    res = np.zeros(shape, dtype=np.uint8)
+    tiles = getIntersectingBlocks(tileShape, roiFromShape(shape))
+    logger.debug("Graph cut in {} tiles of shape {}".format(len(tiles), tileShape))
+    for tileStart in tiles:
+        start, stop = getBlockBounds(shape, tileShape, tileStart)
+        extStart = np.maximum(np.subtract(start, halo), 0)
+        extStop = np.minimum(np.add(stop, halo), shape)
+        seg = segmentGC(pred[roiToSlice(extStart, extStop)], beta)
+        res[roiToSlice(start, stop)] = seg[roiToSlice(start - extStart, stop - extStart)]
+    return res
@@ -43,7 +43,10 @@ from lazyflow.operators.opLabelVolume import OpLabelVolume
 from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.operators.opReorderAxes import OpReorderAxes
 
-from _OpGraphCut import segmentGC, OpGraphCut
+from ilastik.utility.ramBudget import ramBudgetBytes
+
+from _OpGraphCut import segmentGCTiled, OpGraphCut,\
+    GC_BYTES_PER_VOXEL, GC_RAM_FRACTION, GC_TILE_HALO
 
 
 ## segment predictions with pre-thresholding
@@ -63,6 +66,10 @@ from _OpGraphCut import segmentGC, OpGraphCut
 # The slot CachedOutput guarantees consistent results, the slot Output computes
 # the roi on demand.
 #
+# Objects are processed in parallel, in batches whose graph-cut models fit into
+# the graph-cut RAM budget together. Boxes that are too large for one model are
+# segmented in tiles (see _OpGraphCut.segmentGCTiled).
+#
 # The operator inherits from OpGraphCut because they share some details:
 #   * output meta
 #   * dirtiness propagation
@@ -158,7 +165,6 @@ class OpObjectsSegment(OpGraphCut):
 
         margin = self.Margin.value
         beta = self.Beta.value
-        MAXBOXSIZE = 10000000  # FIXME justification??
 
         ## request the bounding box coordinates ##
         # the trailing index brackets give us the dictionary (instead of an
@@ -185,27 +191,20 @@ class OpObjectsSegment(OpGraphCut):
         resultXYZ = vigra.taggedView(np.zeros(cc.shape, dtype=np.uint8),
                                      axistags='xyz')
 
+        def objectBox(i):
+            # maxs are inclusive, so we need to add 1
+            start = np.maximum(mins[i].astype(np.int64) - margin, 0)
+            stop = np.minimum(maxs[i].astype(np.int64) + margin + 1, cc.shape)
+            return tuple(map(int, start)), tuple(map(int, stop))
+
         def processSingleObject(i):
             logger.debug("processing object {}".format(i))
-            # maxs are inclusive, so we need to add 1
-            xmin = max(mins[i][0]-margin[0], 0)
-            ymin = max(mins[i][1]-margin[1], 0)
-            zmin = max(mins[i][2]-margin[2], 0)
-            xmax = min(maxs[i][0]+margin[0]+1, cc.shape[0])
-            ymax = min(maxs[i][1]+margin[1]+1, cc.shape[1])
-            zmax = min(maxs[i][2]+margin[2]+1, cc.shape[2])
+            (xmin, ymin, zmin), (xmax, ymax, zmax) = objectBox(i)
             ccbox = cc[xmin:xmax, ymin:ymax, zmin:zmax]
             resbox = resultXYZ[xmin:xmax, ymin:ymax, zmin:zmax]
 
-            nVoxels = ccbox.size
-            if nVoxels > MAXBOXSIZE:
-                #problem too large to run graph cut, assign to seed
-                logger.warn("Object {} too large for graph cut.".format(i))
-                resbox[ccbox == i] = 1
-                return
-
             probbox = pred[xmin:xmax, ymin:ymax, zmin:zmax]
-            gcsegm = segmentGC(probbox, beta)
+            gcsegm = segmentGCTiled(probbox, beta, self._tileShape(probbox.shape))
             gcsegm = vigra.taggedView(gcsegm, axistags='xyz')
             ccsegm = vigra.analysis.labelVolumeWithBackground(
                 gcsegm.astype(np.uint8))
@@ -231,16 +230,35 @@ class OpObjectsSegment(OpGraphCut):
                 label = passed[1]  # 0 is background
                 resbox[ccsegm == label] = 1
 
-        pool = RequestPool()
-        #FIXME make sure that the parallel computations fit into memory
-        for i in range(1, nobj):
-            req = Request(functools.partial(processSingleObject, i))
-            pool.add(req)
+        def workingMemory(i):
+            start, stop = objectBox(i)
+            shape = np.subtract(stop, start)
+            tileShape = np.minimum(self._tileShape(shape), shape)
+            tileVoxels = np.prod(np.minimum(tileShape + 2*GC_TILE_HALO, shape))
+            return tileVoxels*GC_BYTES_PER_VOXEL
+
+        def processBatch(batch):
+            pool = RequestPool()
+            for i in batch:
+                pool.add(Request(functools.partial(processSingleObject, i)))
+            pool.wait()
+            pool.clean()
 
         logger.info("Processing {} objects ...".format(nobj-1))
 
-        pool.wait()
-        pool.clean()
+        # run as many objects in parallel as fit into the RAM budget
+        budget = ramBudgetBytes(GC_RAM_FRACTION)
+        batch = []
+        batchBytes = 0
+        for i in range(1, nobj):
+            nbytes = workingMemory(i)
+            if batch and batchBytes + nbytes > budget:
+                processBatch(batch)
+                batch = []
+                batchBytes = 0
+            batch.append(i)
+            batchBytes += nbytes
+        processBatch(batch)
 
         logger.info("object loop done")
 
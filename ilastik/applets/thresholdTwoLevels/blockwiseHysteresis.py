@@ -0,0 +1,160 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+##############################################################################
+"""
+Hysteresis thresholding block by block.
+
+Both thresholds are applied to each block and labeled independently.
+Connected components that continue across block faces are merged with a
+union-find over the pairs of labels that touch at the faces, and the
+object sizes for the size filters are summed from the label histograms
+of the blocks. Only these summaries are kept for the whole volume; the
+final labels of a block are computed from the block alone, by labeling
+it again and applying a lookup table.
+"""
+import numpy
+
+from lazyflow.roi import determineBlockShape
+
+from ilastik.utility.blockStitching import labelComponents, uniquePairs, blockFaces, BlockStitcher
+
+# Largest block (in voxels) that is labeled at once
+MAX_BLOCK_VOXELS = 128**3
+
+def hysteresisBlockShape(shape, max_voxels=MAX_BLOCK_VOXELS):
+    """Return the (x,y,z) block shape for a volume of (x,y,z) shape."""
+    return tuple(map(int, determineBlockShape(shape, max_voxels)))
+
+def labelBlock(data, threshold):
+    """Label the connected components (6-neighborhood) of data > threshold
+    in a (x,y,z) block."""
+    return labelComponents(data > threshold)
+
+def _labelSizes(labels):
+    # Must explicitly convert to int on 32-bit systems
+    return numpy.bincount(numpy.asarray(labels.ravel(), dtype=numpy.intp))
+
+class BlockSummary(object):
+    """
+    What HysteresisComponents needs to know about one block, given its
+    low and high threshold labels: the label sizes, which low and high
+    labels overlap, and the labels on the first and last plane along
+    each axis.
+    """
+    def __init__(self, lowLabels, highLabels):
+        self.sizes = (_labelSizes(lowLabels), _labelSizes(highLabels))
+        self.overlaps = uniquePairs(highLabels, lowLabels)
+        lowFaces, highFaces = blockFaces(lowLabels), blockFaces(highLabels)
+        self.firstFaces = zip(lowFaces[0], highFaces[0])
+        self.lastFaces = zip(lowFaces[1], highFaces[1])
+
+class HysteresisComponents(object):
+    """
+    The connected components of the low and high thresholded volume,
+    assembled from the BlockSummary of every block.
+
+    Block-local labels are made global by adding the block's offset
+    (see relabel()). lowComponents and highComponents map global labels
+    to consecutive component numbers, lowSizes and highSizes are the
+    component sizes and overlaps holds the pairs (high component, low
+    component) that overlap.
+
+    The size limits are only applied in the lookup tables, so changing
+    them doesn't require a pass over the volume.
+    """
+    def __init__(self, blockShape, blocks):
+        """
+        blockShape: the (x,y,z) block shape
+        blocks: dict of block start -> BlockSummary, for all blocks
+        """
+        starts = sorted(blocks.keys())
+        # One stitcher for the low (0) and one for the high (1) labels
+        stitchers = []
+        for i in range(2):
+            stitcher = BlockStitcher(blockShape, dict((start, len(block.sizes[i]) - 1)
+                                                      for start, block in blocks.iteritems()))
+            stitcher.mergeFaces(lambda start, axis: blocks[start].firstFaces[axis][i],
+                                lambda start, axis: blocks[start].lastFaces[axis][i])
+            stitchers.append(stitcher)
+        self.offsets = dict((start, tuple(stitcher.offsets[start] for stitcher in stitchers))
+                            for start in starts)
+
+        self.lowComponents, self.highComponents = [stitcher.consecutive_lut() for stitcher in stitchers]
+        self.lowSizes, self.highSizes = [
+            self._componentSizes(components, [blocks[start].sizes[i] for start in starts])
+            for i, components in enumerate((self.lowComponents, self.highComponents))]
+
+        high = [blocks[start].overlaps[0] + self.offsets[start][1] for start in starts]
+        low = [blocks[start].overlaps[1] + self.offsets[start][0] for start in starts]
+        self.overlaps = uniquePairs(self.highComponents[numpy.concatenate([[0]] + high).astype(numpy.intp)],
+                                     self.lowComponents[numpy.concatenate([[0]] + low).astype(numpy.intp)])
+        self._luts = {}
+
+    @staticmethod
+    def _componentSizes(components, blockSizes):
+        counts = numpy.concatenate([[0]] + [sizes[1:] for sizes in blockSizes])
+        return numpy.bincount(components, weights=counts).astype(numpy.int64)
+
+    def _highPassed(self, minSize, maxSize):
+        passed = (self.highSizes >= minSize) & (self.highSizes <= maxSize)
+        passed[0] = False
+        return passed
+
+    def outputLut(self, minSize, maxSize):
+        """
+        Lookup table from global low labels to the final objects: low
+        threshold components that overlap a high threshold component
+        within the size limits, and that are within the size limits
+        themselves. Objects are numbered consecutively, all other labels
+        map to 0.
+        """
+        key = (minSize, maxSize)
+        cached = self._luts.get('output')
+        if cached is None or cached[0] != key:
+            selected = numpy.zeros(len(self.lowSizes), dtype=bool)
+            high, low = self.overlaps
+            selected[low[self._highPassed(minSize, maxSize)[high]]] = True
+            selected &= (self.lowSizes >= minSize) & (self.lowSizes <= maxSize)
+            selected[0] = False
+            final = numpy.zeros(len(selected), dtype=numpy.uint32)
+            final[selected] = numpy.arange(1, selected.sum() + 1)
+            # only the latest table of each kind is kept
+            cached = self._luts['output'] = (key, final[self.lowComponents])
+        return cached[1]
+
+    def filteredHighLut(self, minSize, maxSize):
+        """
+        Lookup table from global high labels to the high threshold
+        components within the size limits, all other labels map to 0.
+        """
+        key = (minSize, maxSize)
+        cached = self._luts.get('high')
+        if cached is None or cached[0] != key:
+            passed = self._highPassed(minSize, maxSize)
+            components = numpy.where(passed, numpy.arange(len(passed)), 0).astype(numpy.uint32)
+            cached = self._luts['high'] = (key, components[self.highComponents])
+        return cached[1]
+
+    def relabel(self, blockStart, labels, lut, high=False):
+        """Apply a lookup table to the (low or high) labels of a block."""
+        offset = self.offsets[tuple(blockStart)][1 if high else 0]
+        blockLut = lut[offset:offset + labels.max() + 1].copy()
+        blockLut[0] = 0
+        return blockLut[labels]
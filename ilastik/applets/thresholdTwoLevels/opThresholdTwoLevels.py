@@ -40,12 +40,13 @@ from lazyflow.operators import OpPixelOperator, OpLabelVolume,\
     OpMultiArrayStacker, OpMultiArraySlicer,\
     OpReorderAxes, OpFilterLabels
 from lazyflow.rtype import SubRegion
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
 from lazyflow.request import Request, RequestPool
 
 # local
 from thresholdingTools import OpAnisotropicGaussianSmoothing5d
 
-from thresholdingTools import OpSelectLabels
+from thresholdingTools import OpSelectLabels, OpBlockwiseHysteresis
 
 from opGraphcutSegment import haveGraphCut
 
@@ -197,17 +198,21 @@ class OpThresholdTwoLevels(Operator):
         self._disconnectAll()
 
         curIndex = self.CurOperator.value
+        cacheBlockShape = {}
 
         if curIndex == 0:
             outputSlot = self._connectForSingleThreshold(self.opThreshold1)
         elif curIndex == 1:
             outputSlot = self._connectForTwoLevelThreshold()
+            # the two level output is computed blockwise, cache the same blocks
+            cacheBlockShape = dict(zip('txyzc', outputSlot.meta.ideal_blockshape))
         elif curIndex == 2:
             outputSlot = self._connectForGraphCut()
         else:
             raise ValueError(
                 "Unknown index {} for current tab.".format(curIndex))
 
+        self._cache.BlockShape.setValue(cacheBlockShape)
         self._opReorder2.Input.connect(outputSlot)
         # force the cache to emit a dirty signal
         self._cache.Input.setDirty(slice(None))
@@ -353,10 +358,9 @@ class _OpThresholdOneLevel(Operator):
 ## internal operator for two level thresholding
 #
 # The input must have 5 dimensions.
-# Input is processed on a what-you-request-is-what-you-get basis: You have to
-# make sure that the ROI for slot 'Output' matches the input shape at least in
-# the spatial dimensions, or you will get inconsistent results. All requests to
-# slot 'CachedOutput' are guaranteed to be consistent though.
+# Thresholding, labeling and size filtering are done block by block (see
+# OpBlockwiseHysteresis), so requests to 'Output' are consistent for any ROI.
+# The caches use the same blocks.
 class _OpThresholdTwoLevels(Operator):
     name = "_OpThresholdTwoLevels"
 
@@ -381,15 +385,15 @@ class _OpThresholdTwoLevels(Operator):
 
     # Schematic:
     #
-    #           HighThreshold                         MinSize,MaxSize                       --(cache)--> opColorize -> FilteredSmallLabels
-    #                   \                                       \                     /
-    #           opHighThresholder --> opHighLabeler --> opHighLabelSizeFilter                           Output
-    #          /                   \          /                 \                                            \                         /
-    # InputImage        --(cache)--> SmallRegions                    opSelectLabels -->opFinalLabelSizeFilter--> opCache --> CachedOutput
-    #          \                                                              /                                           /       \
-    #           opLowThresholder ----> opLowLabeler --------------------------                                       InputHdf5     --> OutputHdf5
-    #                   /                \                                                                                        -> CleanBlocks
-    #           LowThreshold            --(cache)--> BigRegions
+    #                 HighThreshold, LowThreshold, MinSize, MaxSize                 Output
+    #                                  \                                          /
+    # InputImage --------------------> opHysteresis ---------------------------> opCache --> CachedOutput
+    #          \                                     \                           /       \
+    #           \                                     --(cache)--> opColorize    InputHdf5  --> OutputHdf5
+    #            \                                                  \                       -> CleanBlocks
+    #             \                                                  -> FilteredSmallLabels
+    #              opLowThresholder --(cache)--> BigRegions
+    #              opHighThresholder --(cache)--> SmallRegions
 
     def __init__(self, *args, **kwargs):
         super(_OpThresholdTwoLevels, self).__init__(*args, **kwargs)
@@ -400,50 +404,26 @@ class _OpThresholdTwoLevels(Operator):
         self._opHighThresholder = OpPixelOperator(parent=self)
         self._opHighThresholder.Input.connect(self.InputImage)
 
-        self._opLowLabeler = OpLabelVolume(parent=self)
-        self._opLowLabeler.Method.setValue(_labeling_impl)
-        self._opLowLabeler.Input.connect(self._opLowThresholder.Output)
-
-        self._opHighLabeler = OpLabelVolume(parent=self)
-        self._opHighLabeler.Method.setValue(_labeling_impl)
-        self._opHighLabeler.Input.connect(self._opHighThresholder.Output)
-
-        self._opHighLabelSizeFilter = OpFilterLabels(parent=self)
-        self._opHighLabelSizeFilter.Input.connect(self._opHighLabeler.Output)
-        self._opHighLabelSizeFilter.MinLabelSize.connect(self.MinSize)
-        self._opHighLabelSizeFilter.MaxLabelSize.connect(self.MaxSize)
-        self._opHighLabelSizeFilter.BinaryOut.setValue(False)  # we do the binarization in opSelectLabels
-                                                               # this way, we get to display pretty colors
-
-        self._opSelectLabels = OpSelectLabels( parent=self )        
-        self._opSelectLabels.BigLabels.connect( self._opLowLabeler.Output )
-        self._opSelectLabels.SmallLabels.connect( self._opHighLabelSizeFilter.Output )
-
-        # remove the remaining very large objects -
-        # they might still be present in case a big object
-        # was split into many small ones for the higher threshold
-        # and they got reconnected again at lower threshold
-        self._opFinalLabelSizeFilter = OpFilterLabels( parent=self )
-        self._opFinalLabelSizeFilter.Input.connect(self._opSelectLabels.Output )
-        self._opFinalLabelSizeFilter.MinLabelSize.connect( self.MinSize )
-        self._opFinalLabelSizeFilter.MaxLabelSize.connect( self.MaxSize )
-        self._opFinalLabelSizeFilter.BinaryOut.setValue(False)
+        self._opHysteresis = OpBlockwiseHysteresis(parent=self)
+        self._opHysteresis.InputImage.connect(self.InputImage)
+        self._opHysteresis.MinSize.connect(self.MinSize)
+        self._opHysteresis.MaxSize.connect(self.MaxSize)
+        self._opHysteresis.LowThreshold.connect(self.LowThreshold)
+        self._opHysteresis.HighThreshold.connect(self.HighThreshold)
 
         self._opCache = OpCompressedCache( parent=self )
         self._opCache.name = "_OpThresholdTwoLevels._opCache"
         self._opCache.InputHdf5.connect( self.InputHdf5 )
-        self._opCache.Input.connect( self._opFinalLabelSizeFilter.Output )
+        self._opCache.Input.connect( self._opHysteresis.Output )
 
         # Connect our own outputs
-        self.Output.connect( self._opFinalLabelSizeFilter.Output )
+        self.Output.connect( self._opHysteresis.Output )
         self.CachedOutput.connect( self._opCache.Output )
 
         # Serialization outputs
         self.CleanBlocks.connect( self._opCache.CleanBlocks )
         self.OutputHdf5.connect( self._opCache.OutputHdf5 )
 
-        #self.InputChannel.connect( self._opChannelSelector.Output )
-
         # More debug outputs.  These all go through their own caches
         self._opBigRegionCache = OpCompressedCache( parent=self )
         self._opBigRegionCache.name = "_OpThresholdTwoLevels._opBigRegionCache"
@@ -457,7 +437,7 @@ class _OpThresholdTwoLevels(Operator):
 
         self._opFilteredSmallLabelsCache = OpCompressedCache( parent=self )
         self._opFilteredSmallLabelsCache.name = "_OpThresholdTwoLevels._opFilteredSmallLabelsCache"
-        self._opFilteredSmallLabelsCache.Input.connect( self._opHighLabelSizeFilter.Output )
+        self._opFilteredSmallLabelsCache.Input.connect( self._opHysteresis.FilteredSmallLabels )
         self._opColorizeSmallLabels = OpColorizeLabels( parent=self )
         self._opColorizeSmallLabels.Input.connect( self._opFilteredSmallLabelsCache.Output )
         self.FilteredSmallLabels.connect( self._opColorizeSmallLabels.Output )
@@ -484,19 +464,12 @@ class _OpThresholdTwoLevels(Operator):
         # Output is already connected internally -- don't reassign new metadata
         # self.Output.meta.assignFrom(self.InputImage.meta)
 
-        # Blockshape is the entire spatial volume (hysteresis thresholding is
-        # a global operation)
-        tagged_shape = self.Output.meta.getTaggedShape()
-        tagged_shape['c'] = 1
-        tagged_shape['t'] = 1
-        self._opCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
-        self._opBigRegionCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
-        self._opSmallRegionCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
-        self._opFilteredSmallLabelsCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
+        # All caches use the blocks of the hysteresis thresholding
+        blockshape = self._opHysteresis.Output.meta.ideal_blockshape
+        self._opCache.BlockShape.setValue(blockshape)
+        self._opBigRegionCache.BlockShape.setValue(blockshape)
+        self._opSmallRegionCache.BlockShape.setValue(blockshape)
+        self._opFilteredSmallLabelsCache.BlockShape.setValue(blockshape)
 
     def execute(self, slot, subindex, roi, result):
         assert False, "Shouldn't get here..."
@@ -518,6 +491,10 @@ class _OpCacheWrapper(Operator):
     name = "OpCacheWrapper"
     Input = InputSlot()
 
+    # spatial cache block shape, e.g. {'x': 256, 'y': 256, 'z': 1}, or an
+    # empty dict for the default
+    BlockShape = InputSlot(value={})
+
     Output = OutputSlot()
 
     InputHdf5 = InputSlot(optional=True)
@@ -562,7 +539,9 @@ class _OpCacheWrapper(Operator):
         tagged_shape['t'] = 1
         tagged_shape['c'] = 1
         cacheshape = map(lambda k: tagged_shape[k], 'xyzct')
-        if _labeling_impl == "lazy":
+        if self.BlockShape.value:
+            blockshape = map(lambda k: min(tagged_shape[k], self.BlockShape.value.get(k, tagged_shape[k])), 'xyzct')
+        elif _labeling_impl == "lazy":
             #HACK hardcoded block shape
             blockshape = numpy.minimum(cacheshape, 256)
         else:
@@ -583,7 +562,19 @@ class _OpCacheWrapper(Operator):
             "setInSlot not implemented for slot {}".format(slot.name)
         assert self._cache is not None,\
             "setInSlot called before input was configured"
-        self._cache.setInSlot(self._cache.InputHdf5, subindex, key, value)
+        # Projects saved before the two level output was computed blockwise
+        # contain one block for the whole volume, split it into our blocks.
+        start = numpy.asarray(key.start)
+        stop = numpy.asarray(key.stop)
+        blockshape = self._cache.BlockShape.value
+        shape = self._cache.Output.meta.shape
+        for blockStart in getIntersectingBlocks(blockshape, (start, stop)):
+            blockStart, blockStop = getBlockBounds(shape, blockshape, blockStart)
+            if (blockStart < start).any() or (blockStop > stop).any():
+                continue
+            blockRoi = SubRegion(self._cache.InputHdf5, blockStart, blockStop)
+            self._cache.setInSlot(self._cache.InputHdf5, subindex, blockRoi,
+                                  value[roiToSlice(blockStart - start, blockStop - start)])
 
     def _disconnectInternals(self):
         self.CleanBlocks.disconnect()
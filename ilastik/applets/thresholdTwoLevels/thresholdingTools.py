@@ -22,6 +22,7 @@
 # Built-in
 import gc
 import logging
+from functools import partial
 
 # Third-party
 import numpy
@@ -30,11 +31,17 @@ import psutil
 
 # Lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.roi import enlargeRoiForHalo, TinyVector
+from lazyflow.roi import enlargeRoiForHalo, TinyVector, roiFromShape, roiToSlice,\
+    getIntersectingBlocks, getBlockBounds
+from lazyflow.request import Request, RequestPool, RequestLock
 
 # ilastik
 from lazyflow.utility.timer import Timer
 
+# local
+from blockwiseHysteresis import hysteresisBlockShape, labelBlock,\
+    BlockSummary, HysteresisComponents
+
 logger = logging.getLogger(__name__)
 
 
@@ -392,3 +399,164 @@ class OpSelectLabels(Operator):
             self.Output.setDirty(slice(None))
         else:
             assert False, "Unknown input slot: {}".format(slot.name)
+
+
+## Hysteresis thresholding, block by block
+# The objects are the components of InputImage > LowThreshold that contain a
+# component of InputImage > HighThreshold, where the sizes of both components
+# must be within [MinSize, MaxSize]. See blockwiseHysteresis.py for how the
+# components are merged across blocks.
+#
+# The input must have 5 dimensions (txyzc). The components of each time slice
+# and channel are found in one pass over all blocks when it is first requested.
+# After that, requests only label the blocks they intersect, and changing
+# MinSize or MaxSize doesn't require another pass.
+class OpBlockwiseHysteresis(Operator):
+    InputImage = InputSlot()
+    MinSize = InputSlot(stype='int', value=0)
+    MaxSize = InputSlot(stype='int', value=1000000)
+    HighThreshold = InputSlot(stype='float', value=0.5)
+    LowThreshold = InputSlot(stype='float', value=0.2)
+
+    # (x,y,z) block shape, determined from the volume shape if not given
+    BlockShape = InputSlot(optional=True)
+
+    Output = OutputSlot()
+
+    # the high threshold components within the size limits
+    FilteredSmallLabels = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpBlockwiseHysteresis, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        # (t, c) -> HysteresisComponents
+        self._components = {}
+        self._configuration = None
+
+    def setupOutputs(self):
+        assert self.InputImage.meta.getAxisKeys() == list('txyzc'),\
+            "Input must be in txyzc order"
+        for slot in (self.Output, self.FilteredSmallLabels):
+            slot.meta.assignFrom(self.InputImage.meta)
+            slot.meta.dtype = numpy.uint32
+        self.Output.meta.drange = (0, 1)
+        self.FilteredSmallLabels.meta.drange = None
+
+        shape = self.InputImage.meta.shape
+        if self.BlockShape.ready():
+            self._blockShape = tuple(map(int, numpy.minimum(self.BlockShape.value, shape[1:4])))
+        else:
+            self._blockShape = hysteresisBlockShape(shape[1:4])
+        for slot in (self.Output, self.FilteredSmallLabels):
+            slot.meta.ideal_blockshape = (1,) + self._blockShape + (1,)
+
+        low = self.LowThreshold.value
+        high = self.HighThreshold.value
+        drange = self.InputImage.meta.drange
+        if drange is not None:
+            assert drange[0] == 0,\
+                "Don't know how to threshold data with this drange."
+            low *= drange[1]
+            high *= drange[1]
+        self._thresholds = (low, high)
+
+        configuration = (shape, self._blockShape, self._thresholds)
+        if configuration != self._configuration:
+            self._components = {}
+            self._configuration = configuration
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot in (self.Output, self.FilteredSmallLabels)
+        high = (slot == self.FilteredSmallLabels)
+        minSize = self.MinSize.value
+        maxSize = self.MaxSize.value
+        threshold = self._thresholds[1 if high else 0]
+        spatialRoi = (roi.start[1:4], roi.stop[1:4])
+
+        pool = RequestPool()
+        for i, t in enumerate(xrange(roi.start[0], roi.stop[0])):
+            for j, c in enumerate(xrange(roi.start[4], roi.stop[4])):
+                components = self._getComponents(t, c)
+                if high:
+                    lut = components.filteredHighLut(minSize, maxSize)
+                else:
+                    lut = components.outputLut(minSize, maxSize)
+                for blockStart in getIntersectingBlocks(self._blockShape, spatialRoi):
+                    pool.add(Request(partial(self._labelBlock, t, c, blockStart,
+                                             threshold, components, lut, high,
+                                             spatialRoi, result[i, ..., j])))
+        pool.wait()
+        return result
+
+    def _labelBlock(self, t, c, blockStart, threshold, components, lut, high, spatialRoi, result):
+        # the whole block is labeled, so that the labels match its BlockSummary
+        start, stop = self._blockBounds(blockStart)
+        labels = labelBlock(self._readBlock(t, c, start, stop), threshold)
+        labels = components.relabel(start, labels, lut, high=high)
+
+        interStart = numpy.maximum(start, spatialRoi[0])
+        interStop = numpy.minimum(stop, spatialRoi[1])
+        result[roiToSlice(interStart - spatialRoi[0], interStop - spatialRoi[0])] =\
+            labels[roiToSlice(interStart - start, interStop - start)]
+
+    def _getComponents(self, t, c):
+        with self._lock:
+            components = self._components.get((t, c))
+            if components is None:
+                with Timer() as timer:
+                    components = self._computeComponents(t, c)
+                logger.debug("Finding the components of time slice {}, channel {} took {} seconds"
+                             .format(t, c, timer.seconds()))
+                self._components[(t, c)] = components
+            return components
+
+    def _computeComponents(self, t, c):
+        low, high = self._thresholds
+        blocks = {}
+
+        def summarizeBlock(blockStart):
+            start, stop = self._blockBounds(blockStart)
+            data = self._readBlock(t, c, start, stop)
+            blocks[tuple(start)] = BlockSummary(labelBlock(data, low),
+                                                labelBlock(data, high))
+
+        pool = RequestPool()
+        spatialShape = self.InputImage.meta.shape[1:4]
+        for blockStart in getIntersectingBlocks(self._blockShape, roiFromShape(spatialShape)):
+            pool.add(Request(partial(summarizeBlock, blockStart)))
+        pool.wait()
+        return HysteresisComponents(self._blockShape, blocks)
+
+    def _blockBounds(self, blockStart):
+        start, stop = getBlockBounds(self.InputImage.meta.shape[1:4],
+                                     self._blockShape, blockStart)
+        return tuple(map(int, start)), tuple(map(int, stop))
+
+    def _readBlock(self, t, c, start, stop):
+        data = self.InputImage((t,) + start + (c,), (t+1,) + stop + (c+1,)).wait()
+        return data[0, ..., 0]
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.InputImage:
+            # objects can extend beyond the dirty roi, so the affected time
+            # slices are dirty as a whole
+            with self._lock:
+                for t, c in self._components.keys():
+                    if roi.start[0] <= t < roi.stop[0]:
+                        del self._components[(t, c)]
+            shape = self.InputImage.meta.shape
+            start = (roi.start[0], 0, 0, 0, 0)
+            stop = (roi.stop[0],) + tuple(shape[1:])
+            self.Output.setDirty(start, stop)
+            self.FilteredSmallLabels.setDirty(start, stop)
+        elif slot in (self.LowThreshold, self.HighThreshold, self.BlockShape):
+            with self._lock:
+                self._components = {}
+            self.Output.setDirty(slice(None))
+            self.FilteredSmallLabels.setDirty(slice(None))
+        elif slot in (self.MinSize, self.MaxSize):
+            # only the lookup tables change
+            self.Output.setDirty(slice(None))
+            self.FilteredSmallLabels.setDirty(slice(None))
+        else:
+            assert False, "Unknown input slot: {}".format(slot.name)
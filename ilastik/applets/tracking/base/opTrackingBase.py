@@ -20,6 +20,7 @@
 # ##############################################################################
 from functools import partial
 import logging
+import threading
 
 import numpy as np
 
@@ -29,18 +30,131 @@ from lazyflow.rtype import List
 from lazyflow.stype import Opaque
 import pgmlink
 from ilastik.applets.tracking.base.trackingUtilities import relabel, \
-    get_dict_value
+    get_dict_value, RelabelingTables
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
 from ilastik.applets.objectExtraction import config
 from ilastik.applets.base.applet import DatasetConstraintError
 from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.operators.valueProviders import OpZeroDefault
 from lazyflow.roi import sliceToRoi
+from lazyflow.request import Request, RequestPool
+from ilastik.utility.ramBudget import ramBudgetBytes
 
 
 logger = logging.getLogger(__name__)
 
 
+def filter_traxels(rc, ct, x_range, y_range, z_range, size_range):
+    """
+    Return a boolean mask of the objects whose center and size lie
+    within the given [start, stop) ranges.
+
+    :param rc: RegionCenter feature, one row per object (without background)
+    :param ct: Count feature, one row per object (without background)
+    """
+    rc = np.asarray(rc)
+    if rc.shape[1] not in (2, 3):
+        raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
+    size = np.asarray(ct).reshape(len(rc), -1)[:, 0]
+    # for 2d data, the z-coordinate is 0
+    z = rc[:, 2] if rc.shape[1] == 3 else np.zeros(len(rc))
+    keep = (size >= size_range[0]) & (size < size_range[1])
+    for coord, (start, stop) in zip((rc[:, 0], rc[:, 1], z), (x_range, y_range, z_range)):
+        keep &= (coord >= start) & (coord < stop)
+    return keep
+
+
+def _padded_coordinates(coords):
+    """pgmlink expects always 3 coordinates, z=0 for 2d data"""
+    padded = np.zeros((len(coords), 3))
+    padded[:, :coords.shape[1]] = coords
+    return padded
+
+
+def _frame_traxels(t, frame_feats, scales, ranges, with_opt_correction=False,
+                   divProbs=None, detProbs=None, localCenters=None, extract_coordinates=None):
+    """
+    Create the pgmlink.Traxels of the objects in one time step that
+    pass the filter ranges (x_range, y_range, z_range, size_range).
+
+    Returns (traxels, filtered_labels, sizes, num_objects), where
+    filtered_labels are the ids of the rejected objects and sizes
+    the sizes of the accepted ones.
+    """
+    rc = frame_feats[default_features_key]['RegionCenter']
+    ct = frame_feats[default_features_key]['Count']
+    if rc.size == 0 or len(rc) < 2:
+        return [], [], np.zeros((0,)), 0
+    # skip the background object
+    rc = rc[1:, ...]
+    ct = ct[1:, ...]
+    lower = frame_feats[default_features_key]['Coord<Minimum>'][1:, ...]
+    upper = frame_feats[default_features_key]['Coord<Maximum>'][1:, ...]
+
+    if with_opt_correction:
+        try:
+            rc_corr = frame_feats[config.features_vigra_name]['RegionCenter_corr']
+        except:
+            raise Exception, 'cannot consider optical correction since it has not been computed before'
+        coms_corrected = _padded_coordinates(rc_corr[1:, ...]).tolist()
+
+    keep = filter_traxels(rc, ct, *ranges)
+    ids = np.nonzero(keep)[0] + 1
+    filtered_labels = (np.nonzero(~keep)[0] + 1).tolist()
+    sizes = np.asarray(ct, dtype=np.float64).reshape(len(rc), -1)[keep, 0]
+    coms = _padded_coordinates(rc[keep]).tolist()
+    x_scale, y_scale, z_scale = scales
+
+    traxels = []
+    for oid, com, size in zip(ids.tolist(), coms, sizes.tolist()):
+        idx = oid - 1
+        tr = pgmlink.Traxel()
+        tr.set_x_scale(x_scale)
+        tr.set_y_scale(y_scale)
+        tr.set_z_scale(z_scale)
+        tr.Id = oid
+        tr.Timestep = t
+
+        tr.add_feature_array("com", 3)
+        for k, v in enumerate(com):
+            tr.set_feature_value('com', k, v)
+
+        if with_opt_correction:
+            tr.add_feature_array("com_corrected", 3)
+            for k, v in enumerate(coms_corrected[idx]):
+                tr.set_feature_value("com_corrected", k, v)
+
+        if divProbs is not None:
+            tr.add_feature_array("divProb", 1)
+            # divProbs starts from the background object
+            tr.set_feature_value("divProb", 0, float(divProbs[t][oid][1]))
+
+        if detProbs is not None:
+            tr.add_feature_array("detProb", len(detProbs[t][oid]))
+            for k, v in enumerate(detProbs[t][oid]):
+                tr.set_feature_value("detProb", k, float(v))
+
+        # FIXME: check whether it is 2d or 3d data!
+        if localCenters is not None:
+            tr.add_feature_array("localCentersX", len(localCenters[t][oid]))
+            tr.add_feature_array("localCentersY", len(localCenters[t][oid]))
+            tr.add_feature_array("localCentersZ", len(localCenters[t][oid]))
+            for k, v in enumerate(localCenters[t][oid]):
+                tr.set_feature_value("localCentersX", k, float(v[0]))
+                tr.set_feature_value("localCentersY", k, float(v[1]))
+                tr.set_feature_value("localCentersZ", k, float(v[2]))
+
+        tr.add_feature_array("count", 1)
+        tr.set_feature_value("count", 0, size)
+
+        if extract_coordinates is not None:
+            extract_coordinates(t, lower[idx], upper[idx], tr)
+
+        traxels.append(tr)
+
+    return traxels, filtered_labels, sizes, len(rc)
+
+
 class OpTrackingBase(Operator, ExportingOperator):
     name = "Tracking"
     category = "other"
@@ -64,10 +178,23 @@ class OpTrackingBase(Operator, ExportingOperator):
 
     Output = OutputSlot()
 
+    # The relabeling tables of Output and MergerOutput may use this
+    # fraction of the RAM budget (only relevant for very long movies).
+    RELABELING_RAM_FRACTION = 0.02
+
+    # Changes to these slots don't affect the traxels of _generate_traxelstore()
+    _TRAXELSTORE_INDEPENDENT_SLOTS = ('EventsVector', 'FilteredLabels', 'Parameters',
+                                      'InputHdf5', 'MergerInputHdf5')
+
     def __init__(self, parent=None, graph=None):
         super(OpTrackingBase, self).__init__(parent=parent, graph=graph)
         self.label2color = []
         self.mergers = []
+        self._label2colorTables = RelabelingTables()
+        self._mergerTables = RelabelingTables()
+        # (key, traxelstore, empty_frame, filtered_labels, median_size) of the
+        #  last _generate_traxelstore() call, see there
+        self._traxelStoreCache = None
 
         self.track_id = None
         self.extra_track_ids = None
@@ -144,7 +271,8 @@ class OpTrackingBase(Operator, ExportingOperator):
             for t in range(t_start, t_end):
                 if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][
                     0]) and len(self.label2color) > t:
-                    result[t - t_start, ..., 0] = relabel(result[t - t_start, ..., 0], self.label2color[t])
+                    lut = self._label2colorTables.get(t, result.dtype)
+                    result[t - t_start, ..., 0] = relabel(result[t - t_start, ..., 0], self.label2color[t], lut)
                 else:
                     result[t - t_start, ...] = 0
             return result
@@ -167,6 +295,9 @@ class OpTrackingBase(Operator, ExportingOperator):
 
 
     def propagateDirty(self, inputSlot, subindex, roi):
+        if inputSlot.name not in self._TRAXELSTORE_INDEPENDENT_SLOTS:
+            self._traxelStoreCache = None
+
         if inputSlot is self.LabelImage:
             self.Output.setDirty(roi)
         elif inputSlot is self.EventsVector:
@@ -331,6 +462,9 @@ class OpTrackingBase(Operator, ExportingOperator):
 
         self.label2color = label2color
         self.mergers = mergers
+        max_bytes = ramBudgetBytes(self.RELABELING_RAM_FRACTION)
+        self._label2colorTables.reset(label2color, max_bytes)
+        self._mergerTables.reset(mergers, max_bytes)
 
         self.Output._value = None
         self.Output.setDirty(slice(None))
@@ -392,165 +526,116 @@ class OpTrackingBase(Operator, ExportingOperator):
         parameters['z_range'] = z_range
         parameters['size_range'] = size_range
 
+        # The traxel store only depends on the filters and the features, so it
+        #  can be reused if only the solver parameters changed. Coordinate
+        #  lists are written to the caller's coordinate_map, so they are
+        #  always extracted again.
+        cache_key = (tuple(time_range), tuple(x_range), tuple(y_range), tuple(z_range), tuple(size_range),
+                     x_scale, y_scale, z_scale, with_div, with_local_centers, with_opt_correction,
+                     with_classifier_prior)
+        cached = self._traxelStoreCache
+        if not with_coordinate_list and cached is not None and cached[0] == cache_key:
+            logger.info("reusing traxels of the previous run")
+            _, ts, empty_frame, filtered_labels, median_size = cached
+            if median_object_size is not None:
+                median_object_size[0] = median_size
+            self.FilteredLabels.setValue(filtered_labels, check_changed=False)
+            return ts, empty_frame
+
         logger.info("generating traxels")
         logger.info("fetching region features and division probabilities")
         feats = self.ObjectFeatures(time_range).wait()
 
+        divProbs = None
         if with_div:
             if not self.DivisionProbabilities.ready() or len(self.DivisionProbabilities([0]).wait()[0]) == 0:
                 raise Exception, "Classifier not yet ready. Did you forget to train the Division Detection Classifier?"
             divProbs = self.DivisionProbabilities(time_range).wait()
 
+        localCenters = None
         if with_local_centers:
             localCenters = self.RegionLocalCenters(time_range).wait()
 
+        detProbs = None
         if with_classifier_prior:
             if not self.DetectionProbabilities.ready() or len(self.DetectionProbabilities([0]).wait()[0]) == 0:
                 raise Exception, "Classifier not yet ready. Did you forget to train the Object Count Classifier?"
             detProbs = self.DetectionProbabilities(time_range).wait()
 
         logger.info("filling traxelstore")
-        ts = pgmlink.TraxelStore()
+        scales = (x_scale, y_scale, z_scale)
+        ranges = (x_range, y_range, z_range, size_range)
+        coordinate_lock = threading.Lock()
+        frames = {}
+
+        def build_frame(t):
+            if with_coordinate_list and coordinate_map is not None:
+                extract_coordinates = partial(self._extract_coordinates, coordinate_map, coordinate_lock)
+            else:
+                extract_coordinates = None
+            frames[t] = _frame_traxels(t, feats[t], scales, ranges,
+                                       with_opt_correction, divProbs, detProbs, localCenters,
+                                       extract_coordinates)
+
+        pool = RequestPool()
+        for t in feats.keys():
+            pool.add(Request(partial(build_frame, t)))
+        pool.wait()
 
-        max_traxel_id_at = pgmlink.VectorOfInt()
+        ts = pgmlink.TraxelStore()
         filtered_labels = {}
         obj_sizes = []
-        total_count = 0
         empty_frame = False
-        for t in feats.keys():
-            rc = feats[t][default_features_key]['RegionCenter']
-            lower = feats[t][default_features_key]['Coord<Minimum>']
-            upper = feats[t][default_features_key]['Coord<Maximum>']
-            if rc.size:
-                rc = rc[1:, ...]
-                lower = lower[1:, ...]
-                upper = upper[1:, ...]
-
-            if with_opt_correction:
-                try:
-                    rc_corr = feats[t][config.features_vigra_name]['RegionCenter_corr']
-                except:
-                    raise Exception, 'cannot consider optical correction since it has not been computed before'
-                if rc_corr.size:
-                    rc_corr = rc_corr[1:, ...]
-
-            ct = feats[t][default_features_key]['Count']
-            if ct.size:
-                ct = ct[1:, ...]
-
-            logger.info("at timestep {}, {} traxels found".format(t, rc.shape[0]))
-            count = 0
-            filtered_labels_at = []
-            for idx in range(rc.shape[0]):
-                # for 2d data, set z-coordinate to 0:
-                if len(rc[idx]) == 2:
-                    x, y = rc[idx]
-                    z = 0
-                elif len(rc[idx]) == 3:
-                    x, y, z = rc[idx]
-                else:
-                    raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
-                size = ct[idx]
-                if (x < x_range[0] or x >= x_range[1] or
-                            y < y_range[0] or y >= y_range[1] or
-                            z < z_range[0] or z >= z_range[1] or
-                            size < size_range[0] or size >= size_range[1]):
-                    filtered_labels_at.append(int(idx + 1))
-                    continue
-                else:
-                    count += 1
-                tr = pgmlink.Traxel()
-                tr.set_x_scale(x_scale)
-                tr.set_y_scale(y_scale)
-                tr.set_z_scale(z_scale)
-                tr.Id = int(idx + 1)
-                tr.Timestep = t
-
-                # pgmlink expects always 3 coordinates, z=0 for 2d data
-                tr.add_feature_array("com", 3)
-                for i, v in enumerate([x, y, z]):
-                    tr.set_feature_value('com', i, float(v))
-
-                if with_opt_correction:
-                    tr.add_feature_array("com_corrected", 3)
-                    for i, v in enumerate(rc_corr[idx]):
-                        tr.set_feature_value("com_corrected", i, float(v))
-                    if len(rc_corr[idx]) == 2:
-                        tr.set_feature_value("com_corrected", 2, 0.)
-
-                if with_div:
-                    tr.add_feature_array("divProb", 1)
-                    # idx+1 because rc and ct start from 1, divProbs starts from 0
-                    tr.set_feature_value("divProb", 0, float(divProbs[t][idx + 1][1]))
-
-                if with_classifier_prior:
-                    tr.add_feature_array("detProb", len(detProbs[t][idx + 1]))
-                    for i, v in enumerate(detProbs[t][idx + 1]):
-                        val = float(v)
-                        if val < 0.0000001:
-                            val = 0.0000001
-                        if val > 0.99999999:
-                            val = 0.99999999
-                        tr.set_feature_value("detProb", i, float(v))
-
-
-                # FIXME: check whether it is 2d or 3d data!
-                if with_local_centers:
-                    tr.add_feature_array("localCentersX", len(localCenters[t][idx + 1]))
-                    tr.add_feature_array("localCentersY", len(localCenters[t][idx + 1]))
-                    tr.add_feature_array("localCentersZ", len(localCenters[t][idx + 1]))
-                    for i, v in enumerate(localCenters[t][idx + 1]):
-                        tr.set_feature_value("localCentersX", i, float(v[0]))
-                        tr.set_feature_value("localCentersY", i, float(v[1]))
-                        tr.set_feature_value("localCentersZ", i, float(v[2]))
-
-                tr.add_feature_array("count", 1)
-                tr.set_feature_value("count", 0, float(size))
-                if median_object_size is not None:
-                    obj_sizes.append(float(size))
-
+        for t in sorted(frames.keys()):
+            traxels, filtered_labels_at, sizes, num_objects = frames[t]
+            logger.info("at timestep {}, {} traxels found".format(t, num_objects))
+            for tr in traxels:
                 ts.add(tr)
-
-                # add coordinate lists
-
-                if with_coordinate_list and coordinate_map is not None:  # store coordinates in arma::mat
-                    # generate roi: assume the following order: txyzc
-                    n_dim = len(rc[idx])
-                    roi = [0] * 5
-                    roi[0] = slice(int(t), int(t + 1))
-                    roi[1] = slice(int(lower[idx][0]), int(upper[idx][0] + 1))
-                    roi[2] = slice(int(lower[idx][1]), int(upper[idx][1] + 1))
-                    if n_dim == 3:
-                        roi[3] = slice(int(lower[idx][2]), int(upper[idx][2] + 1))
-                    else:
-                        assert n_dim == 2
-                    image_excerpt = self.LabelImage[roi].wait()
-                    if n_dim == 2:
-                        image_excerpt = image_excerpt[0, ..., 0, 0]
-                    elif n_dim == 3:
-                        image_excerpt = image_excerpt[0, ..., 0]
-                    else:
-                        raise Exception, "n_dim = %s instead of 2 or 3"
-
-                    pgmlink.extract_coordinates(coordinate_map, image_excerpt, lower[idx].astype(np.int64), tr)
+            obj_sizes.append(sizes)
 
             if len(filtered_labels_at) > 0:
                 filtered_labels[str(int(t) - time_range[0])] = filtered_labels_at
-            logger.info("at timestep {}, {} traxels passed filter".format(t, count))
-            max_traxel_id_at.append(int(rc.shape[0]))
-            if count == 0:
+            logger.info("at timestep {}, {} traxels passed filter".format(t, len(traxels)))
+            if len(traxels) == 0:
                 empty_frame = True
 
-            total_count += count
-
+        median_size = None
+        if obj_sizes:
+            median_size = np.median(np.concatenate(obj_sizes), overwrite_input=True)
         if median_object_size is not None:
-            median_object_size[0] = np.median(np.array(obj_sizes), overwrite_input=True)
+            median_object_size[0] = median_size
             logger.info('median object size = ' + str(median_object_size[0]))
 
+        if not with_coordinate_list:
+            self._traxelStoreCache = (cache_key, ts, empty_frame, filtered_labels, median_size)
+
         self.FilteredLabels.setValue(filtered_labels, check_changed=False)
 
         return ts, empty_frame
 
+    def _extract_coordinates(self, coordinate_map, lock, t, lower, upper, traxel):
+        """Add the coordinates of one traxel to the coordinate_map."""
+        # generate roi: assume the following order: txyzc
+        n_dim = len(lower)
+        roi = [0] * 5
+        roi[0] = slice(int(t), int(t + 1))
+        roi[1] = slice(int(lower[0]), int(upper[0] + 1))
+        roi[2] = slice(int(lower[1]), int(upper[1] + 1))
+        if n_dim == 3:
+            roi[3] = slice(int(lower[2]), int(upper[2] + 1))
+        else:
+            assert n_dim == 2
+        image_excerpt = self.LabelImage[roi].wait()
+        if n_dim == 2:
+            image_excerpt = image_excerpt[0, ..., 0, 0]
+        elif n_dim == 3:
+            image_excerpt = image_excerpt[0, ..., 0]
+        else:
+            raise Exception, "n_dim = %s instead of 2 or 3"
+
+        with lock:
+            pgmlink.extract_coordinates(coordinate_map, image_excerpt, lower.astype(np.int64), traxel)
+
     def save_export_progress_dialog(self, dialog):
         """
         Implements ExportOperator.save_export_progress_dialog
@@ -568,7 +653,7 @@ class OpTrackingBase(Operator, ExportingOperator):
         :param progress_slot:
         :return:
         """
-        from ilastik.utility.exportFile import objects_per_frame, ExportFile, ilastik_ids, Mode, Default, \
+        from ilastik.utility.exportFile import objects_per_frame, StreamingExportFile, ilastik_ids, Mode, Default, \
             flatten_dict, division_flatten_dict
 
         selected_features = list(selected_features)
@@ -581,7 +666,7 @@ class OpTrackingBase(Operator, ExportingOperator):
         t_range = self.Parameters.value["time_range"] if self.Parameters.ready() else (0, 0)
         ids = ilastik_ids(obj_count)
 
-        export_file = ExportFile(settings["file path"])
+        export_file = StreamingExportFile(settings["file path"])
         export_file.ExportProgress.subscribe(progress_slot)
         export_file.InsertionProgress.subscribe(progress_slot)
 
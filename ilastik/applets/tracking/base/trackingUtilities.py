@@ -18,40 +18,91 @@
 # on the ilastik web site at:
 #		   http://ilastik.org/license.html
 ###############################################################################
+import threading
+
 import h5py
 import numpy as np
 import os.path as path
 import pgmlink
 
+from ilastik.utility.lruCache import LruCache
+
 import logging
 logger = logging.getLogger(__name__)
 
-def relabel(volume, replace):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
-    mp[1:] = 1
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            try:
-                r = replace[label]
-                mp[label] = r
-            except:                
-                pass
-#    mp[replace.keys()] = replace.values()
-    return mp[volume]
-    
-    
-def relabelMergers(volume, merger):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)    
-    mp[:] = 0
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            if label in merger:
-                mp[label] = merger[label]
-            else:
-                mp[label] = 1
-    return mp[volume]
+def relabel_lut(replace, dtype, default=1):
+    """Make a dense lookup table from a {label: new_label} dictionary.
+
+    Labels not in 'replace' are mapped to 'default', the background
+    (label 0) is always mapped to 0. The table has one trailing 'default'
+    entry, so that labels beyond the largest key are mapped to 'default'
+    with numpy.take(..., mode='clip'), see apply_lut().
+    """
+    keys = np.fromiter(replace.iterkeys(), dtype=np.int64, count=len(replace))
+    values = np.fromiter(replace.itervalues(), dtype=np.int64, count=len(replace))
+    positive = keys > 0
+    keys = keys[positive]
+    lut = np.empty((keys.max() + 2 if len(keys) else 2,), dtype=dtype)
+    lut[:] = default
+    lut[keys] = values[positive]
+    lut[0] = 0
+    return lut
+
+def apply_lut(volume, lut):
+    return np.take(lut, volume, mode='clip')
+
+def relabel(volume, replace, lut=None):
+    """Replace all object labels in 'volume' by replace[label], labels
+    that are not in 'replace' become 1.
+
+    If given, 'lut' must be the table relabel_lut(replace, ...), which
+    saves building it again for every call.
+    """
+    if lut is None:
+        lut = relabel_lut(replace, volume.dtype)
+    return apply_lut(volume, lut)
+
+def relabelMergers(volume, merger, lut=None):
+    """Replace all merger labels in 'volume' by the number of merged
+    objects, all other objects become 1."""
+    return relabel(volume, merger, lut)
+
+class RelabelingTables(object):
+    """
+    Thread-safe cache of the relabel_lut() tables of a list of per-time-step
+    dictionaries (e.g. OpTrackingBase.label2color).
+
+    Each table is built on first use and then shared by all requests for
+    that time step. Only max_bytes of tables are kept, the least recently
+    used time steps are dropped first.
+    """
+    def __init__(self, max_bytes=None):
+        self._lock = threading.Lock()
+        self._mappings = []
+        self._tables = LruCache(max_bytes)
+        # Incremented whenever the mappings change, so that tables built
+        #  from outdated mappings are not stored
+        self._generation = 0
+
+    def reset(self, mappings, max_bytes=None):
+        with self._lock:
+            self._generation += 1
+            self._mappings = mappings
+            self._tables.clear()
+            self._tables.set_max_bytes(max_bytes)
+
+    def get(self, t, dtype):
+        dtype = np.dtype(dtype)
+        with self._lock:
+            mappings = self._mappings
+            generation = self._generation
+            lut = self._tables.get((t, dtype))
+        if lut is None:
+            lut = relabel_lut(mappings[t], dtype)
+            with self._lock:
+                if generation == self._generation:
+                    self._tables[(t, dtype)] = lut
+        return lut
 
 def get_dict_value(dic, key, default=[]):
     if key not in dic:
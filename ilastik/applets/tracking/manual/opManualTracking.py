@@ -20,7 +20,7 @@
 ###############################################################################
 from ilastik.applets.base.applet import DatasetConstraintError
 from ilastik.utility.exportingOperator import ExportingOperator
-from ilastik.utility.exportFile import objects_per_frame, ExportFile, ilastik_ids, Mode, Default
+from ilastik.utility.exportFile import objects_per_frame, StreamingExportFile, ilastik_ids, Mode, Default
 from operator import itemgetter
 from itertools import compress
 from functools import partial
@@ -218,7 +218,7 @@ class OpManualTracking(Operator, ExportingOperator):
         max_tracks = max(max(map(len, i.values())) for i in oid2tid.values())
         ids = ilastik_ids(obj_count)
 
-        export_file = ExportFile(settings["file path"])
+        export_file = StreamingExportFile(settings["file path"])
         export_file.ExportProgress.subscribe(progress_slot)
         export_file.InsertionProgress.subscribe(progress_slot)
 
@@ -40,6 +40,9 @@ ClusterConfigFields = \
     "node_output_decompression_cmd" : FormattedField( requiredFields=["compressed_file", "uncompressed_file"]),
     "task_progress_update_command" : FormattedField( requiredFields=["progress"] ),
     "task_launch_server" : str,
+    "task_scheduler" : str,
+    "task_scheduler_workers" : AutoEval(int),
+    "task_max_retries" : AutoEval(int),
     "output_log_directory" : str,
     "server_working_directory" : str,
     "command_format" : FormattedField( requiredFields=["task_args"], optionalFields=["task_name"] ),
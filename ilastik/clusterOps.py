@@ -20,10 +20,13 @@
 ###############################################################################
 import os
 import copy
+import shutil
+import tempfile
 import subprocess
 import collections
 import hashlib
 import functools
+import multiprocessing
 
 import numpy
 
@@ -35,6 +38,8 @@ from lazyflow.utility.timer import Timer
 from lazyflow.utility.pathHelpers import getPathVariants
 
 from ilastik.clusterConfig import parseClusterConfigFile
+from ilastik.clusterScheduler import LocalTaskScheduler
+from ilastik.clusterStaging import openScratchFileset, stageBlock, unstageBlock
 from ilastik.workflow import Workflow
 
 import logging
@@ -89,36 +94,64 @@ class OpTaskWorker(Operator):
 
         logger.info( "Executing for roi: {}".format(roi) )
 
-        if config.use_node_local_scratch:
-            assert False, "FIXME."
-
         assert (blockwiseFileset.getEntireBlockRoi( roi.start )[1] == roi.stop).all(), "Each task must execute exactly one full block.  ({},{}) is not a valid block roi.".format( roi.start, roi.stop )
         assert self.Input.ready()
 
         with Timer() as computeTimer:
-            # Stream the data out to disk.
-            request_blockshape = self._primaryBlockwiseFileset.description.sub_block_shape # Could be None.  That's okay.
-            streamer = BigRequestStreamer(self.Input, (roi.start, roi.stop), request_blockshape )
-            streamer.progressSignal.subscribe( self.progressSignal )
-            streamer.resultSignal.subscribe( self._handlePrimaryResultBlock )
-            streamer.execute()
+            if config.use_node_local_scratch:
+                self._executeWithScratch( config, roi )
+            else:
+                # Stream the data out to disk.
+                self._streamBlock( blockwiseFileset, roi )
 
-            # Now the block is ready.  Update the status.
-            blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
+                # Now the block is ready.  Update the status.
+                blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
 
         logger.info( "Finished task in {} seconds".format( computeTimer.seconds() ) )
         result[0] = True
         return result
 
+    def _executeWithScratch(self, config, roi):
+        """
+        Write the block to node-local scratch space (in sys_tmp_dir), 
+        then move it to the shared output fileset in one piece.
+        If node_output_compression_cmd is configured, the block is compressed 
+        before it is moved and the master unpacks it.
+        """
+        compressionCmd = config.node_output_compression_cmd
+        if compressionCmd is not None:
+            assert config.node_output_decompression_cmd is not None, \
+                "node_output_compression_cmd requires node_output_decompression_cmd"
+
+        scratchDir = tempfile.mkdtemp( prefix="ilastik-task-", dir=config.sys_tmp_dir )
+        try:
+            scratchFileset = openScratchFileset( self._primaryBlockwiseFileset, scratchDir )
+            try:
+                self._streamBlock( scratchFileset, roi )
+            finally:
+                scratchFileset.close()
+
+            logger.info( "Moving block from scratch to {}".format( self._primaryBlockwiseFileset.description.dataset_root_dir ) )
+            stageBlock( scratchFileset, self._primaryBlockwiseFileset, roi.start, compressionCmd )
+        finally:
+            shutil.rmtree( scratchDir, ignore_errors=True )
+
+    def _streamBlock(self, targetFileset, roi):
+        request_blockshape = targetFileset.description.sub_block_shape # Could be None.  That's okay.
+        streamer = BigRequestStreamer(self.Input, (roi.start, roi.stop), request_blockshape )
+        streamer.progressSignal.subscribe( self.progressSignal )
+        streamer.resultSignal.subscribe( functools.partial( self._handlePrimaryResultBlock, targetFileset ) )
+        streamer.execute()
+
     def propagateDirty(self, slot, subindex, roi):
         self.ReturnCode.setDirty( slice(None) )
         
-    def _handlePrimaryResultBlock(self, roi, result):
+    def _handlePrimaryResultBlock(self, targetFileset, roi, result):
         # First write the primary
-        self._primaryBlockwiseFileset.writeData(roi, result)
+        targetFileset.writeData(roi, result)
 
         # Ask the workflow if there is any special post-processing to do...
-        self.get_workflow().postprocessClusterSubResult(roi, result, self._primaryBlockwiseFileset)
+        self.get_workflow().postprocessClusterSubResult(roi, result, targetFileset)
 
     def get_workflow(self):
         op = self
@@ -156,6 +189,9 @@ class OpClusterize(Operator):
         blockwiseFileset, taskInfos = self._prepareDestination()
 
         try:
+            # Unpack any compressed blocks that nodes staged during a previous run.
+            self._unstageBlocks( blockwiseFileset, taskInfos.keys() )
+
             # Figure out which work doesn't need to be recomputed (if any)
             unneeded_rois = []
             for roi in taskInfos.keys():
@@ -169,6 +205,12 @@ class OpClusterize(Operator):
                 del taskInfos[roi]
 
             absWorkDir, _ = getPathVariants(self._config.server_working_directory, os.path.split( configFilePath )[0] )
+            if self._config.task_scheduler == "local":
+                # Run (and monitor) the tasks on this machine.
+                taskResults = self._runLocalScheduler( blockwiseFileset, taskInfos, absWorkDir )
+                result[0] = all( r.success for r in taskResults )
+                return result
+
             if self._config.task_launch_server == "localhost":
                 def localCommand( cmd ):
                     cwd = os.getcwd()
@@ -197,6 +239,51 @@ class OpClusterize(Operator):
         finally:
             blockwiseFileset.close()
 
+    def _unstageBlocks(self, blockwiseFileset, rois):
+        """
+        Decompress the blocks that nodes have staged in compressed form (see OpTaskWorker).
+        """
+        decompressionCmd = self._config.node_output_decompression_cmd
+        if not self._config.use_node_local_scratch or decompressionCmd is None:
+            return
+        for roi in rois:
+            if unstageBlock( blockwiseFileset, roi[0], decompressionCmd ):
+                logger.info( "Unpacked staged block: {}".format( roi ) )
+
+    def _runLocalScheduler(self, blockwiseFileset, taskInfos, workingDirectory):
+        """
+        Run the tasks with a LocalTaskScheduler, which keeps a fixed number 
+        of tasks running and retries tasks that fail or time out.
+        A task only counts as successful if it marked its block as available.
+        """
+        numWorkers = self._config.task_scheduler_workers
+        if not numWorkers:
+            threadsPerTask = self._config.task_threadpool_size or 1
+            numWorkers = max(1, multiprocessing.cpu_count() // threadsPerTask)
+
+        def checkFinished(roi):
+            self._unstageBlocks( blockwiseFileset, [roi] )
+            return blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE
+
+        def resetTask(roi):
+            blockwiseFileset.setBlockStatus(roi[0], BlockwiseFileset.BLOCK_NOT_AVAILABLE)
+
+        scheduler = LocalTaskScheduler( numWorkers,
+                                        workingDirectory,
+                                        timeout_secs=self._config.task_timeout_secs,
+                                        max_retries=self._config.task_max_retries or 0,
+                                        check_finished=checkFinished,
+                                        reset_task=resetTask )
+        scheduler.progressSignal.subscribe( lambda progress: logger.info( "Cluster progress: {}%".format(progress) ) )
+
+        logger.info( "Running {} tasks with {} local workers".format( len(taskInfos), numWorkers ) )
+        taskResults = scheduler.run( taskInfos )
+
+        failedTasks = [ r.taskName for r in taskResults if not r.success ]
+        if failedTasks:
+            logger.error( "The following tasks failed: {}".format( ", ".join(failedTasks) ) )
+        return taskResults
+
     def _prepareTaskInfos(self, roiList):
         # Divide up the workload into large pieces
         logger.info( "Dividing into {} node jobs.".format( len(roiList) ) )
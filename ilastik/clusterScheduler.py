@@ -0,0 +1,187 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import signal
+import threading
+import subprocess
+import collections
+import Queue
+
+import numpy
+
+from lazyflow.graph import OrderedSignal
+
+from ilastik.utility.log_exception import log_exception
+
+import logging
+logger = logging.getLogger(__name__)
+
+class LocalTaskScheduler(object):
+    """
+    Runs the node tasks of OpClusterize on the local machine.
+
+    A fixed number of worker threads pull tasks from a shared queue, so 
+    workers that finish their blocks early simply take the next one 
+    (no block is statically assigned to a worker).  Tasks that fail, 
+    time out or don't produce their block are put back into the queue 
+    until they have been attempted max_retries+1 times.
+    """
+    TaskResult = collections.namedtuple( 'TaskResult', 'taskName roi attempts seconds success' )
+
+    # A task is considered a straggler if it took this many times longer than the median task.
+    STRAGGLER_FACTOR = 2.0
+
+    def __init__(self, num_workers, working_directory=None, timeout_secs=None, max_retries=0, 
+                 check_finished=None, reset_task=None, poll_interval=0.5):
+        """
+        num_workers: The number of tasks to run concurrently
+        working_directory: The directory in which the task commands are executed
+        timeout_secs: Tasks that run longer than this are killed (and retried)
+        max_retries: How many times a failed task is restarted
+        check_finished: Optional function check_finished(roi) -> bool that 
+                        verifies the output of a task that exited successfully
+        reset_task: Optional function reset_task(roi), called before a failed task is retried
+        """
+        self.num_workers = max(1, num_workers)
+        self.working_directory = working_directory
+        self.timeout_secs = timeout_secs
+        self.max_retries = max_retries
+        self.check_finished = check_finished
+        self.reset_task = reset_task
+        self.poll_interval = poll_interval
+
+        self.progressSignal = OrderedSignal()
+
+    def run(self, taskInfos):
+        """
+        Run all tasks and block until they are finished.
+
+        taskInfos: A dict of { roi : OpClusterize.TaskInfo }
+        Returns a list of TaskResult, in order of completion.
+        """
+        results = []
+        if not taskInfos:
+            return results
+
+        queue = Queue.Queue()
+        for roi, taskInfo in taskInfos.items():
+            queue.put( (roi, taskInfo, 1) )
+
+        lock = threading.Lock()
+        remaining = [len(taskInfos)]
+
+        def finishTask(taskResult):
+            with lock:
+                results.append( taskResult )
+                remaining[0] -= 1
+                done = remaining[0] == 0
+                progress = 100 * len(results) // len(taskInfos)
+            self.progressSignal( progress )
+            if done:
+                # Wake up all workers so they can exit.
+                for _ in range(self.num_workers):
+                    queue.put( None )
+
+        def worker():
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                roi, taskInfo, attempt = item
+                logger.info( "Launching task {} (attempt {}): {}".format( taskInfo.taskName, attempt, taskInfo.command ) )
+                start = time.time()
+                try:
+                    success = self._runTask( taskInfo.command ) and \
+                              ( self.check_finished is None or self.check_finished(roi) )
+                except:
+                    # Count it as a failed attempt, so the task is still retried or finished.
+                    log_exception( logger, "Task {} raised an exception.".format( taskInfo.taskName ) )
+                    success = False
+                seconds = time.time() - start
+                
+                if success:
+                    logger.info( "Task {} finished in {:.1f} seconds".format( taskInfo.taskName, seconds ) )
+                elif attempt <= self.max_retries:
+                    logger.warn( "Task {} failed after {:.1f} seconds.  Retrying.".format( taskInfo.taskName, seconds ) )
+                    try:
+                        if self.reset_task is not None:
+                            self.reset_task(roi)
+                    except:
+                        log_exception( logger, "Couldn't reset task {}.  Not retrying.".format( taskInfo.taskName ) )
+                    else:
+                        queue.put( (roi, taskInfo, attempt+1) )
+                        continue
+                else:
+                    logger.error( "Task {} failed after {} attempts.".format( taskInfo.taskName, attempt ) )
+                finishTask( LocalTaskScheduler.TaskResult( taskInfo.taskName, roi, attempt, seconds, success ) )
+
+        threads = [ threading.Thread( target=worker, name="LocalTaskScheduler-{}".format(i) ) 
+                    for i in range(self.num_workers) ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self._logStragglers( results )
+        return results
+
+    def _runTask(self, command):
+        """
+        Run the given shell command.
+        Returns True if it exited with code 0 before the timeout.
+        """
+        kwargs = {}
+        if hasattr(os, 'setsid'):
+            # Start a new process group, so that we can kill the command along with the shell.
+            kwargs['preexec_fn'] = os.setsid
+        process = subprocess.Popen( command, shell=True, cwd=self.working_directory, **kwargs )
+
+        start = time.time()
+        while process.poll() is None:
+            if self.timeout_secs and time.time() - start > self.timeout_secs:
+                logger.warn( "Task timed out after {} seconds: {}".format( self.timeout_secs, command ) )
+                self._kill( process )
+                return False
+            time.sleep( self.poll_interval )
+        return process.returncode == 0
+
+    def _kill(self, process):
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg( process.pid, signal.SIGKILL )
+            else:
+                process.kill()
+        except OSError:
+            # The process finished in the meantime.
+            pass
+        process.wait()
+
+    def _logStragglers(self, results):
+        seconds = [ r.seconds for r in results if r.success ]
+        if not seconds:
+            return
+        median = numpy.median( seconds )
+        logger.info( "Finished {} tasks.  Median task time: {:.1f} seconds, max: {:.1f} seconds".format( len(seconds), median, max(seconds) ) )
+        for r in results:
+            if r.success and r.seconds > self.STRAGGLER_FACTOR * median:
+                logger.info( "Straggler: task {} took {:.1f} seconds".format( r.taskName, r.seconds ) )
@@ -0,0 +1,132 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Helpers for moving the results of cluster tasks from node-local scratch 
+space to the shared output directory.
+
+A node writes its block into a local scratch directory first.  
+The finished block file is then (optionally) compressed, copied to the 
+shared filesystem under a temporary name and renamed, so readers of the 
+shared directory never see partially written files.  Compressed blocks 
+are decompressed by the master (see unstageBlock()).
+"""
+import os
+import copy
+import shutil
+import subprocess
+
+from lazyflow.utility.io.blockwiseFileset import BlockwiseFileset
+
+import logging
+logger = logging.getLogger(__name__)
+
+#: Suffix of compressed block files that have not been unpacked by the master yet.
+STAGED_SUFFIX = '.staged'
+
+def atomicCopy(srcPath, destPath):
+    """
+    Copy srcPath to destPath.  The file is first copied to a temporary 
+    file in the destination directory and then renamed, which is atomic 
+    on POSIX filesystems.
+    """
+    tmpPath = "{}.tmp-{}".format( destPath, os.getpid() )
+    shutil.copyfile( srcPath, tmpPath )
+    os.rename( tmpPath, destPath )
+
+def stageFile(localPath, sharedPath, compressionCmd=None):
+    """
+    Move a finished file from local scratch to the shared filesystem.
+
+    If compressionCmd is given (a format string with the fields 
+    {uncompressed_file} and {compressed_file}), the file is compressed 
+    first and ends up at sharedPath + STAGED_SUFFIX.  It must be 
+    unpacked with unstageFile() before it can be used.
+
+    Returns the path of the file on the shared filesystem.
+    """
+    if compressionCmd is None:
+        atomicCopy( localPath, sharedPath )
+        return sharedPath
+
+    compressedPath = localPath + STAGED_SUFFIX
+    cmd = compressionCmd.format( uncompressed_file=localPath, compressed_file=compressedPath )
+    logger.debug( "Compressing: " + cmd )
+    subprocess.check_call( cmd, shell=True )
+    stagedPath = sharedPath + STAGED_SUFFIX
+    atomicCopy( compressedPath, stagedPath )
+    os.remove( compressedPath )
+    return stagedPath
+
+def unstageFile(sharedPath, decompressionCmd):
+    """
+    Decompress a file that was staged by stageFile() with compression.
+    Returns False if there is no staged file for sharedPath.
+    """
+    stagedPath = sharedPath + STAGED_SUFFIX
+    if not os.path.exists( stagedPath ):
+        return False
+    tmpPath = "{}.tmp-{}".format( sharedPath, os.getpid() )
+    cmd = decompressionCmd.format( compressed_file=stagedPath, uncompressed_file=tmpPath )
+    logger.debug( "Decompressing: " + cmd )
+    subprocess.check_call( cmd, shell=True )
+    os.rename( tmpPath, sharedPath )
+    os.remove( stagedPath )
+    return True
+
+def openScratchFileset(sharedFileset, scratchDir):
+    """
+    Create a BlockwiseFileset in scratchDir with the same layout as 
+    sharedFileset, so that block files can be written locally and moved 
+    to the shared fileset afterwards.
+    """
+    description = copy.deepcopy( sharedFileset.description )
+    description.dataset_root_dir = os.path.abspath( scratchDir )
+    descriptionPath = os.path.join( scratchDir, 'scratch_description.json' )
+    BlockwiseFileset.writeDescription( descriptionPath, description )
+    return BlockwiseFileset( descriptionPath, 'a' )
+
+def stageBlock(scratchFileset, sharedFileset, blockStart, compressionCmd=None):
+    """
+    Move the block file starting at blockStart from the scratch fileset 
+    to the shared fileset.  Without compression, the block is marked as 
+    available right away.  Otherwise the master must call unstageBlock().
+    """
+    localPath = scratchFileset.getDatasetPathComponents( blockStart ).externalPath
+    sharedPath = sharedFileset.getDatasetPathComponents( blockStart ).externalPath
+    sharedDir = os.path.dirname( sharedPath )
+    if not os.path.exists( sharedDir ):
+        os.makedirs( sharedDir )
+
+    stageFile( localPath, sharedPath, compressionCmd )
+    if compressionCmd is None:
+        sharedFileset.setBlockStatus( blockStart, BlockwiseFileset.BLOCK_AVAILABLE )
+
+def unstageBlock(sharedFileset, blockStart, decompressionCmd):
+    """
+    If a compressed block was staged for blockStart, decompress it into 
+    place and mark the block as available.
+    Returns True if a staged block was found.
+    """
+    sharedPath = sharedFileset.getDatasetPathComponents( blockStart ).externalPath
+    if not unstageFile( sharedPath, decompressionCmd ):
+        return False
+    sharedFileset.setBlockStatus( blockStart, BlockwiseFileset.BLOCK_AVAILABLE )
+    return True
@@ -31,6 +31,10 @@ Example:
 debug: false
 plugin_directories: ~/.ilastik/plugins,
 logging_config: ~/custom_ilastik_logging_config.json
+
+[feature cache]
+directory: ~/.ilastik/feature_cache
+max_size_mb: 10240
 """
 
 default_config = """
@@ -42,6 +46,10 @@ plugin_directories: ~/.ilastik/plugins,
 threads: -1
 total_ram_mb: 0
 
+[feature cache]
+directory:
+max_size_mb: 10240
+
 [ipc raw tcp]
 autostart: false
 autoaccept: true
@@ -93,6 +93,35 @@ class ObjectFeaturesPlugin(IPlugin):
         """
         return dict()
 
+    def compute_local_batch(self, image, labels, label_ids, extents, features, axes):
+        """Calculate features on many objects at once.
+
+        Plugins may override this to compute the features of all
+        objects with fewer library calls. The default implementation
+        calls compute_local() once per object.
+
+        :param image: np.ndarray - image cropped to the union of all extents
+        :param labels: np.ndarray - labels cropped like image, without channels
+        :param label_ids: sequence of object labels
+        :param extents: for each object, a list of slices (in xyz
+            order of the axes) of its expanded bounding box into
+            image and labels
+        :param features: which features to compute
+        :param axes: axis tags
+
+        :returns: a list with one dictionary per object, as returned
+            by compute_local()
+
+        """
+        results = []
+        for label_id, extent in zip(label_ids, extents):
+            key = list(extent)
+            key.insert(axes.c, slice(None))
+            rawbbox = image[tuple(key)]
+            binary_bbox = (labels[tuple(extent)] == label_id)
+            results.append(self.compute_local(rawbbox, binary_bbox, features, axes))
+        return results
+
     @staticmethod
     def combine_dicts(ds):
         return dict(sum((d.items() for d in ds), []))
@@ -62,6 +62,10 @@ class VigraObjFeats(ObjectFeaturesPlugin):
     local_suffix = " in neighborhood" #note the space in front, it's important
     local_out_suffixes = [local_suffix, " in object and neighborhood"]
 
+    # compute_local_batch() falls back to single objects if packing
+    # would need more than this many voxels per object voxel
+    max_packing_overhead = 4
+
     ndim = None
     
     def availableFeatures(self, image, labels):
@@ -159,3 +163,71 @@ class VigraObjFeats(ObjectFeaturesPlugin):
             result = self._do_4d(image, label, featurenames, axes)
             results.append(self.update_keys(result, suffix=suffix))
         return self.combine_dicts(results)
+
+    def compute_local_batch(self, image, labels, label_ids, extents, feature_dict, axes):
+        """Pack the neighborhoods of many objects side by side along x
+        and compute their features with one vigra call per mask type."""
+
+        featurenames = feature_dict.keys()
+        local = [x+self.local_suffix for x in self.local_features]
+        featurenames = list(set(featurenames) & set(local))
+        featurenames = [x.split(' ')[0] for x in featurenames]
+
+        # Histogram bins depend on the value range of the whole image
+        # passed to vigra, so they can't be computed on a packed image
+        if len(featurenames) == 0 or "Histogram" in featurenames:
+            return super(VigraObjFeats, self).compute_local_batch(image, labels, label_ids, extents, feature_dict, axes)
+
+        margin = ilastik.applets.objectExtraction.opObjectExtraction.max_margin({'': feature_dict})
+        rawbboxes = []
+        masks = []
+        for label_id, extent in zip(label_ids, extents):
+            key = list(extent)
+            key.insert(axes.c, slice(None))
+            rawbboxes.append(image[tuple(key)])
+            passed, excl = ilastik.applets.objectExtraction.opObjectExtraction.make_bboxes(labels[tuple(extent)] == label_id, margin)
+            masks.append((excl, passed))
+
+        packed_shape = list(image.shape)
+        packed_shape[axes.x] = sum(b.shape[axes.x] for b in rawbboxes)
+        packed_shape[axes.y] = max(b.shape[axes.y] for b in rawbboxes)
+        packed_shape[axes.z] = max(b.shape[axes.z] for b in rawbboxes)
+
+        # Don't pack objects of very different shapes, the padding would
+        # cost more than the saved calls
+        n_voxels = sum(b.size for b in rawbboxes)
+        if np.prod(packed_shape) > self.max_packing_overhead * n_voxels:
+            return super(VigraObjFeats, self).compute_local_batch(image, labels, label_ids, extents, feature_dict, axes)
+
+        packed_image = np.zeros(packed_shape, dtype=np.float32)
+        label_shape = list(packed_shape)
+        del label_shape[axes.c]
+        packed_labels = [np.zeros(label_shape, dtype=np.uint32) for _ in self.local_out_suffixes]
+
+        start = 0
+        for i, (rawbbox, bbox_masks) in enumerate(zip(rawbboxes, masks)):
+            key = [None] * 3
+            key[axes.x] = slice(start, start + rawbbox.shape[axes.x])
+            key[axes.y] = slice(0, rawbbox.shape[axes.y])
+            key[axes.z] = slice(0, rawbbox.shape[axes.z])
+            start += rawbbox.shape[axes.x]
+
+            packed_labels_key = tuple(key)
+            key.insert(axes.c, slice(None))
+            packed_image[tuple(key)] = rawbbox
+            for packed_label, mask in zip(packed_labels, bbox_masks):
+                packed_label[packed_labels_key][np.asarray(mask, dtype=bool)] = i+1
+
+        results = [dict() for _ in label_ids]
+        for j, (packed_label, suffix) in enumerate(zip(packed_labels, self.local_out_suffixes)):
+            result = self._do_4d(packed_image, packed_label, featurenames, axes)
+            for key, value in self.update_keys(result, suffix=suffix).iteritems():
+                for i in range(len(label_ids)):
+                    if masks[i][j].any():
+                        results[i][key] = value[i]
+                    else:
+                        # An empty mask (e.g. no context around an object that
+                        # fills the image) gets no values, as in compute_local(),
+                        # so the feature is dropped with a warning.
+                        results[i][key] = value[:0]
+        return results
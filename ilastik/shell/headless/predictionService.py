@@ -0,0 +1,176 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+A long-running headless service that keeps a project loaded and
+processes batch jobs it receives over a local socket.
+
+Loading a project (and training or loading its classifier) usually takes
+much longer than predicting a small image, so the project is loaded only
+once and each job only replaces the batch inputs (see
+Workflow.handleBatchJob()).
+
+Requests and replies are JSON objects, one per line. A connection may
+carry any number of requests, but only one connection is served at a
+time, since jobs are processed one after the other anyway:
+
+    {"command": "process", "args": ["--output_format=hdf5", "img1.png", "img2.png"]}
+    -> {"status": "ok", "job": 1, "seconds": 0.52,
+        "results": [{"output": "/data/img1_Probabilities.h5", "seconds": 0.27}, ...]}
+    {"command": "status"}
+    -> {"status": "ok", "project": "/data/MyProject.ilp", "jobs": 1, "uptime": 12.3}
+    {"command": "shutdown"}
+    -> {"status": "ok"}
+
+Failed requests are answered with {"status": "error", "message": ...}.
+"""
+import os
+import stat
+import time
+import json
+import socket
+import SocketServer
+import logging
+logger = logging.getLogger(__name__)
+
+from ilastik.utility.contextSocket import socket as context_socket
+from ilastik.utility.numpyJsonEncoder import NumpyJsonEncoder
+from ilastik.utility.log_exception import log_exception
+
+def parse_address(address):
+    """
+    Parse an address given on the command line: 'host:port' for a TCP 
+    socket, anything else is the path of a Unix socket.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and os.path.sep not in address:
+        return (host or 'localhost', int(port))
+    return address
+
+def send_request(address, command, **kwargs):
+    """
+    Send one request to a PredictionService at address (as returned by 
+    parse_address()) and return its reply.
+    """
+    family = socket.AF_UNIX if isinstance(address, basestring) else socket.AF_INET
+    request = dict(kwargs, command=command)
+    with context_socket(family, socket.SOCK_STREAM) as s:
+        s.connect(address)
+        s.sendall(json.dumps(request, cls=NumpyJsonEncoder) + '\n')
+        reply = s.makefile('r').readline()
+    return json.loads(reply)
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        service = self.server.service
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            reply = service.handleMessage(line)
+            self.wfile.write(json.dumps(reply, cls=NumpyJsonEncoder) + '\n')
+            self.wfile.flush()
+            if not service.running:
+                break
+
+class _TCPServer(SocketServer.TCPServer):
+    allow_reuse_address = True
+
+class PredictionService(object):
+    """
+    Serves batch jobs for the project that is loaded in a HeadlessShell.
+
+    Example:
+        shell.openProjectFile('MyProject.ilp')
+        service = PredictionService(shell, ('localhost', 7890))
+        service.serve() # returns after a 'shutdown' request
+    """
+    def __init__(self, shell, address):
+        """
+        shell: a HeadlessShell with an open project
+        address: (host, port) for a TCP socket (port 0 picks a free port),
+            or the path of a Unix socket
+        """
+        self._shell = shell
+        self._socketPath = None
+        if isinstance(address, basestring):
+            # Remove a socket that was left behind by a previous run
+            if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+                os.remove(address)
+            self._server = SocketServer.UnixStreamServer(address, _RequestHandler)
+            self._socketPath = address
+        else:
+            self._server = _TCPServer(tuple(address), _RequestHandler)
+        self._server.service = self
+        self._commands = { 'process' : self._process,
+                           'status' : self._status,
+                           'shutdown' : self._shutdown }
+        self.running = False
+        self.jobCount = 0
+        self._startTime = time.time()
+
+    @property
+    def address(self):
+        """The address the service is listening on."""
+        return self._server.server_address
+
+    def serve(self):
+        """Process requests until a 'shutdown' request is received."""
+        self.running = True
+        logger.info("Serving {} on {}".format( self._shell.projectManager.currentProjectPath, self.address ))
+        try:
+            while self.running:
+                self._server.handle_request()
+        finally:
+            self.running = False
+            self._server.server_close()
+            if self._socketPath is not None and os.path.exists(self._socketPath):
+                os.remove(self._socketPath)
+
+    def handleMessage(self, message):
+        """Execute one JSON-encoded request and return the reply."""
+        try:
+            request = json.loads(message)
+            command = request.pop('command', None)
+            if command not in self._commands:
+                raise ValueError("Unknown command: {}".format( command ))
+            reply = self._commands[command](**request)
+        except Exception, ex:
+            log_exception( logger, "Request failed: {}".format( message.strip() ) )
+            return { 'status' : 'error', 'message' : str(ex) }
+        reply['status'] = 'ok'
+        return reply
+
+    def _process(self, args):
+        self.jobCount += 1
+        start = time.time()
+        results = self._shell.workflow.handleBatchJob( map(str, args) )
+        seconds = time.time() - start
+        logger.info( "Job {}: {} results in {:.3f} seconds".format( self.jobCount, len(results), seconds ) )
+        return { 'job' : self.jobCount, 'seconds' : seconds, 'results' : results }
+
+    def _status(self):
+        return { 'project' : self._shell.projectManager.currentProjectPath,
+                 'workflow' : self._shell.workflow.workflowName,
+                 'jobs' : self.jobCount,
+                 'uptime' : time.time() - self._startTime }
+
+    def _shutdown(self):
+        self.running = False
+        return {}
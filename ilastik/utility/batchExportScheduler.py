@@ -0,0 +1,183 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import sys
+import time
+import threading
+import collections
+
+import numpy
+
+from lazyflow.graph import OrderedSignal
+from lazyflow.request import Request
+
+from ilastik.utility.ramBudget import ramBudgetBytes
+from ilastik.utility.log_exception import log_exception
+
+import logging
+logger = logging.getLogger(__name__)
+
+class BatchExportScheduler(object):
+    """
+    Exports several lanes of a headless batch run concurrently.
+
+    At most num_workers lanes are exported at the same time, and a lane
+    is only started if the estimated RAM of all running lanes (including
+    its own) fits into the RAM budget. A lane is always started when no
+    other lane is running, however large it is. Lanes that write the same
+    file are never exported at the same time. Lanes are started in the
+    given order.
+
+    The lanes' computations run in lazyflow's thread pool, which limits
+    the number of threads used by all of them together. Exporting several
+    lanes at once keeps that pool busy when a single (small) lane can't.
+    """
+    LaneResult = collections.namedtuple( 'LaneResult', 'lane seconds nbytes success' )
+
+    # Fraction of the available RAM that the running lanes may use together
+    RAM_FRACTION = 0.5
+
+    def __init__(self, num_workers=None, ram_budget_bytes=None):
+        """
+        num_workers: The maximum number of lanes exported at the same time 
+                     (default: the number of lazyflow worker threads)
+        ram_budget_bytes: The RAM that the running lanes may use together
+                          (default: RAM_FRACTION of the available RAM)
+        """
+        if num_workers is None:
+            num_workers = Request.global_thread_pool.num_workers
+        self.num_workers = max(1, num_workers)
+        self.ram_budget_bytes = ram_budget_bytes
+        self.progressSignal = OrderedSignal()
+
+    def run(self, lane_indexes, export_lane, lane_ram_bytes, lane_output_bytes=None, lane_output_file=None):
+        """
+        Export all lanes and block until they are finished.
+
+        export_lane: function export_lane(lane_index) that exports one lane
+        lane_ram_bytes: function lane_ram_bytes(lane_index) that estimates the 
+                        RAM needed to export the lane
+        lane_output_bytes: Optional function lane_output_bytes(lane_index) that 
+                           returns the size of the exported data, which is used 
+                           to report the throughput (default: lane_ram_bytes)
+        lane_output_file: Optional function lane_output_file(lane_index) that 
+                          returns the file the lane is exported to. Lanes with 
+                          the same file are exported one after another.
+
+        Returns a list of LaneResult, in the order of lane_indexes.
+        If any lane fails, no further lanes are started and the first 
+        exception is re-raised once the running lanes are finished.
+        """
+        lane_indexes = list(lane_indexes)
+        if not lane_indexes:
+            return []
+        lane_output_bytes = lane_output_bytes or lane_ram_bytes
+        ram_budget = self.ram_budget_bytes
+        if ram_budget is None:
+            ram_budget = ramBudgetBytes( self.RAM_FRACTION )
+
+        output_files = {}
+        if lane_output_file is not None:
+            output_files = dict( (lane, lane_output_file(lane)) for lane in lane_indexes )
+            lanes_by_file = collections.defaultdict(list)
+            for lane in lane_indexes:
+                lanes_by_file[output_files[lane]].append(lane)
+            for output_file, lanes in sorted(lanes_by_file.items()):
+                if len(lanes) > 1:
+                    logger.warning( "Lanes {} are all exported to {}. "
+                                    "Exporting them one at a time.".format( lanes, output_file ) )
+
+        pending = collections.deque( (lane, lane_ram_bytes(lane)) for lane in lane_indexes )
+        results = {}
+        condition = threading.Condition()
+        # [number of running lanes, their RAM, exc_info of the first failure]
+        state = [0, 0, None]
+        running_files = set()
+
+        def nextLane():
+            with condition:
+                while True:
+                    if state[2] is not None or not pending:
+                        return None
+                    lane, ram_bytes = pending[0]
+                    fits = state[0] == 0 or state[1] + ram_bytes <= ram_budget
+                    if fits and output_files.get(lane) not in running_files:
+                        pending.popleft()
+                        state[0] += 1
+                        state[1] += ram_bytes
+                        if lane in output_files:
+                            running_files.add( output_files[lane] )
+                        return lane, ram_bytes
+                    condition.wait()
+
+        def worker():
+            while True:
+                item = nextLane()
+                if item is None:
+                    return
+                lane, ram_bytes = item
+                start = time.time()
+                exc_info = None
+                nbytes = 0
+                try:
+                    export_lane( lane )
+                    nbytes = lane_output_bytes( lane )
+                except:
+                    exc_info = sys.exc_info()
+                    log_exception( logger, "Export of lane {} failed.".format( lane ) )
+                seconds = time.time() - start
+
+                result = BatchExportScheduler.LaneResult( lane, seconds, nbytes, exc_info is None )
+                if result.success:
+                    logger.info( "Exported lane {}: {:.1f} MB in {:.1f} seconds ({:.1f} MB/s)"
+                                 .format( lane, result.nbytes / 1e6, seconds, result.nbytes / 1e6 / max(seconds, 1e-6) ) )
+                with condition:
+                    results[lane] = result
+                    state[0] -= 1
+                    state[1] -= ram_bytes
+                    running_files.discard( output_files.get(lane) )
+                    if exc_info is not None and state[2] is None:
+                        state[2] = exc_info
+                    condition.notify_all()
+                    # Emitted under the lock, so the progress never goes backwards
+                    self.progressSignal( 100 * len(results) // len(lane_indexes) )
+
+        start = time.time()
+        num_threads = min( self.num_workers, len(lane_indexes) )
+        threads = [ threading.Thread( target=worker, name="BatchExportScheduler-{}".format(i) ) 
+                    for i in range(num_threads) ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if state[2] is not None:
+            raise state[2][0], state[2][1], state[2][2]
+
+        seconds = time.time() - start
+        total_bytes = sum( result.nbytes for result in results.values() )
+        logger.info( "Exported {} lanes ({} at a time): {:.1f} MB in {:.1f} seconds ({:.1f} MB/s)"
+                     .format( len(results), num_threads, total_bytes / 1e6, seconds, total_bytes / 1e6 / max(seconds, 1e-6) ) )
+        return [ results[lane] for lane in lane_indexes ]
+
+def slot_nbytes(slot):
+    """The size of the data of a (ready) slot, in bytes."""
+    return int( numpy.prod( slot.meta.shape ) ) * numpy.dtype( slot.meta.dtype ).itemsize
@@ -0,0 +1,99 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Connected components of a volume, assembled from blocks that are
+labeled independently.
+
+Block-local labels are made global by adding the block's offset, and
+labels that touch at a block face are merged with a union-find.
+"""
+import numpy
+import vigra
+
+from unionFind import UnionFind
+
+def labelComponents(mask):
+    """Label the connected components (6-neighborhood) of the nonzero
+    voxels of a (x,y,z) block."""
+    mask = numpy.asarray(mask != 0, dtype=numpy.uint8)
+    labels = vigra.analysis.labelVolumeWithBackground(mask)
+    return numpy.asarray(labels, dtype=numpy.uint32)
+
+def uniquePairs(a, b):
+    """Return the distinct pairs (a[i], b[i]) where both are nonzero, as
+    two arrays."""
+    a = numpy.asarray(a, numpy.uint64).ravel()
+    b = numpy.asarray(b, numpy.uint64).ravel()
+    mask = (a > 0) & (b > 0)
+    pairs = numpy.unique((a[mask] << numpy.uint64(32)) | b[mask])
+    return (pairs >> numpy.uint64(32)).astype(numpy.intp), \
+           (pairs & numpy.uint64(0xffffffff)).astype(numpy.intp)
+
+def blockFaces(labels):
+    """Return the labels on the first and the last plane along each axis
+    of a block, as two lists."""
+    return [labels.take([0], axis) for axis in range(labels.ndim)], \
+           [labels.take([-1], axis) for axis in range(labels.ndim)]
+
+class BlockStitcher(object):
+    """
+    A union-find over the labels of all blocks of a volume.
+
+    offsets maps each block start to the offset that makes its labels
+    global (label 0 stays the background).
+    """
+    def __init__(self, blockShape, nlabels):
+        """
+        blockShape: the block shape
+        nlabels: dict of block start -> number of labels in the block
+            (without the background), for all blocks
+        """
+        self.blockShape = tuple(blockShape)
+        self.starts = sorted(nlabels.keys())
+        self.unionFind = UnionFind()
+        self.offsets = {}
+        for start in self.starts:
+            self.offsets[start] = len(self.unionFind) - 1
+            self.unionFind.add(nlabels[start])
+
+    def mergeFaces(self, firstFace, lastFace):
+        """
+        Merge the labels that touch at block faces.
+
+        firstFace, lastFace: functions (block start, axis) -> the block
+            labels on the first resp. last plane along that axis
+        """
+        for start in self.starts:
+            for axis in range(len(start)):
+                neighbor = list(start)
+                neighbor[axis] += self.blockShape[axis]
+                neighbor = tuple(neighbor)
+                if neighbor not in self.offsets:
+                    continue
+                a, b = uniquePairs(lastFace(start, axis), firstFace(neighbor, axis))
+                a += self.offsets[start]
+                b += self.offsets[neighbor]
+                for x, y in zip(a.tolist(), b.tolist()):
+                    self.unionFind.union(x, y)
+
+    def consecutive_lut(self):
+        """Lookup table from global labels to consecutive component ids."""
+        return self.unionFind.consecutive_lut()
@@ -0,0 +1,138 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import threading
+
+import numpy
+
+import logging
+logger = logging.getLogger(__name__)
+
+class DiskBlockStore(object):
+    """
+    A directory of arrays, addressed by key (e.g. a content hash), 
+    which can be shared between processes and sessions.
+
+    Each array is stored as a separate .npy file.  Reading an array 
+    updates the modification time of its file, and the files that were 
+    least recently used are deleted once the total size of the 
+    directory exceeds max_bytes.
+
+    Example:
+        store = DiskBlockStore('/tmp/ilastik_feature_cache', max_bytes=2**30)
+        store.put('abc', numpy.zeros((10,10)))
+        a = store.get('abc')
+    """
+    SUFFIX = '.npy'
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._total = sum( size for _, _, size in self._listFiles() )
+
+    @property
+    def nbytes(self):
+        return self._total
+
+    def _path(self, key):
+        return os.path.join( self.directory, key + self.SUFFIX )
+
+    def _listFiles(self):
+        """Return (mtime, path, size) of all stored files."""
+        files = []
+        for name in os.listdir( self.directory ):
+            if not name.endswith( self.SUFFIX ):
+                continue
+            path = os.path.join( self.directory, name )
+            try:
+                st = os.stat( path )
+            except OSError:
+                # Deleted by another process in the meantime
+                continue
+            files.append( (st.st_mtime, path, st.st_size) )
+        return files
+
+    def __contains__(self, key):
+        return os.path.exists( self._path(key) )
+
+    def get(self, key):
+        """
+        Return the array stored for key, or None if there is none.
+        """
+        path = self._path(key)
+        try:
+            value = numpy.load( path )
+            os.utime( path, None )
+        except (IOError, OSError, ValueError):
+            # Missing, deleted in the meantime or truncated
+            return None
+        return value
+
+    def put(self, key, value):
+        """
+        Store an array.  The file is written under a temporary name and 
+        then renamed, so concurrent readers never see a partial file.
+        """
+        path = self._path(key)
+        tmpPath = "{}.tmp-{}-{}".format( path, os.getpid(), threading.current_thread().ident )
+        try:
+            with open( tmpPath, 'wb' ) as f:
+                numpy.save( f, numpy.asarray(value) )
+            size = os.path.getsize( tmpPath )
+            os.rename( tmpPath, path )
+        except (IOError, OSError) as ex:
+            # The cache is optional: Don't fail if the disk is full, etc.
+            logger.warn( "Could not write block to disk cache: {}".format( ex ) )
+            if os.path.exists( tmpPath ):
+                os.remove( tmpPath )
+            return
+
+        with self._lock:
+            self._total += size
+            if self.max_bytes is not None and self._total > self.max_bytes:
+                self._evict( keep=path )
+
+    def _evict(self, keep):
+        files = sorted( self._listFiles() )
+        total = sum( size for _, _, size in files )
+        for _, path, size in files:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove( path )
+            except OSError:
+                pass
+            total -= size
+        self._total = total
+
+    def clear(self):
+        with self._lock:
+            for _, path, _ in self._listFiles():
+                try:
+                    os.remove( path )
+                except OSError:
+                    pass
+            self._total = 0
@@ -3,8 +3,10 @@ import numpy.lib.recfunctions as nlr
 import h5py
 from vigra import AxisTags
 from lazyflow.utility import OrderedSignal
+from lazyflow.request import Request, RequestPool
 from sys import stdout
 from zipfile import ZipFile
+from functools import partial
 import logging
 
 logger = logging.getLogger(__name__)
@@ -63,12 +65,26 @@ def flatten_ilastik_feature_table(table, selection, signal):
         computed_feature = table([]).wait()
     signal(100)
 
+    dtype, dtype_to_key = feature_table_layout(computed_feature[0], selection)
+
+    frame_tables = [feature_table_rows(computed_feature[t], dtype, dtype_to_key)
+                    for t in sorted(computed_feature.iterkeys())]
+    return np.concatenate(frame_tables)
+
+
+def feature_table_layout(frame_features, selection):
+    """
+    Determines the columns of the flattened feature table
+    :param frame_features: the computed features of one frame ({category: {name: array}})
+    :param selection: the names of the selected features
+    :returns: the structured dtype of the table and a dict mapping each column to (category, name, channel)
+    """
     feature_names = []
     feature_cats = []
     feature_channels = []
     feature_types = []
 
-    for cat_name, category in computed_feature[0].iteritems():
+    for cat_name, category in frame_features.iteritems():
         for feat_name, feat_array in category.iteritems():
             if cat_name == "Default features" or \
                     feat_name not in feature_names and \
@@ -78,10 +94,6 @@ def flatten_ilastik_feature_table(table, selection, signal):
                 feature_channels.append((feat_array.shape[1]))
                 feature_types.append(feat_array.dtype)
 
-    obj_count = []
-    for t, cf in computed_feature.iteritems():
-        obj_count.append(cf["Default features"]["Count"].shape[0] - 1)  # no background
-
     dtype_names = []
     dtype_types = []
     dtype_to_key = {}
@@ -97,35 +109,40 @@ def flatten_ilastik_feature_table(table, selection, signal):
             dtype_types.append(feature_types[i].name)
             dtype_to_key[dtype_names[-1]] = (feature_cats[i], name, 0)
 
-    feature_table = np.zeros((sum(obj_count),), dtype=",".join(dtype_types))
-    feature_table.dtype.names = map(str, dtype_names)
+    dtype = np.dtype([(str(name), type_) for name, type_ in zip(dtype_names, dtype_types)])
+    return dtype, dtype_to_key
 
-    start = 0
-    end = obj_count[0]
-    for t, cf in computed_feature.iteritems():
-        for name in dtype_names:
-            cat, feat_name, index = dtype_to_key[name]
-            feature_table[name][start:end] = cf[cat][feat_name][1:, index]
-        start = end
-        try:
-            end += obj_count[int(t) + 1]
-        except IndexError:
-            end = sum(obj_count)
 
-    return feature_table
+def feature_table_rows(frame_features, dtype, dtype_to_key):
+    """
+    Flattens the features of one frame into rows of the feature table (without the background object)
+    :param frame_features: the computed features of one frame ({category: {name: array}})
+    :param dtype: the dtype as returned by feature_table_layout
+    :param dtype_to_key: the column mapping as returned by feature_table_layout
+    """
+    obj_count = frame_features["Default features"]["Count"].shape[0] - 1  # no background
+    rows = np.zeros((obj_count,), dtype=dtype)
+    for name in dtype.names:
+        cat, feat_name, index = dtype_to_key[name]
+        rows[name] = frame_features[cat][feat_name][1:, index]
+    return rows
 
 
 def objects_per_frame(labeling_image):
-    t_index = labeling_image.meta.axistags.index("t")
-    data = labeling_image([]).wait()
-    frames = data.shape[t_index]
-
-    if t_index != 0:
-        raise RuntimeError("FAIL")
+    """
+    Yields the number of objects (i.e. the highest label) of each frame.
+    The frames are requested one at a time, so the whole labeling is never in memory.
+    """
+    if "t" not in labeling_image.meta.getAxisKeys():
+        yield labeling_image([]).wait().max()
+        return
 
-    for t in xrange(frames):
-        yield data[t].max()
-        #yield len(np.unique(data[t]))
+    t_index = labeling_image.meta.axistags.index("t")
+    shape = labeling_image.meta.shape
+    for t in xrange(shape[t_index]):
+        slicing = [slice(None)] * len(shape)
+        slicing[t_index] = slice(t, t + 1)
+        yield labeling_image(slicing).wait().max()
 
 
 def division_flatten_dict(divisions, dict_):
@@ -188,11 +205,11 @@ def create_slicing(axistags, dimensions, margin, feature_table):
     maxx = feature_table["Coord<Maximum>_0"].astype(np.int32)
     miny = feature_table["Coord<Minimum>_1"].astype(np.int32)
     maxy = feature_table["Coord<Maximum>_1"].astype(np.int32)
-    table_shape = feature_table.shape[0]
+    table_shape = len(time)
     try:
         minz = feature_table["Coord<Minimum>_2"].astype(np.int32)
         maxz = feature_table["Coord<Maximum>_2"].astype(np.int32)
-    except ValueError:
+    except (ValueError, KeyError):
         minz = maxz = [0] * table_shape
 
     indices = map(axistags.index, "txyzc")
@@ -216,6 +233,66 @@ def create_slicing(axistags, dimensions, margin, feature_table):
         oid += 1
 
 
+ROI_TILE_SIZE = 128
+ROI_BATCH_SIZE = 1000
+
+
+def extract_rois(image_slot, slicings, binarize=False):
+    """
+    Yields the image data of the object rois, in the order of slicings
+        Instead of one blocking request per object, the objects are processed in batches of ROI_BATCH_SIZE.
+        Within a batch, the objects are grouped by time step and by the spatial tile (of ROI_TILE_SIZE)
+        their roi starts in. Each group is read with one request for the union of its rois, and the
+        requests of a batch run concurrently.
+    :param image_slot: the slot to read the data from
+    :type image_slot: lazyflow.slot.Slot
+    :param slicings: the slicings and object ids, as yielded by create_slicing
+    :param binarize: if True, yield 1 where the roi equals the object id and 0 elsewhere (for labelings)
+    """
+    axis_keys = image_slot.meta.getAxisKeys()
+    slicings = iter(slicings)
+    while True:
+        batch = [item for _, item in zip(xrange(ROI_BATCH_SIZE), slicings)]
+        if not batch:
+            return
+
+        groups = {}
+        for index, (slicing, _) in enumerate(batch):
+            key = tuple(0 if s.start is None else (s.start if axis == "t" else s.start // ROI_TILE_SIZE)
+                        for axis, s in zip(axis_keys, slicing))
+            groups.setdefault(key, []).append(index)
+
+        rois = [None] * len(batch)
+
+        def read_group(indices):
+            union = []
+            for dim in xrange(len(batch[indices[0]][0])):
+                dim_slices = [batch[i][0][dim] for i in indices]
+                if dim_slices[0].start is None:
+                    union.append(slice(None))
+                else:
+                    union.append(slice(min(s.start for s in dim_slices), max(s.stop for s in dim_slices)))
+            data = image_slot(union).wait()
+            for i in indices:
+                slicing, oid = batch[i]
+                local = tuple(slice(None) if u.start is None else slice(s.start - u.start, s.stop - u.start)
+                              for s, u in zip(slicing, union))
+                roi = data[local]
+                if binarize:
+                    roi = np.equal(roi, oid).astype(int)
+                else:
+                    roi = roi.copy()
+                rois[i] = roi
+
+        pool = RequestPool()
+        for indices in groups.itervalues():
+            pool.add(Request(partial(read_group, indices)))
+        pool.wait()
+
+        for roi in rois:
+            yield roi
+
+
 def actual_axistags(axistags, shape):
     return AxisTags([axistags[j] for j, s in enumerate(shape) if s > 1])
 
@@ -289,13 +366,7 @@ class ExportFile(object):
                                   margin, self.table_dict[feature_table_name])
         self.InsertionProgress(0)
 
-        if type_ == "labeling":
-            vec = self._normalize
-        else:
-            vec = lambda _: lambda y: y
-        for i, (slicing, oid) in enumerate(slicings):
-            roi = image_slot(slicing).wait()
-            roi = vec(oid)(roi)
+        for i, roi in enumerate(extract_rois(image_slot, slicings, type_ == "labeling")):
             roi_path = table_path.format(i)
             self.meta_dict[roi_path] = {
                 "type": type_,
@@ -305,13 +376,6 @@ class ExportFile(object):
             self.InsertionProgress(100 * i / self.table_dict[feature_table_name].shape[0])
         self.InsertionProgress(100)
 
-    @staticmethod
-    def _normalize(oid):
-        def f(pixel_value):
-            return 1 if pixel_value == oid else 0
-
-        return np.vectorize(f)
-
     def add_image(self, table, image_slot):
         """
         Adds an image as a table
@@ -401,6 +465,223 @@ class ExportFile(object):
             fout.write("\n")
 
 
+class _FeatureColumns(object):
+    """
+    Placeholder for IlastikFeatureTable columns in a StreamingExportFile, which are computed frame by frame
+    """
+    def __init__(self, slot, selection):
+        self.slot = slot
+        self.selection = list(selection)
+
+    def frame(self, t):
+        if self.slot.meta.shape[0] > 1:
+            return self.slot([t]).wait()[t]
+        return self.slot([]).wait()[t]
+
+
+class StreamingExportFile(ExportFile):
+    """
+    An ExportFile that writes everything while it is computed instead of collecting it in memory first.
+
+    Tables that contain IlastikFeatureTable columns are computed one frame at a time. Each frame's rows are
+    appended to the file (resizable HDF5 datasets or CSV) and its ROI images are written right away.
+    Images added with add_image are copied frame by frame. Only the columns added in the other modes are
+    kept in memory, so the peak memory use doesn't grow with the number of frames.
+
+    The object counts of the other columns must match the feature table (as in ExportFile), and the ROIs
+    can only be added for tables with IlastikFeatureTable columns.
+    """
+    def __init__(self, file_name):
+        super(StreamingExportFile, self).__init__(file_name)
+        self.table_parts = {}
+        self.roi_requests = {}
+        self.image_requests = []
+
+    def add_columns(self, table_name, col_data, mode, extra=None):
+        if mode == Mode.IlastikFeatureTable:
+            if extra is None or "selection" not in extra:
+                raise AttributeError("IlastikFeatureTable needs a feature selection (extra 'selection')")
+            self.table_parts.setdefault(table_name, []).append(_FeatureColumns(col_data, extra["selection"]))
+        else:
+            super(StreamingExportFile, self).add_columns(table_name, col_data, mode, extra)
+
+    def _add_columns(self, table_name, columns):
+        self.table_parts.setdefault(table_name, []).append(columns)
+
+    def add_rois(self, table_path, image_slot, feature_table_name, margin, type_="image"):
+        assert type_ in ("labeling", "image"), "Type must be 'labeling' or 'image'"
+        assert self._is_streamed(feature_table_name), "ROIs need a table with IlastikFeatureTable columns"
+        self.roi_requests.setdefault(feature_table_name, []).append((table_path, image_slot, margin, type_))
+
+    def add_image(self, table, image_slot):
+        self.image_requests.append((table, image_slot))
+
+    def _is_streamed(self, table_name):
+        return any(isinstance(part, _FeatureColumns) for part in self.table_parts.get(table_name, []))
+
+    def write_all(self, mode, compression=None):
+        """
+        Computes and writes all tables, ROIs and images to the file
+        :param mode: "h[d[f]]5" or "csv" at the moment
+        :type mode: str
+        :param compression: the compression settings
+        :type compression: dict
+        """
+        compression = compression if compression is not None else {}
+        self.ExportProgress(0)
+        if mode in ("h5", "hd5", "hdf5"):
+            with h5py.File(self.file_name, "w") as fout:
+                def open_table(table_name):
+                    return _H5TableWriter(fout, table_name, self.meta_dict.get(table_name, {}), compression)
+                self._write_tables(open_table, fout, compression)
+                for table, image_slot in self.image_requests:
+                    self._write_image(fout, table, image_slot, compression)
+        elif mode == "csv":
+            f_name = self.file_name.rsplit(".", 1)
+            if len(f_name) == 1:
+                base, ext = f_name[0], ""
+            else:
+                base, ext = f_name
+
+            def open_table(table_name):
+                return _CsvTableWriter("{name}_{table}.{ext}".format(name=base, table=table_name, ext=ext))
+            self._write_tables(open_table, None, compression)
+        self.ExportProgress(100)
+        logger.info("exported %i tables" % len(self.table_parts))
+
+    def _write_tables(self, open_table, fout, compression):
+        for count, (table_name, parts) in enumerate(self.table_parts.iteritems()):
+            writer = open_table(table_name)
+            try:
+                if self._is_streamed(table_name):
+                    self._stream_table(writer, table_name, parts, fout, compression)
+                else:
+                    writer.append(nlr.merge_arrays(parts, flatten=True) if len(parts) > 1 else parts[0])
+            finally:
+                writer.close()
+            self.ExportProgress(100 * (count + 1) / len(self.table_parts))
+
+    def _stream_table(self, writer, table_name, parts, fout, compression):
+        features = [part for part in parts if isinstance(part, _FeatureColumns)]
+        frames = features[0].slot.meta.shape[0]
+        layouts = {}
+        row = 0
+        self.InsertionProgress(0)
+        for t in xrange(frames):
+            frame_columns = []
+            n_rows = None
+            for part in parts:
+                if isinstance(part, _FeatureColumns):
+                    frame_features = part.frame(t)
+                    if part not in layouts:
+                        layouts[part] = feature_table_layout(frame_features, part.selection)
+                    columns = feature_table_rows(frame_features, *layouts[part])
+                    n_rows = len(columns)
+                    frame_columns.append(columns)
+                else:
+                    frame_columns.append(part)
+            # The in-memory columns are sliced with the object count of this frame
+            frame_columns = [columns if isinstance(part, _FeatureColumns) else columns[row:row + n_rows]
+                             for part, columns in zip(parts, frame_columns)]
+            if len(frame_columns) > 1:
+                rows = nlr.merge_arrays(frame_columns, flatten=True)
+            else:
+                rows = frame_columns[0]
+            writer.append(rows)
+
+            if fout is not None:
+                for table_path, image_slot, margin, type_ in self.roi_requests.get(table_name, []):
+                    self._write_frame_rois(fout, table_path, image_slot, margin, type_, t, row, rows, compression)
+            row += n_rows
+            self.InsertionProgress(100 * (t + 1) / frames)
+
+    def _write_frame_rois(self, fout, table_path, image_slot, margin, type_, t, first_row, rows, compression):
+        coords = dict((name, rows[name]) for name in rows.dtype.names if name.startswith("Coord<"))
+        coords[Default.TimeColumnName] = np.repeat(t, len(rows))
+        slicings = create_slicing(image_slot.meta.axistags, image_slot.meta.shape, margin, coords)
+        for i, roi in enumerate(extract_rois(image_slot, slicings, type_ == "labeling")):
+            meta = {
+                "type": type_,
+                "axistags": actual_axistags(image_slot.meta.axistags, roi.shape).toJSON()
+            }
+            self._make_h5_dataset(fout, table_path.format(first_row + i), roi.squeeze(), meta, compression)
+
+    @staticmethod
+    def _write_image(fout, table, image_slot, compression):
+        shape = image_slot.meta.shape
+        keep = [i for i, s in enumerate(shape) if s > 1]
+        try:
+            dset = fout.create_dataset(table, tuple(shape[i] for i in keep), dtype=image_slot.meta.dtype, **compression)
+        except TypeError:
+            dset = fout.create_dataset(table, tuple(shape[i] for i in keep), dtype=image_slot.meta.dtype)
+        dset.attrs["type"] = "image"
+        dset.attrs["axistags"] = actual_axistags(image_slot.meta.axistags, shape).toJSON()
+
+        keys = image_slot.meta.getAxisKeys()
+        t_index = keys.index("t") if "t" in keys else None
+        if t_index is None or shape[t_index] == 1:
+            dset[...] = image_slot([]).wait().reshape(dset.shape)
+            return
+
+        for t in xrange(shape[t_index]):
+            slicing = [slice(None)] * len(shape)
+            slicing[t_index] = slice(t, t + 1)
+            data = image_slot(slicing).wait()
+            dset_slicing = tuple(slice(t, t + 1) if i == t_index else slice(None) for i in keep)
+            dset[dset_slicing] = data.reshape([data.shape[i] for i in keep])
+
+
+class _H5TableWriter(object):
+    """
+    Appends rows to a resizable HDF5 dataset, which is created with the first rows
+    """
+    def __init__(self, fout, table_name, meta, compression):
+        self.fout = fout
+        self.table_name = table_name
+        self.meta = meta
+        self.compression = compression
+        self.dset = None
+
+    def append(self, rows):
+        if self.dset is None:
+            kwargs = dict(shape=(0,), maxshape=(None,), dtype=rows.dtype, chunks=True)
+            try:
+                self.dset = self.fout.create_dataset(self.table_name, **dict(kwargs, **self.compression))
+            except TypeError:
+                self.dset = self.fout.create_dataset(self.table_name, **kwargs)
+            for k, v in self.meta.iteritems():
+                self.dset.attrs[k] = v
+        if len(rows) == 0:
+            return
+        start = self.dset.shape[0]
+        self.dset.resize((start + len(rows),))
+        self.dset[start:] = rows
+
+    def close(self):
+        pass
+
+
+class _CsvTableWriter(object):
+    """
+    Appends rows to a CSV file, the header is written with the first rows
+    """
+    def __init__(self, file_name):
+        self.fout = open(file_name, "w")
+        self.header_written = False
+
+    def append(self, rows):
+        if not self.header_written:
+            self.fout.write(",".join(rows.dtype.names))
+            self.fout.write("\n")
+            self.header_written = True
+        for row in rows:
+            self.fout.write(",".join(map(str, row)))
+            self.fout.write("\n")
+
+    def close(self):
+        self.fout.close()
+
+
 class ProgressPrinter(object):
     def __init__(self, name, range_, max_=0):
         self.first = True
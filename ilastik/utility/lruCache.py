@@ -0,0 +1,136 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import collections
+import threading
+
+def nbytes(value):
+    """
+    Estimate the memory used by a value, counting only numpy arrays
+    (possibly nested in tuples, lists and dicts).
+    """
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.itervalues())
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    return 0
+
+class LruCache(object):
+    """
+    A thread-safe dict-like cache which evicts the least recently used
+    items once their total size exceeds max_bytes.
+
+    The most recently inserted item is never evicted, even if it alone
+    exceeds max_bytes.
+
+    Example:
+        cache = LruCache(max_bytes=1000)
+        cache[0] = numpy.zeros((100,))  # 800 bytes
+        cache[1] = numpy.zeros((100,))  # evicts cache[0]
+    """
+    def __init__(self, max_bytes=None, sizeof=nbytes, on_evict=None):
+        """
+        max_bytes: The size limit, or None for an unbounded cache
+        sizeof: Function that returns the size of a value in bytes
+        on_evict: Optional callback on_evict(key, value), called for evicted items
+        """
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._on_evict = on_evict
+        self._items = collections.OrderedDict()
+        self._sizes = {}
+        self._total = 0
+        self._lock = threading.RLock()
+
+    @property
+    def nbytes(self):
+        return self._total
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                return self[key]
+            return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.pop(key)
+            self._items[key] = value
+            self._sizes[key] = self._sizeof(value)
+            self._total += self._sizes[key]
+            self._evict()
+
+    def pop(self, key, *default):
+        with self._lock:
+            if key not in self._items and default:
+                return default[0]
+            value = self._items.pop(key)
+            self._total -= self._sizes.pop(key)
+            return value
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def keys(self):
+        with self._lock:
+            return self._items.keys()
+
+    def items(self):
+        with self._lock:
+            return self._items.items()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self._total = 0
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        while self._total > self.max_bytes and len(self._items) > 1:
+            key, value = self._items.popitem(last=False)
+            self._total -= self._sizes.pop(key)
+            if self._on_evict is not None:
+                self._on_evict(key, value)
@@ -0,0 +1,42 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import lazyflow
+
+def availableRamMb():
+    """
+    Return the amount of RAM (in MB) that ilastik may use.
+
+    This is lazyflow.AVAILABLE_RAM_MB if it was configured (see
+    ilastik_main._prepare_lazyflow_config), otherwise the RAM that is
+    currently available on this machine.
+    """
+    ram_mb = getattr(lazyflow, 'AVAILABLE_RAM_MB', None)
+    if ram_mb:
+        return ram_mb
+
+    import psutil
+    return psutil.virtual_memory().available / (1024.0**2)
+
+def ramBudgetBytes(fraction):
+    """
+    Return the given fraction of availableRamMb(), in bytes.
+    """
+    return int(fraction * availableRamMb() * 1024**2)
@@ -0,0 +1,63 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+class UnionFind(object):
+    """
+    Disjoint sets of the labels 0..n-1. Label 0 (background) is
+    never merged with anything else.
+    """
+    def __init__(self):
+        self._parent = [0]
+
+    def __len__(self):
+        return len(self._parent)
+
+    def add(self, n):
+        """Add n new labels, each in a set of its own."""
+        start = len(self._parent)
+        self._parent.extend( xrange(start, start + n) )
+
+    def find(self, label):
+        parent = self._parent
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a != b:
+            # the smaller label becomes the representative
+            self._parent[max(a, b)] = min(a, b)
+
+    def consecutive_lut(self):
+        """Return a lookup table from each label to the consecutive
+        number (starting at 1) of its set."""
+        parent = numpy.array( self._parent, dtype=numpy.uint32 )
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+        _, lut = numpy.unique( parent, return_inverse=True )
+        return lut.astype(numpy.uint32)
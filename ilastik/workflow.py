@@ -108,6 +108,20 @@ class Workflow( Operator ):
     def postprocessClusterSubResult(self, roi, result, blockwise_fileset):
         pass
 
+    def handleBatchJob(self, job_args):
+        """
+        Called by the headless prediction service (see 
+        ilastik.shell.headless.predictionService) for each job it receives.
+        job_args is a list of command-line arguments, like those of a 
+        headless batch run (input files and export settings), which 
+        replace the batch inputs of the previous job.
+        
+        Returns a list with one dict per exported result, with (at least) 
+        the keys 'output' (the export path) and 'seconds'.
+        Workflows that can be served must reimplement this method.
+        """
+        raise NotImplementedError( "{} does not support batch jobs".format( self.workflowName ) )
+
     ##################
     # Public methods #
     ##################
@@ -0,0 +1,139 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Watershed supervoxels for volumes that don't fit into RAM.
+
+Each block is segmented together with a halo. Only the labels inside the
+block itself are kept, and the labels that the halo sees in the
+preceding neighbor blocks are used to merge the supervoxels which were
+cut at the block seams.
+"""
+import numpy
+import vigra
+
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
+
+from ilastik.utility.unionFind import UnionFind
+
+import logging
+logger = logging.getLogger(__name__)
+
+def watershed_labels(volume, is3d=True):
+    """Unseeded watershed of a 3D (x,y,z) volume, as used for carving.
+
+    3D volumes are converted to uint8 first. Of 2D volumes
+    (is3d=False), only the first z-slice is segmented.
+
+    Returns (labels, max_label).
+    """
+    if is3d:
+        labels, max_label = vigra.analysis.watersheds(volume.astype(numpy.uint8))
+    else:
+        labels, max_label = vigra.analysis.watersheds(numpy.asarray(volume[:,:,0], numpy.float32))
+        labels = labels[:,:,numpy.newaxis]
+    return numpy.asarray(labels, numpy.uint32), max_label
+
+def _best_matches(groups, counts):
+    """Return a boolean mask that selects, for each value in groups,
+    the entry with the largest count."""
+    order = numpy.lexsort( (-counts, groups) )
+    first = numpy.ones( len(order), dtype=bool )
+    first[1:] = groups[order][1:] != groups[order][:-1]
+    best = numpy.zeros( len(order), dtype=bool )
+    best[order[first]] = True
+    return best
+
+def seam_matches(halo_labels, neighbor_labels):
+    """Match the labels a block's halo sees inside its neighbor block
+    with the labels the neighbor block was segmented into.
+
+    Two labels are matched if each one is the label that the other one
+    overlaps most, labels 0 are ignored.
+
+    Returns two arrays (halo label, neighbor label) of the matched pairs.
+    """
+    a = numpy.asarray(halo_labels, numpy.uint64).ravel()
+    b = numpy.asarray(neighbor_labels, numpy.uint64).ravel()
+    mask = (a > 0) & (b > 0)
+    if not mask.any():
+        return numpy.zeros((0,), numpy.uint64), numpy.zeros((0,), numpy.uint64)
+    pairs, inverse = numpy.unique( (a[mask] << numpy.uint64(32)) | b[mask], return_inverse=True )
+    counts = numpy.bincount( inverse )
+    halo_ids = pairs >> numpy.uint64(32)
+    neighbor_ids = pairs & numpy.uint64(0xffffffff)
+    mutual = _best_matches( halo_ids, counts ) & _best_matches( neighbor_ids, counts )
+    return halo_ids[mutual], neighbor_ids[mutual]
+
+def blockwise_watershed(read_volume, labels, block_shape, halo, is3d=True):
+    """Segment a volume into watershed supervoxels block by block.
+
+    :param read_volume: function read_volume(start, stop) that returns
+        the (x,y,z) subvolume to segment
+    :param labels: writable (x,y,z) uint32 array or h5py dataset that
+        receives the supervoxel labels of each block, before merging
+    :param block_shape: (x,y,z) block shape
+    :param halo: number of voxels each block is extended by
+    :returns: the lookup table that maps the labels written to 'labels'
+        to consecutive, merged supervoxel labels
+
+    Only one block (with its halo) is held in memory at a time. Blocks
+    are processed in raster order, so that the labels of the preceding
+    neighbors are already stored when a block's seams are merged.
+    """
+    shape = labels.shape
+    block_shape = tuple(block_shape)
+    union_find = UnionFind()
+    block_starts = sorted( map( tuple, getIntersectingBlocks( block_shape, ((0,)*len(shape), shape) ) ) )
+    for block_start in block_starts:
+        core_start, core_stop = map( numpy.array, getBlockBounds( shape, block_shape, block_start ) )
+        ext_start = numpy.maximum( numpy.subtract(core_start, halo), 0 )
+        ext_stop = numpy.minimum( numpy.add(core_stop, halo), shape )
+
+        ext_labels, max_label = watershed_labels( read_volume(ext_start, ext_stop), is3d )
+
+        # Number the labels that occur in the block itself consecutively,
+        # after the labels of all preceding blocks.
+        core_labels = ext_labels[ roiToSlice( core_start - ext_start, core_stop - ext_start ) ]
+        present = numpy.unique( core_labels )
+        present = present[present > 0]
+        offset = len(union_find)
+        local_lut = numpy.zeros( (max_label + 1,), dtype=numpy.uint32 )
+        local_lut[present] = numpy.arange( offset, offset + len(present), dtype=numpy.uint32 )
+        union_find.add( len(present) )
+        labels[ roiToSlice( core_start, core_stop ) ] = local_lut[core_labels]
+
+        # Merge with the preceding neighbor along each axis.
+        for axis in range(len(shape)):
+            if core_start[axis] == 0:
+                continue
+            strip_start = core_start.copy()
+            strip_stop = core_stop.copy()
+            strip_start[axis] = ext_start[axis]
+            strip_stop[axis] = core_start[axis]
+            halo_labels = local_lut[ ext_labels[ roiToSlice( strip_start - ext_start, strip_stop - ext_start ) ] ]
+            neighbor_labels = labels[ roiToSlice( strip_start, strip_stop ) ]
+            for a, b in zip( *seam_matches( halo_labels, neighbor_labels ) ):
+                union_find.union( int(a), int(b) )
+
+    lut = union_find.consecutive_lut()
+    logger.info( "Blockwise watershed: {} supervoxels in {} blocks, {} after merging"
+                 .format( len(lut) - 1, len(block_starts), lut.max() ) )
+    return lut
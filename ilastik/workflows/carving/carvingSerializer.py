@@ -22,6 +22,7 @@ from ilastik.applets.base.appletSerializer import AppletSerializer, getOrCreateG
 import numpy
 
 from lazyflow.roi import roiFromShape, roiToSlice
+from watershed_segmentor import createCompressedDataset
 
 import logging
 logger = logging.getLogger(__name__)
@@ -36,7 +37,13 @@ class CarvingSerializer( AppletSerializer ):
         obj = getOrCreateGroup(topGroup, "objects")
         for imageIndex, opCarving in enumerate( self._o.innerOperators ):
             mst = opCarving._mst 
-            for name in opCarving._dirtyObjects:
+
+            # Only changed objects are written. Objects the file doesn't
+            # have yet (e.g. a new snapshot file) are written, too.
+            names = set(opCarving._dirtyObjects)
+            if mst is not None:
+                names.update( name for name in mst.object_seeds_fg_voxels if name not in obj )
+            for name in sorted(names):
                 logger.info( "[CarvingSerializer] serializing %s" % name )
                
                 if name in obj and name in mst.object_seeds_fg_voxels: 
@@ -62,12 +69,12 @@ class CarvingSerializer( AppletSerializer ):
                 v = mst.object_seeds_fg_voxels[name]
                 v = [v[i][:,numpy.newaxis] for i in range(3)]
                 v = numpy.concatenate(v, axis=1)
-                g.create_dataset("fg_voxels", data=v)
+                createCompressedDataset(g, "fg_voxels", v)
                 v = mst.object_seeds_bg_voxels[name]
                 v = [v[i][:,numpy.newaxis] for i in range(3)]
                 v = numpy.concatenate(v, axis=1)
-                g.create_dataset("bg_voxels", data=v)
-                g.create_dataset("sv", data=mst.object_lut[name])
+                createCompressedDataset(g, "bg_voxels", v)
+                createCompressedDataset(g, "sv", mst.object_lut[name])
                 
                 d1 = numpy.asarray(mst.bg_priority[name], dtype=numpy.float32)
                 d2 = numpy.asarray(mst.no_bias_below[name], dtype=numpy.int32)
@@ -87,12 +94,12 @@ class CarvingSerializer( AppletSerializer ):
             if fg_voxels[0].shape[0] > 0:
                 v = [fg_voxels[i][:,numpy.newaxis] for i in range(3)]
                 v = numpy.concatenate(v, axis=1)
-                topGroup.create_dataset("fg_voxels", data = v)
+                createCompressedDataset(topGroup, "fg_voxels", v)
 
             if bg_voxels[0].shape[0] > 0:
                 v = [bg_voxels[i][:,numpy.newaxis] for i in range(3)]
                 v = numpy.concatenate(v, axis=1)
-                topGroup.create_dataset("bg_voxels", data = v)
+                createCompressedDataset(topGroup, "bg_voxels", v)
 
             logger.info( "saved seeds" )
         
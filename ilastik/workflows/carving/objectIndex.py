@@ -0,0 +1,107 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+def supervoxelIds(objectSupervoxels):
+    """
+    The supervoxel ids of an entry of WatershedSegmentor.object_lut, which
+    is either an array or the result of numpy.where() on a supervoxel lut.
+    """
+    return numpy.asarray(objectSupervoxels).ravel()
+
+class SupervoxelObjectIndex(object):
+    """
+    Inverted index from supervoxel ids to the names of the carved objects
+    that contain them, together with the lookup tables of the 'done'
+    objects (all saved objects except the one currently being edited):
+
+    done_lut[sv]      number of done objects that contain supervoxel sv
+    done_seg_lut[sv]  object number of a done object that contains sv, or 0
+
+    update() brings the index in sync with a WatershedSegmentor's
+    object_lut. Only objects that were added, removed or replaced (i.e.
+    their object_lut entry is a different array) since the last call are
+    processed, so saving or deleting an object doesn't touch all others.
+    """
+    def __init__(self, numNodes):
+        self.done_lut = numpy.zeros(numNodes+1, dtype=numpy.int32)
+        self.done_seg_lut = numpy.zeros(numNodes+1, dtype=numpy.int32)
+        # supervoxel id -> set of object names
+        self._names = {}
+        # object name -> (object_lut entry, supervoxel ids)
+        self._objects = {}
+        # done object name -> (supervoxel ids, object number)
+        self._done = {}
+
+    def names(self, sv):
+        """The names of all objects that contain supervoxel sv."""
+        return sorted(self._names.get(int(sv), ()))
+
+    def update(self, object_lut, object_names, exclude=None):
+        """
+        Apply all changes of object_lut and object_names since the last
+        update. The object named 'exclude' is not counted as done.
+        """
+        for name, (objectSupervoxels, ids) in self._objects.items():
+            if object_lut.get(name) is not objectSupervoxels:
+                self._removeObject(name, ids)
+        for name, objectSupervoxels in object_lut.iteritems():
+            if name not in self._objects:
+                self._addObject(name, objectSupervoxels)
+
+        for name, (ids, objNr) in self._done.items():
+            if name == exclude or name not in self._objects or self._objects[name][1] is not ids \
+                    or object_names.get(name) != objNr:
+                self._removeDone(name)
+        for name, (_, ids) in self._objects.iteritems():
+            if name != exclude and name not in self._done:
+                assert name in object_names, "%s not in object_names, keys are %r" % (name, object_names.keys())
+                self._addDone(name, ids, object_names[name])
+
+    def _addObject(self, name, objectSupervoxels):
+        ids = supervoxelIds(objectSupervoxels)
+        for sv in ids.tolist():
+            self._names.setdefault(sv, set()).add(name)
+        self._objects[name] = (objectSupervoxels, ids)
+
+    def _removeObject(self, name, ids):
+        for sv in ids.tolist():
+            names = self._names[sv]
+            names.discard(name)
+            if not names:
+                del self._names[sv]
+        del self._objects[name]
+
+    def _addDone(self, name, ids, objNr):
+        self.done_lut[ids] += 1
+        self.done_seg_lut[ids] = objNr
+        self._done[name] = (ids, objNr)
+
+    def _removeDone(self, name):
+        ids, objNr = self._done.pop(name)
+        self.done_lut[ids] -= 1
+        self.done_seg_lut[ids] = 0
+        # Supervoxels that are still covered by other done objects
+        for sv in ids[self.done_lut[ids] > 0].tolist():
+            for other in self._names.get(sv, ()):
+                if other in self._done:
+                    self.done_seg_lut[sv] = self._done[other][1]
+                    break
@@ -34,6 +34,7 @@ from lazyflow.operators.valueProviders import OpValueCache
 #ilastik
 from lazyflow.utility.timer import Timer
 from ilastik.applets.base.applet import DatasetConstraintError
+from objectIndex import SupervoxelObjectIndex
 
 
 import logging
@@ -124,6 +125,9 @@ class OpCarving(Operator):
         #supervoxels of finished and saved objects
         self._done_lut = None
         self._done_seg_lut = None
+        #supervoxel -> object names, kept in sync with self._mst.object_lut
+        self._objectIndex = None
+        self._objectIndexMst = None
         self._hints = None
         self._pmap = None
         if hintOverlayFile is not None:
@@ -193,24 +197,29 @@ class OpCarving(Operator):
         self._currObjectName = n
         self.CurrentObjectName.setValue(n)
 
+    def _updateObjectIndex(self):
+        """
+        Applies the changes of the saved objects since the last call to
+        the supervoxel index, or builds it anew for a new MST.
+        """
+        if self._objectIndex is None or self._objectIndexMst is not self._mst:
+            self._objectIndex = SupervoxelObjectIndex(self._mst.numNodes)
+            self._objectIndexMst = self._mst
+        self._objectIndex.update(self._mst.object_lut, self._mst.object_names, exclude=self._currObjectName)
+
     def _buildDone(self):
         """
-        Builds the done segmentation anew, for example after saving an object or
+        Updates the done segmentation, for example after saving an object or
         deleting an object.
         """
         if self._mst is None:
             return
         with Timer() as timer:
-            self._done_lut = numpy.zeros(self._mst.numNodes+1, dtype=numpy.int32)
-            self._done_seg_lut = numpy.zeros(self._mst.numNodes+1, dtype=numpy.int32)
-            logger.info( "building 'done' luts" )
-            for name, objectSupervoxels in self._mst.object_lut.iteritems():
-                if name == self._currObjectName:
-                    continue
-                self._done_lut[objectSupervoxels] += 1
-                assert name in self._mst.object_names, "%s not in self._mst.object_names, keys are %r" % (name, self._mst.object_names.keys())
-                self._done_seg_lut[objectSupervoxels] = self._mst.object_names[name]
-        logger.info( "building the 'done' luts took {} seconds".format( timer.seconds() ) )
+            logger.info( "updating 'done' luts" )
+            self._updateObjectIndex()
+            self._done_lut = self._objectIndex.done_lut
+            self._done_seg_lut = self._objectIndex.done_seg_lut
+        logger.info( "updating the 'done' luts took {} seconds".format( timer.seconds() ) )
     
     def dataIsStorable(self):
         if self._mst is None:
@@ -290,10 +299,8 @@ class OpCarving(Operator):
 
         #find the supervoxel that was clicked
         sv = self._mst.supervoxelUint32[position3d]
-        names = []
-        for name, objectSupervoxels in self._mst.object_lut.iteritems():
-            if numpy.sum(sv == objectSupervoxels) > 0:
-                names.append(name)
+        self._updateObjectIndex()
+        names = self._objectIndex.names(sv)
         logger.info( "click on %r, supervoxel=%d: %r" % (position3d, sv, names) )
         return names
 
@@ -19,19 +19,25 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 #Python
+import os
 import sys
+import tempfile
 
 #SciPy
 import numpy
 import vigra
+import h5py
 
 #lazyflow
-from lazyflow.roi import roiFromShape
+from lazyflow.roi import roiFromShape, roiToSlice, determineBlockShape, getIntersectingBlocks, getBlockBounds
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators import OpArrayCache
+from lazyflow.request import RequestLock
 
 from lazyflow.utility.timer import Timer
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.utility.ramBudget import ramBudgetBytes
+from blockwiseWatershed import watershed_labels, blockwise_watershed
 
 #carving Cython module
 from watershed_segmentor import WatershedSegmentor
@@ -39,6 +45,29 @@ from watershed_segmentor import WatershedSegmentor
 import logging
 logger = logging.getLogger(__name__)
 
+# Preprocessing works on blocks that need at most this fraction of the
+# RAM budget, assuming BYTES_PER_VOXEL for the filter and watershed
+# temporaries (the Hessian alone takes 6 float32 channels).
+RAM_FRACTION = 0.1
+BYTES_PER_VOXEL = 64
+
+def preprocessingBlockShape(shape):
+    """
+    Return the (t,x,y,z,c) block shape for preprocessing a volume of the
+    given shape, which is the whole volume if it fits into the budget.
+    """
+    max_voxels = max( 1, ramBudgetBytes(RAM_FRACTION) // BYTES_PER_VOXEL )
+    if numpy.prod(shape) <= max_voxels:
+        return tuple(shape)
+    spatial = determineBlockShape( shape[1:4], max_voxels )
+    return (1,) + tuple(spatial) + (1,)
+
+def _spatialRoi(start, stop, halo, shape):
+    """Extend a (x,y,z) roi by halo, clipped to the volume shape."""
+    ext_start = numpy.maximum( numpy.subtract(start, halo), 0 )
+    ext_stop = numpy.minimum( numpy.add(stop, halo), shape )
+    return ext_start, ext_stop
+
 class OpFilter(Operator):
     HESSIAN_BRIGHT = 0
     HESSIAN_DARK = 1
@@ -52,6 +81,9 @@ class OpFilter(Operator):
     
     Output = OutputSlot()
 
+    # Blocks are filtered with a halo of WINDOW_SIZE * sigma
+    WINDOW_SIZE = 3.5
+
     def setupOutputs(self):
         self.Output.meta.assignFrom( self.Input.meta )
         self.Output.meta.dtype = numpy.float32
@@ -66,46 +98,59 @@ class OpFilter(Operator):
             assert ax[i].isSpatial()
         assert ax[4].key == "c" and sh[4] == 1
         
-        volume5d = self.Input.value
+        # Filter the requested block together with a halo
         sigma = self.Sigma.value
+        halo = int( numpy.ceil( self.WINDOW_SIZE * sigma ) ) + 1
+        start, stop = roi.start[1:4], roi.stop[1:4]
+        ext_start, ext_stop = _spatialRoi( start, stop, halo, sh[1:4] )
+        volume5d = self.Input( (0,) + tuple(ext_start) + (0,), (1,) + tuple(ext_stop) + (1,) ).wait()
         volume = volume5d[0,:,:,:,0]
-        result_view = result[0,:,:,:,0]
         
         logger.info( "input volume shape: %r" %  (volume.shape,) )
         logger.info( "input volume size: %r MB", (volume.nbytes / 1024**2,) )
         fvol = numpy.asarray(volume, numpy.float32)
 
-        #Choose filter selected by user
-        volume_filter = self.Filter.value
+        volume_feat = self._filter( fvol, self.Filter.value, sigma, sh[3] > 1 )
+        result[0,:,:,:,0] = volume_feat[ roiToSlice( numpy.subtract(start, ext_start), numpy.subtract(stop, ext_start) ) ]
+        return result
+
+    @classmethod
+    def _filter(cls, fvol, volume_filter, sigma, is3d):
+        """
+        Apply the chosen filter to a float32 (x,y,z) volume.
 
+        Unlike in previous versions, the bright Hessian response is not
+        shifted by the maximum of the volume (which can't be known for a 
+        single block). The result only ever gets normalized, so this makes 
+        no difference.
+        """
         logger.info( "applying filter on shape = %r" % (fvol.shape,) )
         with Timer() as filterTimer:        
-            if fvol.shape[2] > 1:
+            if is3d:
                 # true 3D volume
                 if volume_filter == OpFilter.HESSIAN_BRIGHT:
                     logger.info( "lowest eigenvalue of Hessian of Gaussian" )
                     options = vigra.blockwise.BlockwiseConvolutionOptions3D()
                     options.stdDev = (sigma, )*3 
-                    result_view[...] = vigra.blockwise.hessianOfGaussianLastEigenvalue(fvol,options)[:,:,:]
-                    result_view[:] = numpy.max(result_view) - result_view
+                    volume_feat = -vigra.blockwise.hessianOfGaussianLastEigenvalue(fvol,options)[:,:,:]
                 
                 elif volume_filter == OpFilter.HESSIAN_DARK:
                     logger.info( "greatest eigenvalue of Hessian of Gaussian" )
                     options = vigra.blockwise.BlockwiseConvolutionOptions3D()
                     options.stdDev = (sigma, )*3 
-                    result_view[...] = vigra.blockwise.hessianOfGaussianFirstEigenvalue(fvol,options)[:,:,:]
+                    volume_feat = vigra.blockwise.hessianOfGaussianFirstEigenvalue(fvol,options)[:,:,:]
                      
                 elif volume_filter == OpFilter.STEP_EDGES:
                     logger.info( "Gaussian Gradient Magnitude" )
-                    result_view[...] = vigra.filters.gaussianGradientMagnitude(fvol,sigma)
+                    volume_feat = vigra.filters.gaussianGradientMagnitude(fvol,sigma)
                     
                 elif volume_filter == OpFilter.RAW:
                     logger.info( "Gaussian Smoothing" )
-                    result_view[...] = vigra.filters.gaussianSmoothing(fvol,sigma)
+                    volume_feat = vigra.filters.gaussianSmoothing(fvol,sigma)
                     
                 elif volume_filter == OpFilter.RAW_INVERTED:
                     logger.info( "negative Gaussian Smoothing" )
-                    result_view[...] = vigra.filters.gaussianSmoothing(-fvol,sigma)
+                    volume_feat = vigra.filters.gaussianSmoothing(-fvol,sigma)
 
                 logger.info( "Filter took {} seconds".format( filterTimer.seconds() ) )
             else:
@@ -113,8 +158,7 @@ class OpFilter(Operator):
                 fvol = fvol[:,:,0]
                 if volume_filter == OpFilter.HESSIAN_BRIGHT:
                     logger.info( "lowest eigenvalue of Hessian of Gaussian" )
-                    volume_feat = vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,1]
-                    volume_feat[:] = numpy.max(volume_feat) - volume_feat
+                    volume_feat = -vigra.filters.hessianOfGaussianEigenvalues(fvol,sigma)[:,:,1]
                 
                 elif volume_filter == OpFilter.HESSIAN_DARK:
                     logger.info( "greatest eigenvalue of Hessian of Gaussian" )
@@ -132,9 +176,9 @@ class OpFilter(Operator):
                     logger.info( "negative Gaussian Smoothing" )
                     volume_feat = vigra.filters.gaussianSmoothing(-fvol,sigma)
 
-                result_view[:,:,0] = volume_feat
+                volume_feat = volume_feat[:,:,numpy.newaxis]
                 logger.info( "Filter took {} seconds".format( filterTimer.seconds() ) )
-        return result
+        return volume_feat
 
     def propagateDirty(self, slot, subindex, roi):
         self.Output.setDirty(slice(None))
@@ -143,14 +187,36 @@ class OpNormalize255(Operator):
     Input = InputSlot()
     Output = OutputSlot()
 
+    def __init__(self, *args, **kwargs):
+        super(OpNormalize255, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        self._extrema = None
+
     def setupOutputs(self):
         self.Output.meta.assignFrom( self.Input.meta )
+        self._extrema = None
     
+    def _getExtrema(self):
+        """
+        The minimum and maximum of the whole input, computed block by block.
+        """
+        with self._lock:
+            if self._extrema is None:
+                shape = self.Input.meta.shape
+                block_shape = preprocessingBlockShape( shape )
+                volume_min, volume_max = numpy.inf, -numpy.inf
+                for block_start in getIntersectingBlocks( block_shape, roiFromShape(shape) ):
+                    block = self.Input( *getBlockBounds( shape, block_shape, block_start ) ).wait()
+                    volume_min = min( volume_min, numpy.min(block) )
+                    volume_max = max( volume_max, numpy.max(block) )
+                self._extrema = (volume_min, volume_max)
+            return self._extrema
+
     def execute(self, slot, subindex, roi, result):
+        volume_min, volume_max = self._getExtrema()
+
         # Save memory: use result as a temporary
         self.Input( roi.start, roi.stop ).writeInto(result).wait()
-        volume_max = numpy.max(result)
-        volume_min = numpy.min(result)
 
         # result[...] = (result - volume_min) * 255.0 / (volume_max-volume_min)
         # Avoid temporaries...
@@ -160,39 +226,93 @@ class OpNormalize255(Operator):
         return result
 
     def propagateDirty(self, slot, subindex, roi):
-        self.Output.setDirty(roi.start, roi.stop)
+        # The normalization depends on the whole volume
+        self._extrema = None
+        self.Output.setDirty(slice(None))
 
 class OpSimpleWatershed(Operator):
+    """
+    Watershed supervoxels of the whole volume.
+
+    Volumes that don't fit into a single preprocessing block are segmented
+    block by block (see blockwiseWatershed). The labels are then kept in
+    a compressed scratch file, and only relabeled when they are requested.
+    """
     Input = InputSlot()
     Output = OutputSlot()
 
+    # Each block is segmented with this many voxels of context
+    HALO = 16
+
+    def __init__(self, *args, **kwargs):
+        super(OpSimpleWatershed, self).__init__(*args, **kwargs)
+        self._lock = RequestLock()
+        self._labels = None
+        self._lut = None
+        self._scratchFile = None
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.Input.meta)
         self.Output.meta.dtype = numpy.uint32
+        self._resetLabels()
 
     def execute(self, slot, subindex, roi, result):
-        assert roi.stop - roi.start == self.Output.meta.shape, "Watershed must be run on the entire volume."
-        input_image = self.Input(roi.start, roi.stop).wait()
-        volume_feat = input_image[0,...,0]
-        result_view = result[0,...,0]
-        with Timer() as watershedTimer:
-            if self.Input.meta.getTaggedShape()['z'] > 1:
-                sys.stdout.write("Watershed..."); sys.stdout.flush()
-                #result_view[...] = vigra.analysis.watersheds(volume_feat[:,:])[0].astype(numpy.int32)
-                result_view[...] = vigra.analysis.watersheds(volume_feat[:,:].astype(numpy.uint8))[0]
-                logger.info( "done {}".format(numpy.max(result[...]) ) )
-            else:
-                sys.stdout.write("Watershed..."); sys.stdout.flush()
-                
-                labelVolume = vigra.analysis.watersheds(volume_feat[:,:,0])[0]#.view(dtype=numpy.int32)
-                result_view[...] = labelVolume[:,:,numpy.newaxis]
-                logger.info( "done {}".format(numpy.max(labelVolume)) )
-
-        logger.info( "Watershed took {} seconds".format( watershedTimer.seconds() ) )
+        labels, lut = self._getLabels()
+        block_labels = labels[ roiToSlice( roi.start[1:4], roi.stop[1:4] ) ]
+        if lut is not None:
+            block_labels = numpy.take( lut, block_labels )
+        result[0,...,0] = block_labels
         return result
 
+    def _getLabels(self):
+        with self._lock:
+            if self._labels is None:
+                with Timer() as watershedTimer:
+                    self._computeLabels()
+                logger.info( "Watershed took {} seconds".format( watershedTimer.seconds() ) )
+            return self._labels, self._lut
+
+    def _computeLabels(self):
+        shape = self.Input.meta.shape
+        is3d = self.Input.meta.getTaggedShape()['z'] > 1
+        block_shape = preprocessingBlockShape( shape )
+        sys.stdout.write("Watershed..."); sys.stdout.flush()
+
+        if block_shape == tuple(shape):
+            input_image = self.Input( *roiFromShape(shape) ).wait()
+            self._labels, max_label = watershed_labels( input_image[0,...,0], is3d )
+            self._lut = None
+            logger.info( "done {}".format( max_label ) )
+            return
+
+        fd, path = tempfile.mkstemp( prefix='ilastik-watershed-', suffix='.h5' )
+        os.close(fd)
+        self._scratchFile = h5py.File( path, 'w' )
+        labels = self._scratchFile.create_dataset( 'labels', shape=shape[1:4], dtype=numpy.uint32,
+                                                   chunks=True, compression='lzf' )
+        def read_volume(start, stop):
+            return self.Input( (0,) + tuple(start) + (0,), (1,) + tuple(stop) + (1,) ).wait()[0,...,0]
+        self._lut = blockwise_watershed( read_volume, labels, block_shape[1:4], self.HALO, is3d )
+        self._labels = labels
+        logger.info( "done {}".format( self._lut.max() ) )
+
+    def _resetLabels(self):
+        with self._lock:
+            self._labels = None
+            self._lut = None
+            if self._scratchFile is not None:
+                path = self._scratchFile.filename
+                self._scratchFile.close()
+                os.remove( path )
+                self._scratchFile = None
+
     def propagateDirty(self, slot, subindex, roi):
+        self._resetLabels()
         self.Output.setDirty(slice(None))
+
+    def cleanUp(self):
+        self._resetLabels()
+        super(OpSimpleWatershed, self).cleanUp()
     
 class OpMstSegmentorProvider(Operator):
     Image = InputSlot()
@@ -359,7 +479,8 @@ class OpPreprocessing(Operator):
         self.PreprocessedData.meta.shape = (1,)
         self.PreprocessedData.meta.dtype = object
 
-        self._opFilterCache.blockShape.setValue( self.InputData.meta.shape )
+        block_shape = preprocessingBlockShape( self.InputData.meta.shape )
+        self._opFilterCache.blockShape.setValue( block_shape )
         self._opFilterCache.Input.connect( self._opFilterNormalize.Output )
 
         # If the user's boundaries are dark, then invert the special watershed sources
@@ -383,12 +504,12 @@ class OpPreprocessing(Operator):
         else:
             assert False, "Unknown Watershed source option: {}".format( ws_source )
 
-        self._opWatershedSourceCache.blockShape.setValue( self.InputData.meta.shape )
+        self._opWatershedSourceCache.blockShape.setValue( block_shape )
         self._opWatershedSourceCache.Input.connect( self._opWatershed.Input )
 
         self.WatershedSourceImage.connect( self._opWatershedSourceCache.Output )
 
-        self._opWatershedCache.blockShape.setValue( self._opWatershed.Output.meta.shape )
+        self._opWatershedCache.blockShape.setValue( block_shape )
         self._opWatershedCache.Input.connect( self._opWatershed.Output )
 
 
@@ -3,6 +3,23 @@ from vigra import graphs as vgraph
 #from vigra import ilastiktools
 import ilastiktools
 import numpy
+import h5py
+import uuid
+
+# Chunk shape of the supervoxel labels in project files
+LABELS_CHUNK_SHAPE = (64, 64, 64)
+
+def createCompressedDataset(group, name, data, chunks=True):
+    """
+    Replace group[name] by a chunked, gzip-compressed dataset. 
+    (Empty arrays can't be chunked, they are stored as they are.)
+    """
+    if name in group:
+        del group[name]
+    data = numpy.asarray(data)
+    if data.size == 0:
+        return group.create_dataset(name, data=data)
+    return group.create_dataset(name, data=data, chunks=chunks, compression=1, shuffle=True)
 
 
 class WatershedSegmentor(object):
@@ -30,9 +47,13 @@ class WatershedSegmentor(object):
             self.numNodes = self.nodeNum
        
             self.hasSeg = False
+            # identifies the supervoxels and graph, see saveH5G()
+            self.graphId = uuid.uuid4().hex
         else:
             self.numNodes = h5file.attrs["numNodes"]
             self.nodeNum = self.numNodes
+            # Older projects don't have an id, saving them rewrites the graph once
+            self.graphId = h5file.attrs.get("graphId", uuid.uuid4().hex)
             self.supervoxelUint32 = h5file['labels'][:]
 
             self.gridSegmentor = ilastiktools.GridSegmentor_3D_UInt32()
@@ -89,17 +110,29 @@ class WatershedSegmentor(object):
         self.saveH5G(h5g)
 
     def saveH5G(self, h5g):
+        """
+        Save the segmentor to the given group. 
 
+        The supervoxel labels and the graph don't change after preprocessing,
+        so they are only written if the group doesn't hold them already.
+        Everything is stored chunked and compressed.
+        """
         g = h5g
-
-        g.attrs["numNodes"] = self.numNodes
-        g.create_dataset("labels", data = self.supervoxelUint32)
-
         gridSeg = self.gridSegmentor
-        g.create_dataset("graph", data = gridSeg.serializeGraph())
-        g.create_dataset("edgeWeights", data = gridSeg.getEdgeWeights())
-        g.create_dataset("nodeSeeds", data = gridSeg.getNodeSeeds())
-        g.create_dataset("resultSegmentation", data = gridSeg.getResultSegmentation())
+
+        if g.attrs.get("graphId") != self.graphId or \
+           not all(name in g for name in ("labels", "graph", "edgeWeights")):
+            if "graphId" in g.attrs:
+                del g.attrs["graphId"]
+            g.attrs["numNodes"] = self.numNodes
+            chunks = tuple(min(c, s) for c, s in zip(LABELS_CHUNK_SHAPE, self.supervoxelUint32.shape))
+            createCompressedDataset(g, "labels", self.supervoxelUint32, chunks)
+            createCompressedDataset(g, "graph", gridSeg.serializeGraph())
+            createCompressedDataset(g, "edgeWeights", gridSeg.getEdgeWeights())
+            g.attrs["graphId"] = self.graphId
+
+        createCompressedDataset(g, "nodeSeeds", gridSeg.getNodeSeeds())
+        createCompressedDataset(g, "resultSegmentation", gridSeg.getResultSegmentation())
         
         g.file.flush()
 
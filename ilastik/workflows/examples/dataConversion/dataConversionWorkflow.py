@@ -24,9 +24,11 @@ logger = logging.getLogger(__name__)
 
 from lazyflow.roi import TinyVector
 from lazyflow.graph import Graph
+from lazyflow.utility import PathComponents
 from ilastik.workflow import Workflow
 from ilastik.applets.dataSelection import DataSelectionApplet
 from ilastik.applets.dataExport.dataExportApplet import DataExportApplet
+from ilastik.utility.batchExportScheduler import BatchExportScheduler, slot_nbytes
 
 class DataConversionWorkflow(Workflow):
     """
@@ -109,20 +111,28 @@ class DataConversionWorkflow(Workflow):
         if self._headless and self._data_input_args and self._data_export_args:
             # Now run the export and report progress....
             opDataExport = self.dataExportApplet.topLevelOperator
-            for i, opExportDataLaneView in enumerate(opDataExport):
-                logger.info( "Exporting file #{} to {}".format(i, opExportDataLaneView.ExportPath.value) )
-    
-                sys.stdout.write( "Result #{}/{} Progress: ".format( i, len( opDataExport ) ) )
-                def print_progress( progress ):
-                    sys.stdout.write( "{} ".format( progress ) )
-    
-                # If the operator provides a progress signal, use it.
-                slotProgressSignal = opExportDataLaneView.progressSignal
-                slotProgressSignal.subscribe( print_progress )
+
+            def export_lane(lane_index):
+                opExportDataLaneView = opDataExport.getLane(lane_index)
+                logger.info( "Exporting file #{} to {}".format(lane_index, opExportDataLaneView.ExportPath.value) )
                 opExportDataLaneView.run_export()
-                
-                # Finished.
-                sys.stdout.write("\n")
+
+            def lane_nbytes(lane_index):
+                return slot_nbytes( opDataExport.getLane(lane_index).ImageToExport )
+
+            def lane_output_file(lane_index):
+                return PathComponents( opDataExport.getLane(lane_index).ExportPath.value ).externalPath
+
+            sys.stdout.write( "Exporting {} files. Progress: ".format( len( opDataExport ) ) )
+            def print_progress( progress ):
+                sys.stdout.write( "{} ".format( progress ) )
+
+            scheduler = BatchExportScheduler( self._data_export_args.parallel_exports )
+            scheduler.progressSignal.subscribe( print_progress )
+            scheduler.run( range( len( opDataExport ) ), export_lane, lane_nbytes, lane_output_file=lane_output_file )
+
+            # Finished.
+            sys.stdout.write("\n")
 
     def connectLane(self, laneIndex):
         opDataSelectionView = self.dataSelectionApplet.topLevelOperator.getLane(laneIndex)
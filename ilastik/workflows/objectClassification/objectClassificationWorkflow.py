@@ -476,10 +476,8 @@ class ObjectClassificationWorkflow(Workflow):
         region_features_dict = region_features.flat[0]
         region_centers = region_features_dict['Default features']['RegionCenter']
 
-        opBlockPipeline = opBatchClassify._blockPipelines[ tuple(roi[0]) ]
-
         # Compute the block offset within the image coordinates
-        halo_roi = opBlockPipeline._halo_roi
+        halo_roi = opBatchClassify.get_halo_roi( tuple(roi[0]) )
 
         translated_region_centers = region_centers + halo_roi[0][1:-1]
 
@@ -495,7 +493,7 @@ class ObjectClassificationWorkflow(Workflow):
         # Remove all 'negative' predictions, emit only 'positive' predictions
         # FIXME: Don't hardcode this?
         POSITIVE_LABEL = 2
-        objectwise_predictions = opBlockPipeline.ObjectwisePredictions([]).wait()[0]
+        objectwise_predictions = opBatchClassify.get_objectwise_predictions( tuple(roi[0]) )[0]
         assert objectwise_predictions.shape == mask.shape
         mask[objectwise_predictions != POSITIVE_LABEL] = False
 
@@ -25,6 +25,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 import numpy
+import h5py
 
 from ilastik.config import cfg as ilastik_config
 
@@ -35,9 +36,11 @@ from ilastik.applets.projectMetadata import ProjectMetadataApplet
 from ilastik.applets.dataSelection import DataSelectionApplet
 from ilastik.applets.featureSelection import FeatureSelectionApplet
 
-from ilastik.applets.pixelClassification.opPixelClassification import OpPredictionPipelineNoCache
+from ilastik.applets.pixelClassification.opPixelClassification import OpPredictionPipelineNoCache, PREDICTION_PRODUCTS
+from ilastik.utility.batchExportScheduler import BatchExportScheduler, slot_nbytes
 
 from lazyflow.roi import TinyVector, fullSlicing
+from lazyflow.utility import PathComponents
 from lazyflow.graph import Graph, OperatorWrapper
 from lazyflow.operators.generic import OpTransposeSlots, OpSelectSubslot
 
@@ -76,6 +79,8 @@ class PixelClassificationWorkflow(Workflow):
         parser.add_argument('--random-label-value', help="The label value to use injecting random labels", default=1, type=int)
         parser.add_argument('--random-label-count', help="The number of random labels to inject via --generate-random-labels", default=2000, type=int)
         parser.add_argument('--retrain', help="Re-train the classifier based on labels stored in project file, and re-save.", action="store_true")
+        parser.add_argument('--export-products', help="Headless batch mode: Export these results together into one hdf5 file per input, predicting each block only once.", 
+                            nargs='+', choices=PREDICTION_PRODUCTS.keys())
 
         # Parse the creation args: These were saved to the project file when this project was first created.
         parsed_creation_args, unused_args = parser.parse_known_args(project_creation_args)
@@ -89,6 +94,7 @@ class PixelClassificationWorkflow(Workflow):
         self.random_label_value = parsed_args.random_label_value
         self.random_label_count = parsed_args.random_label_count
         self.retrain = parsed_args.retrain
+        self.export_products = parsed_args.export_products
 
         if parsed_args.filter and parsed_args.filter != parsed_creation_args.filter:
             logger.error("Ignoring new --filter setting.  Filter implementation cannot be changed after initial project creation.")
@@ -416,28 +422,101 @@ class PixelClassificationWorkflow(Workflow):
             projectManager.saveProject(force_all_save=False)
 
         if self._headless and self._batch_input_args and self._batch_export_args:
-            # Make sure we're using the up-to-date classifier.
-            self.pcApplet.topLevelOperator.FreezePredictions.setValue(False)
+            self._run_batch_export( self._batch_export_args.parallel_exports )
+
+    def handleBatchJob(self, job_args):
+        """
+        Overridden from Workflow base class.  Called by the prediction service.
         
-            # Now run the batch export and report progress....
-            opBatchDataExport = self.batchResultsApplet.topLevelOperator
-            for i, opExportDataLaneView in enumerate(opBatchDataExport):
-                logger.info( "Exporting result {} to {}".format(i, opExportDataLaneView.ExportPath.value) )
-    
-                sys.stdout.write( "Result {}/{} Progress: ".format( i, len( opBatchDataExport ) ) )
-                sys.stdout.flush()
-                def print_progress( progress ):
-                    sys.stdout.write( "{} ".format( progress ) )
-                    sys.stdout.flush()
+        Replaces the batch inputs with the ones given in job_args and exports 
+        their results.  The trained classifier (and everything else that 
+        doesn't depend on the batch inputs) is kept between jobs.
+        """
+        if self.batchInputApplet is None:
+            raise RuntimeError("This workflow was created without batch operators.")
+        input_args, unused_args = self.batchInputApplet.parse_known_cmdline_args( job_args )
+        export_args, unused_args = self.batchResultsApplet.parse_known_cmdline_args( unused_args )
+        if unused_args:
+            raise ValueError("Unsupported job arguments: {}".format( unused_args ))
+
+        # Drop the lanes of the previous job that aren't needed anymore.
+        # The others are reconfigured below.
+        opBatchInputs = self.batchInputApplet.topLevelOperator
+        num_lanes = len(input_args.input_files or input_args.raw_data or [])
+        opBatchInputs.DatasetGroup.resize( min(num_lanes, len(opBatchInputs.DatasetGroup)) )
+
+        self.batchInputApplet.configure_operator_with_parsed_args( input_args )
+        self.batchResultsApplet.configure_operator_with_parsed_args( export_args )
+        return self._run_batch_export( export_args.parallel_exports )
+
+    def _run_batch_export(self, parallel_exports=None):
+        """
+        Export the results of all batch lanes, several lanes at a time 
+        (at most parallel_exports, see BatchExportScheduler).
+        Returns a list of dicts with the export path, time and throughput of each result.
+        """
+        # Make sure we're using the up-to-date classifier.
+        self.pcApplet.topLevelOperator.FreezePredictions.setValue(False)
     
-                # If the operator provides a progress signal, use it.
-                slotProgressSignal = opExportDataLaneView.progressSignal
-                slotProgressSignal.subscribe( print_progress )
+        opBatchDataExport = self.batchResultsApplet.topLevelOperator
+
+        def export_lane(lane_index):
+            opExportDataLaneView = opBatchDataExport.getLane(lane_index)
+            logger.info( "Exporting result {} to {}".format(lane_index, opExportDataLaneView.ExportPath.value) )
+            if self.export_products:
+                self._export_products(lane_index, lambda progress: None)
+            else:
                 opExportDataLaneView.run_export()
-                
-                # Finished.
-                sys.stdout.write("\n")
 
+        def lane_ram_bytes(lane_index):
+            # The features are the largest intermediate result of a lane.
+            featureSlot = self.opBatchPredictionPipeline[lane_index].FeatureImages
+            return slot_nbytes( featureSlot ) if featureSlot.ready() else 0
+
+        def lane_output_bytes(lane_index):
+            return slot_nbytes( opBatchDataExport.getLane(lane_index).ImageToExport )
+
+        def lane_output_file(lane_index):
+            # e.g. an --output_filename_format without {nickname} gives all lanes the same file
+            return PathComponents( opBatchDataExport.getLane(lane_index).ExportPath.value ).externalPath
+
+        # Now run the batch export and report progress....
+        sys.stdout.write( "Exporting {} results. Progress: ".format( len( opBatchDataExport ) ) )
+        sys.stdout.flush()
+        def print_progress( progress ):
+            sys.stdout.write( "{} ".format( progress ) )
+            sys.stdout.flush()
+
+        scheduler = BatchExportScheduler( parallel_exports )
+        scheduler.progressSignal.subscribe( print_progress )
+        lane_results = scheduler.run( range( len( opBatchDataExport ) ), export_lane, lane_ram_bytes,
+                                      lane_output_bytes, lane_output_file )
+
+        # Finished.
+        sys.stdout.write("\n")
+        return [ { 'output' : opBatchDataExport.getLane(result.lane).ExportPath.value,
+                   'seconds' : result.seconds,
+                   'mb_per_second' : result.nbytes / 1e6 / max(result.seconds, 1e-6) }
+                 for result in lane_results ]
+
+    def _export_products(self, lane_index, progress_callback):
+        """
+        Export all products given via --export-products for one batch lane.
+        Each product is written as a separate dataset inside the export file's internal path.
+        The export dtype and axis order settings don't apply to these datasets.
+        """
+        opExportDataLaneView = self.batchResultsApplet.topLevelOperator.getLane(lane_index)
+        if opExportDataLaneView.OutputFormat.value != 'hdf5':
+            raise Exception("--export-products can only be used with --output_format=hdf5")
+
+        roi = None
+        if opExportDataLaneView.RegionStart.ready() and opExportDataLaneView.RegionStop.ready():
+            roi = ( opExportDataLaneView.RegionStart.value, opExportDataLaneView.RegionStop.value )
+
+        pathComponents = PathComponents( opExportDataLaneView.ExportPath.value )
+        with h5py.File( pathComponents.externalPath, 'w' ) as f:
+            group = f.require_group( pathComponents.internalPath or 'exported_data' )
+            self.opBatchPredictionPipeline[lane_index].exportProducts( group, self.export_products, roi, progress_callback )
 
     def _print_labels_by_slice(self, search_value):
         """
@@ -23,6 +23,7 @@ parser.add_argument('--redirect_output', help='A filepath to redirect stdout to'
 parser.add_argument('--debug', help='Start ilastik in debug mode.', action='store_true', default=False)
 parser.add_argument('--logfile', help='A filepath to dump all log messages to.', required=False)
 parser.add_argument('--process_name', help='A process name (used for logging purposes).', required=False)
+parser.add_argument('--serve', help='Headless only: keep the project loaded and process batch jobs received on this address (host:port or the path of a unix socket).', required=False)
 parser.add_argument('--configfile', help='A custom path to a user config file for expert ilastik settings.', required=False)
 parser.add_argument('--fullscreen', help='Show Window in fullscreen mode.', action='store_true', default=False)
 
@@ -100,6 +101,10 @@ def main( parsed_args, workflow_cmdline_args=[] ):
         # Run post-init
         for f in postinit_funcs:
             f(shell)
+
+        if parsed_args.serve:
+            from ilastik.shell.headless.predictionService import PredictionService, parse_address
+            PredictionService( shell, parse_address( parsed_args.serve ) ).serve()
         return shell
     # Normal launch
     else:
@@ -191,6 +196,10 @@ def _validate_arg_compatibility( parsed_args ):
         sys.stderr.write("Some of the command-line options you provided are not supported in headless mode.  Exiting.")
         sys.exit(1)
 
+    if parsed_args.serve and not ( parsed_args.headless and parsed_args.project ):
+        sys.stderr.write("The --serve argument may only be used in headless mode, with a --project.")
+        sys.exit(1)
+
 def _import_opengm():
     # Import opengm first if possible, to make sure it is included before vigra.
     # Otherwise the import fails and we will not get access to GraphCut thresholding
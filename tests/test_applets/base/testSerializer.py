@@ -488,6 +488,63 @@ class TestSerialBlockSlot(unittest.TestCase):
         os.remove(h5_filepath)
         shutil.rmtree(tmp_dir)
 
+    def testIncremental(self):
+        tmp_dir = tempfile.mkdtemp()
+        h5_filepath = os.path.join(tmp_dir , 'serial_blockslot_test.h5' )
+
+        # Create an operator and a serializer to write the data.
+        opLabelArrays, slotSerializer = self._init_objects()
+
+        # Give it some data.
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][30:31, 30:40, 30:40, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+            assert not slotSerializer.shouldSerialize( label_group )
+
+            lane_group = label_group[slotSerializer.name]['0']
+            assert len(lane_group) == 2
+            datasets = dict( (ds.attrs['blockSlice'], ds) for ds in lane_group.values() )
+            first = datasets['[10:20,10:20,10:20,0:1]']
+            second = datasets['[30:40,30:40,30:40,0:1]']
+            assert first.compression == 'gzip'
+            assert first.chunks is not None
+
+            # Change the stored data of the second block behind the serializer's back.
+            second[...] = 7
+
+            # Only the first block changes, so only it should be written.
+            opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 3*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            assert slotSerializer.shouldSerialize( label_group )
+            slotSerializer.serialize( label_group )
+            assert not slotSerializer.shouldSerialize( label_group )
+            assert ( first[0:1, 0:10, 0:10, 0:1] == 3 ).all()
+            assert ( second[...] == 7 ).all()
+            second[...] = 0
+            second[0:1, 0:10, 0:10, 0:1] = 2
+
+            # Erase the second block.
+            opLabelArrays.Input[0][30:31, 30:40, 30:40, 0:1] = 255*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            slotSerializer.serialize( label_group )
+
+        # Now start again with fresh objects.
+        # This time we'll read the data.
+        opLabelArrays, slotSerializer = self._init_objects()
+
+        with h5py.File(h5_filepath, 'r') as f:
+            label_group = f['label_data']
+            slotSerializer.deserialize( label_group )
+            assert not slotSerializer.shouldSerialize( label_group )
+
+        # Verify that we get the latest data back.
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 3 ).all()
+        assert ( opLabelArrays.Output[0][30:31, 30:40, 30:40, 0:1].wait() == 0 ).all()
+
+        os.remove(h5_filepath)
+        shutil.rmtree(tmp_dir)
+
 
 class TestSerialBlockSlot2(unittest.TestCase):
 
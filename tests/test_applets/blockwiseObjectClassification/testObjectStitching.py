@@ -0,0 +1,90 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import unittest
+
+import numpy
+import vigra
+
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
+from ilastik.applets.blockwiseObjectClassification.objectStitching import \
+    labelObjects, BlockObjects, StitchedObjects
+
+FEATURES = set(['Count', 'Mean', 'Variance', 'RegionCenter', 'Coord<Minimum>', 'Coord<Maximum>'])
+
+def stitchBlockwise(binary, raw, blockShape):
+    """Return (stitched object ids of each voxel, StitchedObjects)."""
+    shape = binary.shape
+    blocks = {}
+    for blockStart in getIntersectingBlocks(blockShape, ((0, 0, 0), shape)):
+        start, stop = getBlockBounds(shape, blockShape, blockStart)
+        slicing = roiToSlice(start, stop)
+        blocks[tuple(start)] = BlockObjects(labelObjects(binary[slicing]), vigra.taggedView(raw[slicing], 'xyz'), FEATURES)
+    stitched = StitchedObjects(blockShape, blocks, FEATURES)
+    objects = numpy.zeros(shape, dtype=numpy.uint32)
+    for start in blocks:
+        stop = numpy.minimum(numpy.add(start, blockShape), shape)
+        slicing = roiToSlice(start, stop)
+        objects[slicing] = stitched.relabel(start, labelObjects(binary[slicing]))
+    return objects, stitched
+
+
+class TestStitchedObjects(unittest.TestCase):
+    def setUp(self):
+        numpy.random.seed(0)
+        smooth = vigra.filters.gaussianSmoothing(numpy.random.rand(40, 33, 21).astype(numpy.float32), 1.0)
+        self.binary = (smooth > numpy.percentile(smooth, 70)).astype(numpy.uint8)
+        self.raw = numpy.random.rand(40, 33, 21).astype(numpy.float32)
+        self.labels = labelObjects(self.binary)
+        self.features = vigra.analysis.extractRegionFeatures(self.raw, self.labels, list(FEATURES), ignoreLabel=0)
+
+    def testAgainstWholeVolume(self):
+        for blockShape in [(40, 33, 21), (10, 10, 10), (7, 33, 4), (40, 1, 21)]:
+            objects, stitched = stitchBlockwise(self.binary, self.raw, blockShape)
+            assert stitched.nobjects == self.labels.max() + 1
+
+            # Same objects, each with one id
+            numpy.testing.assert_array_equal(objects > 0, self.labels > 0)
+            pairs = set(zip(self.labels[self.labels > 0].tolist(), objects[objects > 0].tolist()))
+            assert len(pairs) == self.labels.max()
+
+            # Same features
+            labels, ids = map(numpy.array, zip(*sorted(pairs)))
+            for name in FEATURES:
+                expected = numpy.asarray(self.features[name]).reshape(len(self.features[name]), -1)
+                numpy.testing.assert_allclose(stitched.features[name][ids], expected[labels],
+                                              rtol=1e-4, atol=1e-4, err_msg=name)
+
+    def testRelabelWithLut(self):
+        blockShape = (10, 10, 10)
+        objects, stitched = stitchBlockwise(self.binary, self.raw, blockShape)
+        lut = numpy.arange(stitched.nobjects) % 2 + 1
+        lut[0] = 0
+        labels = labelObjects(self.binary[10:20, 10:20, 0:10])
+        numpy.testing.assert_array_equal(stitched.relabel((10, 10, 0), labels, lut),
+                                         lut[objects[10:20, 10:20, 0:10]])
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")
+    sys.argv.append("--nologcapture")
+    nose.run(defaultTest=__file__)
@@ -107,6 +107,78 @@ class TestOpBlockwiseObjectClassification(object):
                 "Blockwise prediction operator did not produce the same prediction image" \
                 "as the non-blockwise prediction operator!"
  
+    def testPipelineEviction(self):
+        # Allow only one pipeline at a time: all others are deleted after use,
+        # but the prediction must not change and their features must be kept.
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op._blockPipelines.set_max_bytes( 1 )
+
+        pred = self.op.PredictionImage[:].wait()
+        assert (pred == self.prediction_volume).all(), \
+            "Blockwise prediction with evicted pipelines differs from the non-blockwise prediction"
+        assert len(self.op._blockPipelines) == 1, "Evicted pipelines were not deleted"
+
+        features = self.op.BlockwiseRegionFeatures[:].wait()
+        assert features.shape == (1, 3, 3, 3, 1)
+        for block_features in features.flat:
+            assert block_features is not None
+        predictions = self.op.get_objectwise_predictions( (0, 40, 40, 40, 0) )
+        assert len(predictions[0]) > 1
+
+        # Requesting an evicted block again recreates its pipeline
+        pred = self.op.PredictionImage[:, 0:10, 0:10, 0:10, :].wait()
+        assert (pred == self.prediction_volume[:, 0:10, 0:10, 0:10, :]).all()
+
+    def testEvictedPipelineInUse(self):
+        # A block's pipeline can be evicted, recreated and evicted again while
+        # the first one is still in use. Both must be retired once released.
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op._blockPipelines.set_max_bytes( 1 )
+        block_start = (0, 0, 0, 0, 0)
+        other_block_start = (0, 40, 0, 0, 0)
+
+        first = self.op._acquirePipeline( block_start )
+        self.op._releasePipeline( self.op._acquirePipeline( other_block_start ) )
+        second = self.op._acquirePipeline( block_start )
+        self.op._releasePipeline( self.op._acquirePipeline( other_block_start ) )
+        assert second is not first
+        assert set(self.op._evictedPipelines.keys()) == set([first, second])
+
+        self.op._releasePipeline( first )
+        self.op._releasePipeline( second )
+        assert not self.op._evictedPipelines, "Evicted pipelines were not retired"
+        assert block_start in self.op._blockResults
+
+    def testStitchedObjects(self):
+        # Objects that cross block borders are stitched together, so even blocks that
+        # slice through the cubes give the same prediction as the non-blockwise classification.
+        # Stitching requires features that can be merged across blocks.
+        self.testingFeatures = {"Standard Object Features": {"Count":{}, "Mean":{}}}
+        self.setUpObjExtraction()
+        self.setUpClassifier()
+        self.connectLanes()
+
+        self.op.StitchObjects.setValue( True )
+        self.op.BlockShape3dDict.setValue( {'x' : 42, 'y' : 42, 'z' : 42} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 0, 'y' : 0, 'z' : 0} )
+
+        pred = self.op.PredictionImage[:].wait()
+        if not (pred == self.prediction_volume).all():
+            self.logImage(pred, "stitched_prediction_")
+            assert False, \
+                "Blockwise prediction with stitched objects did not produce the same prediction image" \
+                "as the non-blockwise prediction operator!"
+
+        pred = self.op.ProbabilityChannelImage[:].wait()
+        argmax_pred = numpy.argmax( pred, axis=-1 )[...,None] + 1
+        argmax_pred[pred.sum(-1) == 0] = 0
+        assert (argmax_pred == self.prediction_volume).all()
+
+        pred = self.op.PredictionImage[:, 30:50, 35:45, 0:10, :].wait()
+        assert (pred == self.prediction_volume[:, 30:50, 35:45, 0:10, :]).all()
+
     def testZeroHalo(self):
         # If we shrink the halo down to zero, then we get different predictions...
         # This block shape/halo combination will slice through some of the big blocks, causing mis-classification.
@@ -0,0 +1,80 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+from ilastik.workflows.carving.blockwiseWatershed import UnionFind, seam_matches, blockwise_watershed
+
+def cellVolume(shape, spacing):
+    """Cells of zeros, separated by walls of 255 every 'spacing' voxels."""
+    volume = numpy.zeros(shape, dtype=numpy.uint8)
+    cells = numpy.zeros(shape, dtype=numpy.uint32)
+    for axis in range(3):
+        index = [slice(None)] * 3
+        index[axis] = slice(spacing - 1, None, spacing)
+        volume[tuple(index)] = 255
+    grid = numpy.indices(shape) // spacing
+    cells[:] = 1 + grid[0] + grid[1] * 100 + grid[2] * 10000
+    cells[volume > 0] = 0
+    return volume, cells
+
+class TestUnionFind(object):
+    def test_lut(self):
+        union_find = UnionFind()
+        union_find.add(5)
+        union_find.union(5, 2)
+        union_find.union(3, 5)
+        assert list(union_find.consecutive_lut()) == [0, 1, 2, 2, 3, 2]
+
+class TestSeamMatches(object):
+    def test_mutual_best(self):
+        halo = numpy.array([1, 1, 1, 2, 2, 3, 3, 3, 0])
+        neighbor = numpy.array([7, 7, 8, 8, 8, 8, 9, 9, 9])
+        a, b = seam_matches(halo, neighbor)
+        assert sorted(zip(a, b)) == [(1, 7), (2, 8), (3, 9)]
+        # 8 overlaps most with 2, so 1 is not matched with it
+        a, b = seam_matches(numpy.array([1, 2, 2]), numpy.array([8, 8, 8]))
+        assert zip(a, b) == [(2, 8)]
+
+class TestBlockwiseWatershed(object):
+    def check(self, block_shape, halo):
+        volume, cells = cellVolume((40, 35, 20), 8)
+        labels = numpy.zeros(volume.shape, dtype=numpy.uint32)
+        def read_volume(start, stop):
+            return volume[tuple(slice(a, b) for a, b in zip(start, stop))]
+        lut = blockwise_watershed(read_volume, labels, block_shape, halo)
+        merged = lut[labels]
+        inside = cells > 0
+        # every cell gets exactly one label, and no two cells share a label
+        pairs = set(zip(cells[inside], merged[inside]))
+        assert len(pairs) == len(numpy.unique(cells[inside])) == len(numpy.unique(merged[inside]))
+
+    def test_single_block(self):
+        self.check((40, 35, 20), 0)
+
+    def test_blocks(self):
+        self.check((13, 11, 7), 4)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,184 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+
+import numpy
+import h5py
+
+from ilastik.workflows.carving.watershed_segmentor import WatershedSegmentor
+from ilastik.workflows.carving.carvingSerializer import CarvingSerializer
+
+SHAPE = (20, 20, 20)
+
+def makeSegmentor():
+    # 4x4x4 supervoxels, cubes of 5x5x5 voxels
+    x, y, z = numpy.indices(SHAPE) // 5
+    labels = numpy.asarray(1 + 16*x + 4*y + z, dtype=numpy.uint32)
+    numpy.random.seed(0)
+    volume_feat = numpy.random.random(SHAPE).astype(numpy.float32)
+    return WatershedSegmentor(labels, volume_feat)
+
+def markLabels(g):
+    # Rewriting the labels replaces the dataset, which drops this attribute
+    g["labels"].attrs["marker"] = True
+
+def labelsRewritten(g):
+    return "marker" not in g["labels"].attrs
+
+class Meta(object):
+    shape = (1,) + SHAPE + (1,)
+    dtype = numpy.uint8
+
+class Output(object):
+    meta = Meta()
+
+class LabelArray(object):
+    Output = Output()
+
+class WriteSeeds(object):
+    def __setitem__(self, slicing, value):
+        pass
+
+class SeedRoi(object):
+    # (t,x,y,z,c), like the rois OpCarving passes to addSeeds()
+    start = (0, 0, 0, 0, 0)
+    stop = (1, 10, 5, 5, 1)
+
+class CarvingLane(object):
+    """The parts of OpCarving that CarvingSerializer uses."""
+    def __init__(self, mst):
+        self._mst = mst
+        self._dirtyObjects = set()
+        self.has_seeds = False
+        self.opLabelArray = LabelArray()
+        self.WriteSeeds = WriteSeeds()
+
+    def get_label_voxels(self):
+        return None, None
+
+    def _buildDone(self):
+        pass
+
+class Carving(object):
+    def __init__(self, mst):
+        self.innerOperators = [CarvingLane(mst)]
+
+class TestCarvingSerialization(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.f = h5py.File(os.path.join(self.tmpdir, "carving.h5"), "w")
+
+    def tearDown(self):
+        self.f.close()
+        shutil.rmtree(self.tmpdir)
+
+    def testSaveTwice(self):
+        mst = makeSegmentor()
+        g = self.f.create_group("graph")
+        mst.saveH5G(g)
+        assert g.attrs["graphId"] == mst.graphId
+        assert g["labels"].chunks is not None and g["labels"].compression == "gzip"
+        markLabels(g)
+
+        mst.saveH5G(g)
+        assert not labelsRewritten(g), "Saving the same segmentor again rewrote the labels"
+
+        # Preprocessing again creates a new segmentor
+        newMst = makeSegmentor()
+        newMst.saveH5G(g)
+        assert labelsRewritten(g), "Saving a new segmentor didn't rewrite the labels"
+        assert g.attrs["graphId"] == newMst.graphId
+
+    def testConvertOldGroup(self):
+        g = self.f.create_group("graph")
+        makeSegmentor().saveH5G(g)
+        # Projects from older versions don't have a graphId
+        del g.attrs["graphId"]
+        markLabels(g)
+
+        mst = WatershedSegmentor(h5file=g)
+        mst.saveH5G(g)
+        assert labelsRewritten(g), "A group without graphId wasn't converted"
+        assert g.attrs["graphId"] == mst.graphId
+
+        markLabels(g)
+        mst.saveH5G(g)
+        assert not labelsRewritten(g)
+
+        reloaded = WatershedSegmentor(h5file=g)
+        assert reloaded.graphId == mst.graphId
+        assert (reloaded.supervoxelUint32 == mst.supervoxelUint32).all()
+
+    def testDeltaSaveToNewFile(self):
+        mst = makeSegmentor()
+        brushStroke = numpy.zeros((10, 5, 5), dtype=numpy.uint8)
+        brushStroke[:5] = 2
+        brushStroke[5:] = 1
+        mst.addSeeds(SeedRoi(), brushStroke)
+        assert mst.gridSegmentor.getNodeSeeds().any()
+
+        numpy.random.seed(1)
+        for i, name in enumerate(["a", "b", "c"]):
+            fg = numpy.random.randint(0, 20, size=(3, 10))
+            bg = numpy.random.randint(0, 20, size=(3, 7))
+            mst.object_names[name] = i+1
+            mst.object_seeds_fg_voxels[name] = [fg[k] for k in range(3)]
+            mst.object_seeds_bg_voxels[name] = [bg[k] for k in range(3)]
+            mst.object_lut[name] = numpy.unique(numpy.random.randint(1, mst.numNodes, size=5)).astype(numpy.uint32)
+            mst.bg_priority[name] = 0.95
+            mst.no_bias_below[name] = 64
+
+        # Only "b" changed since the last save, but "a" and "c" are missing
+        # from the new file (e.g. after "Save As") and must be written, too.
+        carving = Carving(mst)
+        carving.innerOperators[0]._dirtyObjects = set(["b"])
+        serializer = CarvingSerializer(carving, "carving")
+        top = self.f.create_group("carving")
+        serializer._serializeToHdf5(top, self.f, self.f.filename)
+        mst.saveH5G(self.f.create_group("graph"))
+
+        assert sorted(top["objects"].keys()) == ["a", "b", "c"]
+        for name in ["a", "b", "c"]:
+            assert top["objects"][name]["sv"].compression == "gzip"
+
+        reloaded = WatershedSegmentor(h5file=self.f["graph"])
+        assert (reloaded.supervoxelUint32 == mst.supervoxelUint32).all()
+        assert (reloaded.gridSegmentor.getNodeSeeds() == mst.gridSegmentor.getNodeSeeds()).all()
+
+        serializer = CarvingSerializer(Carving(reloaded), "carving")
+        serializer._deserializeFromHdf5(top, None, self.f, self.f.filename)
+        assert sorted(reloaded.object_lut.keys()) == ["a", "b", "c"]
+        for name in ["a", "b", "c"]:
+            assert (reloaded.object_lut[name] == mst.object_lut[name]).all()
+            for k in range(3):
+                assert (reloaded.object_seeds_fg_voxels[name][k] == mst.object_seeds_fg_voxels[name][k]).all()
+                assert (reloaded.object_seeds_bg_voxels[name][k] == mst.object_seeds_bg_voxels[name][k]).all()
+            assert reloaded.bg_priority[name] == numpy.float32(mst.bg_priority[name])
+            assert reloaded.no_bias_below[name] == mst.no_bias_below[name]
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
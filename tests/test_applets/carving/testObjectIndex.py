@@ -0,0 +1,97 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+from ilastik.workflows.carving.objectIndex import SupervoxelObjectIndex
+
+NUM_NODES = 50
+
+def buildDone(object_lut, object_names, exclude):
+    # the full rebuild that the index replaces
+    done_lut = numpy.zeros(NUM_NODES+1, dtype=numpy.int32)
+    done_covered = [set() for _ in range(NUM_NODES+1)]
+    for name, objectSupervoxels in object_lut.iteritems():
+        if name == exclude:
+            continue
+        done_lut[objectSupervoxels] += 1
+        for sv in numpy.asarray(objectSupervoxels).ravel():
+            done_covered[sv].add(object_names[name])
+    return done_lut, done_covered
+
+class TestSupervoxelObjectIndex(object):
+    def check(self, index, object_lut, object_names, exclude=None):
+        index.update(object_lut, object_names, exclude)
+        done_lut, done_covered = buildDone(object_lut, object_names, exclude)
+        assert (index.done_lut == done_lut).all()
+        for sv in range(NUM_NODES+1):
+            if done_covered[sv]:
+                assert index.done_seg_lut[sv] in done_covered[sv]
+            else:
+                assert index.done_seg_lut[sv] == 0
+            names = [name for name, objectSupervoxels in object_lut.iteritems()
+                     if numpy.sum(numpy.uint32(sv) == objectSupervoxels) > 0]
+            assert index.names(sv) == sorted(names)
+
+    def test_save_and_delete(self):
+        object_lut = {}
+        object_names = {}
+        index = SupervoxelObjectIndex(NUM_NODES)
+        self.check(index, object_lut, object_names)
+
+        # like OpCarving.saveCurrentObjectAs
+        object_names['a'] = 1
+        object_lut['a'] = numpy.where(numpy.arange(NUM_NODES+1) % 3 == 0)
+        object_names['b'] = 2
+        object_lut['b'] = numpy.arange(10, 20)
+        self.check(index, object_lut, object_names)
+
+        # load 'a' for editing, then save it again with other supervoxels
+        self.check(index, object_lut, object_names, exclude='a')
+        object_lut['a'] = numpy.where(numpy.arange(NUM_NODES+1) % 4 == 0)
+        self.check(index, object_lut, object_names)
+
+        # like OpCarving.deleteObject_impl
+        del object_lut['b']
+        del object_names['b']
+        self.check(index, object_lut, object_names)
+
+    def test_random(self):
+        numpy.random.seed(0)
+        object_lut = {}
+        object_names = {}
+        index = SupervoxelObjectIndex(NUM_NODES)
+        for i in range(100):
+            name = 'object%d' % numpy.random.randint(10)
+            if name in object_lut and numpy.random.rand() < 0.3:
+                del object_lut[name]
+                del object_names[name]
+            else:
+                object_names[name] = int(name[6:]) + 1
+                object_lut[name] = numpy.unique(numpy.random.randint(1, NUM_NODES+1, size=8))
+            exclude = 'object%d' % numpy.random.randint(10)
+            self.check(index, object_lut, object_names, exclude)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,127 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import shutil
+import tempfile
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper, OpPixelOperator
+
+from ilastik.utility.diskBlockStore import DiskBlockStore
+from ilastik.applets.featureSelection.opPersistentFeatureCache import OpPersistentFeatureCache
+
+class TestOpPersistentFeatureCache(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        numpy.random.seed(0)
+        raw = numpy.random.random((2, 60, 50, 1)).astype(numpy.float32)
+        self.raw = vigra.taggedView(raw, 'txyc')
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _makeCache(self, raw):
+        """
+        Simulate a session: a new graph with a 'feature' operator 
+        behind a persistent cache in our temporary directory.
+        """
+        def features(a):
+            self.calls.append(a.shape)
+            return numpy.concatenate((a, 2*a), axis=-1)
+
+        graph = Graph()
+        opRaw = OpArrayPiper(graph=graph)
+        opRaw.Input.setValue(raw)
+
+        opFeatures = OpPixelOperator(graph=graph)
+        opFeatures.Input.connect(opRaw.Output)
+        opFeatures.Function.setValue(features)
+
+        opCache = OpPersistentFeatureCache(DiskBlockStore(self.tmpdir), graph=graph)
+        opCache.BLOCK_VOXELS = 500
+        opCache.Input.connect(opFeatures.Output)
+        opCache.RawImage.connect(opRaw.Output)
+        opCache.CacheKey.setValue("test features")
+        opCache.Halo.setValue(3)
+        return opCache
+
+    def _expected(self, raw):
+        return numpy.concatenate((raw, 2*raw), axis=-1)
+
+    def testReuseAcrossSessions(self):
+        opCache = self._makeCache(self.raw)
+        assert (opCache.Output[:].wait() == self._expected(self.raw)).all()
+        assert len(self.calls) > 0
+
+        # A new session with the same data and settings doesn't compute anything
+        del self.calls[:]
+        opCache = self._makeCache(self.raw)
+        result = opCache.Output[1:2, 10:40, 5:45, 1:2].wait()
+        assert (result == self._expected(self.raw)[1:2, 10:40, 5:45, 1:2]).all()
+        assert len(self.calls) == 0
+
+    def testChangedData(self):
+        opCache = self._makeCache(self.raw)
+        opCache.Output[:].wait()
+
+        # Change the raw data in one place: only the blocks whose halo includes it are recomputed.
+        raw = self.raw.copy()
+        raw[0, 30, 25, 0] = 100
+        del self.calls[:]
+        opCache = self._makeCache(raw)
+        assert (opCache.Output[:].wait() == self._expected(raw)).all()
+        assert 0 < len(self.calls) < opCache.Output.meta.shape[0] * 60 * 50 / 500
+
+class TestDiskBlockStore(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testEviction(self):
+        a = numpy.zeros((100,), dtype=numpy.float64)
+        store = DiskBlockStore(self.tmpdir, max_bytes=2000)
+        store.put('a', a)
+        store.put('b', a + 1)
+        assert (store.get('a') == a).all()
+        assert (store.get('b') == a + 1).all()
+
+        # Each file takes a bit more than 800 bytes, so only two fit.
+        store.put('c', a + 2)
+        assert 'c' in store
+        assert len([k for k in 'abc' if k in store]) == 2
+        assert store.nbytes <= 2000
+
+        # Another store on the same directory sees the same data
+        store2 = DiskBlockStore(self.tmpdir, max_bytes=2000)
+        assert (store2.get('c') == a + 2).all()
+        assert store2.get('nonexistent') is None
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -26,7 +26,7 @@ import numpy as np
 import vigra
 from lazyflow.graph import Graph
 from ilastik.applets.objectClassification.opObjectClassification import \
-    OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
+    OpRelabelSegmentation, OpMultiRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
     OpBadObjectsToWarningMessage, OpMaxLabel
     
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifier
@@ -85,6 +85,52 @@ class TestOpRelabelSegmentation(object):
         assert (np.all(img[1, 10:20, 10:20, 10:20, 0] == 60))
         assert (np.all(img[1, 20:25, 20:25, 20:25, 0] == 70))
 
+    def test_short_map(self):
+        # objects without an entry in the map are painted with 0
+        segimg = segImage()
+        map_ = {0 : np.array([10, 20]),
+                1 : np.array([40, 50, 60, 70])}
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMap.setValue(map_)
+        self.op.Features._setReady() # hack because we do not use features
+        img = self.op.Output.value
+        assert (np.all(img[0,  0:10,  0:10,  0:10, 0] == 20))
+        assert (np.all(img[0, 20:25, 20:25, 20:25, 0] == 0))
+
+        # the cached lookup table is replaced when the map changes
+        self.op.ObjectMap.setValue({0 : np.array([10, 20, 30]),
+                                    1 : np.array([40, 50, 60, 70])})
+        img = self.op.Output.value
+        assert (np.all(img[0, 20:25, 20:25, 20:25, 0] == 30))
+
+class TestOpMultiRelabelSegmentation(object):
+    def setUp(self):
+        g = Graph()
+        self.op = OpMultiRelabelSegmentation(graph=g)
+
+    def test(self):
+        segimg = segImage()
+        maps = [{0 : np.array([0.0, 0.1, 0.2]),
+                 1 : np.array([0.0, 0.3, 0.4, 0.5])},
+                {0 : np.array([0.0, 0.6, 0.7]),
+                 1 : np.array([0.0, 0.8, 0.9])}]
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMaps.resize(2)
+        for islot, map_ in zip(self.op.ObjectMaps, maps):
+            islot.setValue(map_)
+        self.op.Features._setReady() # hack because we do not use features
+
+        stacked = self.op.StackedOutput[:].wait()
+        assert stacked.shape == segimg.shape[:-1] + (2,)
+        for c in range(2):
+            assert np.all(stacked[..., c:c+1] == self.op.Output[c][:].wait())
+        # object 3 at t=1 has no entry in the second map
+        assert np.all(stacked[1, 20:25, 20:25, 20:25, 1] == 0)
+
+        # a subset of channels
+        channel1 = self.op.StackedOutput[..., 1:2].wait()
+        assert np.all(channel1 == stacked[..., 1:2])
+
 class TestOpObjectTrain(unittest.TestCase):
     
     nRandomForests = 1
@@ -236,7 +282,46 @@ class TestOpObjectPredict(unittest.TestCase):
         
         self.assertTrue( np.all(probChannel0Time01[0]==probs[0][:, 0]) )
         self.assertTrue( np.all(probChannel0Time01[1]==probs[1][:, 0]) )
-        
+
+    def test_concurrent_requests(self):
+        ###
+        # test that concurrent requests predict each time step only once
+        ###
+        predicted = []
+        predict_time_step = self.op._predict_time_step
+        def counting_predict(t, *args):
+            predicted.append(t)
+            return predict_time_step(t, *args)
+        self.op._predict_time_step = counting_predict
+
+        reqs = [self.op.Probabilities([i % 2]) for i in range(10)]
+        for req in reqs:
+            req.submit()
+        results = [req.wait() for req in reqs]
+
+        self.assertEqual(sorted(predicted), [0, 1])
+        for i, result in enumerate(results):
+            self.assertTrue( np.all(result[i % 2] == results[i % 2][i % 2]) )
+
+    def test_cache_eviction(self):
+        ###
+        # test that the least recently used time step is evicted from a full cache
+        ###
+        bad_objects = self.op.BadObjects([0, 1]).wait()
+        self.op.prediction_cache.set_max_bytes(1)
+        self.op.Probabilities([0]).wait()
+        self.op.Probabilities([1]).wait()
+        cached = self.op.CachedProbabilities([0, 1]).wait()
+        self.assertEqual(cached.keys(), [1])
+
+        # evicted time steps are predicted again
+        preds = self.op.Predictions([0]).wait()
+        self.assertTrue(np.all(preds[0] == np.array([0, 1, 2])))
+
+        # the bad objects are evicted (and predicted again) together with the probabilities
+        for t in [0, 1]:
+            self.assertTrue(np.all(self.op.BadObjects([t]).wait()[t] == bad_objects[t]))
+
 
  
 class TestFeatureSelection(unittest.TestCase):
@@ -22,7 +22,117 @@ import ilastik.ilastik_logging
 ilastik.ilastik_logging.default_config.init()
 
 from ilastik.applets.objectClassification.opObjectClassification import OpObjectClassification
+from lazyflow.utility.timer import Timer
 import numpy
+import itertools
+import nose
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def transferLabelsReference(old_labels, old_bboxes, new_bboxes, axistags = None):
+    """The original pairwise implementation of transferLabels, for comparison."""
+
+    mins_old = old_bboxes["Coord<Minimum>"]
+    maxs_old = old_bboxes["Coord<Maximum>"]
+    mins_new = new_bboxes["Coord<Minimum>"]
+    maxs_new = new_bboxes["Coord<Maximum>"]
+    nobj_old = mins_old.shape[0]
+    nobj_new = mins_new.shape[0]
+    if axistags is None:
+        axistags = "xyz"
+    
+    data2D = False
+    if mins_old.shape[1]==2:
+        data2D = True
+    class bbox():
+        def __init__(self, minmaxs, axistags):
+            self.xmin = minmaxs[0][axistags.index('x')]
+            self.ymin = minmaxs[0][axistags.index('y')]
+            if not data2D:
+                self.zmin = minmaxs[0][axistags.index('z')]
+            else:
+                self.zmin = 0
+            self.xmax = minmaxs[1][axistags.index('x')]
+            self.ymax = minmaxs[1][axistags.index('y')]
+            if not data2D:
+                self.zmax = minmaxs[1][axistags.index('z')]
+            else:
+                self.zmax = 0
+            self.rad_x = 0.5*(self.xmax - self.xmin)
+            self.cent_x = self.xmin+self.rad_x
+            self.rad_y = 0.5*(self.ymax-self.ymin)
+            self.cent_y = self.ymin+self.rad_y
+            self.rad_z = 0.5*(self.zmax-self.zmin)
+            self.cent_z = self.zmin+self.rad_z
+
+        @staticmethod
+        def overlap(bbox_tuple):
+            this = bbox_tuple[0]
+            that = bbox_tuple[1]
+            over_x = this.rad_x+that.rad_x - (abs(this.cent_x-that.cent_x))
+            over_y = this.rad_y+that.rad_y - (abs(this.cent_y-that.cent_y))
+            over_z = this.rad_z+that.rad_z - (abs(this.cent_z-that.cent_z))
+            if not data2D:
+                if over_x>0 and over_y>0 and over_z>0:
+                    return over_x*over_y*over_z
+            else:
+                if over_x>0 and over_y>0:
+                    return over_x*over_y
+            return 0
+
+    nonzeros = numpy.nonzero(old_labels)[0]
+    bboxes_old = [bbox(x, axistags) for x in zip(mins_old[nonzeros], maxs_old[nonzeros])]
+    bboxes_new = [bbox(x, axistags) for x in zip(mins_new, maxs_new)]
+
+    #remove background
+    #FIXME: assuming background is 0 again
+    bboxes_new = bboxes_new[1:]
+
+    double_for_loop = itertools.product(bboxes_old, bboxes_new)
+    overlaps = map(bbox.overlap, double_for_loop)
+
+    overlaps = numpy.asarray(overlaps)
+    overlaps = overlaps.reshape((len(bboxes_old), len(bboxes_new)))
+    new_labels = numpy.zeros((nobj_new,), dtype=numpy.uint32)
+    old_labels_lost = dict()
+    old_labels_lost["full"]=[]
+    old_labels_lost["partial"]=[]
+    new_labels_lost = dict()
+    new_labels_lost["conflict"]=[]
+    for iobj in range(overlaps.shape[0]):
+        #take the object with maximum overlap
+        overlapsum = numpy.sum(overlaps[iobj, :])
+        if overlapsum==0:
+            old_labels_lost["full"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
+            continue
+        newindex = numpy.argmax(overlaps[iobj, :])
+        if overlapsum-overlaps[iobj,newindex]>0:
+            #this object overlaps with more than one new object
+            old_labels_lost["partial"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
+
+        overlaps[iobj, :] = 0
+        overlaps[iobj, newindex] = 1 #doesn't matter what number>0
+
+    for iobj in range(overlaps.shape[1]):
+        labels = numpy.where(overlaps[:, iobj]>0)[0]
+        if labels.shape[0]==1:
+            new_labels[iobj+1]=old_labels[nonzeros[labels[0]]] #iobj+1 because of the background
+        elif labels.shape[0]>1:
+            new_labels_lost["conflict"].append((bboxes_new[iobj].cent_x, bboxes_new[iobj].cent_y, bboxes_new[iobj].cent_z))
+
+    new_labels = new_labels
+    new_labels[0]=0 #FIXME: hardcoded background value again
+    return new_labels, old_labels_lost, new_labels_lost
+
+def randomBoxes(nobj, shape, maxsize):
+    mins = numpy.random.randint(0, shape - maxsize, size=(nobj, 3))
+    maxs = mins + numpy.random.randint(0, maxsize, size=(nobj, 3))
+    # background object
+    mins[0] = 0
+    maxs[0] = shape - 1
+    return {"Coord<Minimum>": mins, "Coord<Maximum>": maxs}
 
 class TestTransferLabelsFunction(object):
     def test(self):
@@ -52,8 +162,59 @@ class TestTransferLabelsFunction(object):
         newmin4 =  coords_new["Coord<Minimum>"][4]
         newmax4 = coords_new["Coord<Maximum>"][4]
         assert numpy.all(newlost["conflict"]==(newmin4+(newmax4-newmin4)/2.))
-    
-    
+
+
+class TestTransferLabelsAgainstReference(object):
+    def _compare(self, nold, nnew, ndim):
+        numpy.random.seed(0)
+        old_bboxes = randomBoxes(nold, 200, 20)
+        new_bboxes = randomBoxes(nnew, 200, 20)
+        if ndim == 2:
+            for bboxes in (old_bboxes, new_bboxes):
+                for key in bboxes:
+                    bboxes[key] = bboxes[key][:, :2]
+        labels = numpy.random.randint(0, 4, size=(nold,))
+        labels[0] = 0
+
+        result = OpObjectClassification.transferLabels(labels, old_bboxes, new_bboxes)
+        expected = transferLabelsReference(labels, old_bboxes, new_bboxes)
+        assert numpy.all(result[0] == expected[0])
+        for key in ("full", "partial"):
+            assert numpy.allclose(numpy.reshape(result[1][key], (-1, 3)), numpy.reshape(expected[1][key], (-1, 3)))
+        assert numpy.allclose(numpy.reshape(result[2]["conflict"], (-1, 3)), numpy.reshape(expected[2]["conflict"], (-1, 3)))
+
+    def test3D(self):
+        self._compare(300, 500, 3)
+
+    def test2D(self):
+        self._compare(300, 500, 2)
+
+
+class TestTransferLabelsBenchmark(object):
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def test(self):
+        numpy.random.seed(0)
+        old_bboxes = randomBoxes(2000, 2000, 30)
+        new_bboxes = randomBoxes(10000, 2000, 30)
+        labels = numpy.random.randint(0, 4, size=(2000,))
+        labels[0] = 0
+
+        with Timer() as timer:
+            result = OpObjectClassification.transferLabels(labels, old_bboxes, new_bboxes)
+        logger.info("Grid-based label transfer took {} seconds".format(timer.seconds()))
+
+        with Timer() as timer:
+            expected = transferLabelsReference(labels, old_bboxes, new_bboxes)
+        logger.info("Pairwise label transfer took {} seconds".format(timer.seconds()))
+
+        assert numpy.all(result[0] == expected[0])
+
+
 if __name__ == "__main__":
     import sys
     import nose
@@ -34,10 +34,11 @@ from ilastik.applets.objectClassification.opObjectClassification import \
     OpBadObjectsToWarningMessage, OpMaxLabel
     
 from ilastik.applets.counting.opCounting import \
-    OpCounting, OpMean, OpVolumeOperator,OpLabelPipeline, \
+    OpCounting, OpMean, OpVolumeOperator,OpLabelPipeline, OpDensityIntegral, \
     OpPredictionPipelineNoCache,OpPredictionPipeline
 
 from ilastik.applets.counting.countingOperators import OpTrainCounter, OpPredictCounter, OpLabelPreviewer
+from ilastik.applets.counting.densityIntegral import BlockwiseIntegralImage
 
  
 # def segImage():
@@ -89,6 +90,42 @@ class TestOpMean(object):
         #FIXME: why is it this the region ?
         np.testing.assert_allclose(np.mean(rimg.view(np.ndarray),axis=2),mean.view(np.ndarray)[...,0:1,0])
 
+class TestBlockwiseIntegralImage(object):
+    def test(self):
+        image = np.random.rand(50, 37)
+        integral = BlockwiseIntegralImage(image.shape, (16, 16))
+        for block in integral.dirtyBlocks():
+            integral.setBlock(block, image[integral.blockSlicing(block)])
+
+        image[20:40, 5:8] = 3
+        integral.markDirty((20, 5), (40, 8))
+        assert len(integral.dirtyBlocks()) == 2
+        for block in integral.dirtyBlocks():
+            integral.setBlock(block, image[integral.blockSlicing(block)])
+
+        for start, stop in [((0, 0), (50, 37)), ((3, 17), (41, 18)), ((16, 16), (32, 32))]:
+            region = image[start[0]:stop[0], start[1]:stop[1]]
+            np.testing.assert_allclose(integral.statistics(start, stop),
+                                       (region.sum(), region.mean(), region.std()))
+
+class TestOpDensityIntegral(object):
+    def setUp(self):
+        g = Graph()
+        self.op = OpDensityIntegral(graph=g)
+        self.op.DefaultBlockSize = 8
+
+    def test(self):
+        rimg = imageWithRandomNoise()[0:1, ..., 0:1, :]
+        self.op.Input.setValue(rimg)
+        np.testing.assert_allclose(self.op.OutputSum.value[0], rimg.sum())
+
+        integral = self.op.Integral.value
+        region = rimg.view(np.ndarray)[0, 3:20, 10:11, 0, 0]
+        np.testing.assert_allclose(integral.sums((3, 10), (20, 11))[0], region.sum())
+
+        self.op.Input.setValue(rimg*2)
+        np.testing.assert_allclose(self.op.OutputSum.value[0], 2*rimg.sum())
+
         
 # class TestOpObjectTrain(unittest.TestCase):
 #     
@@ -0,0 +1,70 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+import vigra
+
+from ilastik.applets.objectExtraction.blockwiseRegionFeatures import determine_block_shape, block_starts, \
+                                                                    extract_block_features, RegionFeatureAccumulator
+
+FEATURES = ['Count', 'Sum', 'Mean', 'Variance', 'Minimum', 'Maximum',
+            'Coord<Minimum>', 'Coord<Maximum>', 'RegionCenter']
+
+class TestRegionFeatureAccumulator(object):
+    def setUp(self):
+        np.random.seed(0)
+        self.raw = np.random.random((40, 30, 20)).astype(np.float32)
+        binary = np.zeros((40, 30, 20), dtype=np.uint8)
+        binary[2:20, 3:25, 1:10] = 1
+        binary[25:38, 5:8, 5:18] = 1
+        binary[5:35, 27:29, 12:19] = 1
+        self.labels = vigra.analysis.labelVolumeWithBackground(binary).astype(np.uint32)
+
+    def test_merge(self):
+        expected = vigra.analysis.extractRegionFeatures(self.raw, self.labels, FEATURES, ignoreLabel=0)
+
+        block_shape = (16, 16, 8)
+        accumulator = RegionFeatureAccumulator(FEATURES)
+        for start in block_starts(self.raw.shape, block_shape):
+            slicing = tuple(slice(s, s+b) for s, b in zip(start, block_shape))
+            block_feats = extract_block_features(self.raw[slicing], self.labels[slicing], FEATURES)
+            accumulator.add_block(block_feats, start)
+        merged = accumulator.result()
+
+        nobj = self.labels.max() + 1
+        for name in FEATURES:
+            value = np.asarray(expected[name]).reshape(nobj, -1)
+            assert merged[name].shape == value.shape, name
+            assert np.allclose(merged[name][1:], value[1:], rtol=1e-4), name
+            assert np.all(merged[name][0] == 0)
+
+    def test_block_shape(self):
+        assert determine_block_shape((40, 30, 20), 4, 40*30*20*4) == (40, 30, 20)
+        block_shape = determine_block_shape((40, 30, 20), 4, 10000)
+        assert np.prod(block_shape) * 4 <= 10000
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
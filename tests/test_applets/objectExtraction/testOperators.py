@@ -184,6 +184,70 @@ class testOpRegionFeaturesAgainstNumpy(object):
                     center_good = mins[iobj][icoord] + (maxs[iobj][icoord]-mins[iobj][icoord])/2.
                     assert abs(coord-center_good)<0.01
 
+    def test_local_chunks(self):
+        # Batched local features must not depend on how objects are chunked
+        opAdapt = OpAdaptTimeListRoi(graph=self.op.graph)
+        opAdapt.Input.connect(self.op.Output)
+        feats = opAdapt.Output([0, 1]).wait()
+
+        self.op.LOCAL_FEATURES_CHUNK_SIZE = 1
+        self.op.Features.setValue(self.features, check_changed=False)
+        single_feats = opAdapt.Output([0, 1]).wait()
+
+        for t in range(self.img.shape[0]):
+            for key in ["Sum in neighborhood", "Mean in neighborhood", "Sum in object and neighborhood"]:
+                assert np.allclose(feats[t][NAME][key], single_feats[t][NAME][key])
+
+
+class TestLocalFeaturesBatch(object):
+    # The vigra plugin packs the objects of a chunk into one image, this
+    # must give the same features as computing each object on its own.
+    def setUp(self):
+        self.plugin = pluginManager.getPluginByName(NAME, "ObjectFeatures").plugin_object
+        self.plugin.ndim = 3
+        margin = {"margin" : (3, 3, 1)}
+        self.features = {
+            "Mean in neighborhood" : margin,
+            "Sum in neighborhood" : margin,
+            "Variance in neighborhood" : margin,
+            "Maximum in neighborhood" : margin,
+        }
+
+        class Axes(object):
+            x, y, z, c = 0, 1, 2, 3
+        self.axes = Axes()
+
+        self.labels = np.zeros((30, 12, 4), dtype=np.uint32)
+        self.labels[2:5, 2:5, 1:3] = 1
+        self.labels[10:14, 3:9, 0:2] = 2
+        # fills its whole extent, so it has no context
+        self.labels[20:28, 0:12, 0:4] = 3
+        np.random.seed(0)
+        self.raw = vigra.taggedView(np.random.random((30, 12, 4, 1)).astype(np.float32), 'xyzc')
+        self.extents = [[slice(0, 8), slice(0, 8), slice(0, 4)],
+                        [slice(7, 17), slice(0, 12), slice(0, 3)],
+                        [slice(20, 28), slice(0, 12), slice(0, 4)]]
+
+    def test_against_compute_local(self):
+        label_ids = [1, 2, 3]
+        batch = self.plugin.compute_local_batch(self.raw, self.labels, label_ids, self.extents,
+                                                self.features, self.axes)
+        assert len(batch) == len(label_ids)
+        for label_id, extent, batch_feats in zip(label_ids, self.extents, batch):
+            rawbbox = self.raw[tuple(extent + [slice(None)])]
+            binary_bbox = (self.labels[tuple(extent)] == label_id)
+            single_feats = self.plugin.compute_local(rawbbox, binary_bbox, self.features, self.axes)
+            assert sorted(batch_feats.keys()) == sorted(single_feats.keys())
+            for key in single_feats:
+                expected = np.asarray(single_feats[key]).ravel()
+                actual = np.asarray(batch_feats[key]).ravel()
+                assert actual.shape == expected.shape, (label_id, key)
+                assert np.allclose(actual, expected), (label_id, key)
+
+        # No values for the empty context, so _extract() drops these features
+        for key in ["Mean in neighborhood", "Sum in neighborhood"]:
+            assert np.asarray(batch[2][key]).size == 0
+        assert np.asarray(batch[2]["Sum in object and neighborhood"]).size == 1
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,72 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+import h5py
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+from ilastik.applets.pixelClassification.opPixelClassification import export_prediction_products, \
+                                                                      OpArgmaxChannel, OpEnsembleMargin
+
+class TestExportPredictionProducts(object):
+    def setUp(self):
+        numpy.random.seed(0)
+        pmap = numpy.random.random((2, 40, 30, 5, 3)).astype(numpy.float32)
+        self.pmap = vigra.taggedView(pmap, 'txyzc')
+
+        graph = Graph()
+        self.opPiper = OpArrayPiper(graph=graph)
+        self.opPiper.Input.setValue(self.pmap)
+
+        self.opArgmax = OpArgmaxChannel(graph=graph)
+        self.opArgmax.Input.connect(self.opPiper.Output)
+        self.opUncertainty = OpEnsembleMargin(graph=graph)
+        self.opUncertainty.Input.connect(self.opPiper.Output)
+
+        self.f = h5py.File('testExportPredictionProducts.h5', driver='core', backing_store=False)
+
+    def tearDown(self):
+        self.f.close()
+
+    def testAllProducts(self):
+        names = ['Probabilities', 'Probabilities (uint8)', 'Simple Segmentation', 'Uncertainty']
+        export_prediction_products(self.opPiper.Output, self.f, names, blockshape=(1, 16, 16, 5))
+
+        assert numpy.allclose(self.f['Probabilities'][:], self.pmap)
+        assert (self.f['Probabilities (uint8)'][:] == (255*self.pmap).astype(numpy.uint8)).all()
+        assert (self.f['Simple Segmentation'][:] == self.opArgmax.Output[:].wait()).all()
+        assert numpy.allclose(self.f['Uncertainty'][:], self.opUncertainty.Output[:].wait())
+
+    def testSubregion(self):
+        roi = ((1, 10, 5, 0, 0), (2, 30, 25, 5, 1))
+        export_prediction_products(self.opPiper.Output, self.f, ['Simple Segmentation'], roi, blockshape=(1, 8, 8, 5))
+
+        expected = self.opArgmax.Output(roi[0], roi[1]).wait()
+        assert self.f['Simple Segmentation'].shape == (1, 20, 20, 5, 1)
+        assert (self.f['Simple Segmentation'][:] == expected).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
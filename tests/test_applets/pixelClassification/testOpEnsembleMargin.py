@@ -0,0 +1,57 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+from lazyflow.graph import Graph
+from ilastik.applets.pixelClassification.opPixelClassification import OpEnsembleMargin
+
+class TestOpEnsembleMargin(object):
+    def test(self):
+        numpy.random.seed(0)
+        for nclasses in (2, 3, 10):
+            pmap = numpy.random.random((1, 20, 30, 1, nclasses)).astype(numpy.float32)
+            pmap = vigra.taggedView(pmap, 'txyzc')
+
+            op = OpEnsembleMargin(graph=Graph())
+            op.Input.setValue(pmap)
+            uncertainty = op.Output[:].wait()
+
+            sorted_pmap = numpy.sort(pmap, axis=-1)
+            expected = 1 - (sorted_pmap[..., -1:] - sorted_pmap[..., -2:-1])
+            assert uncertainty.shape == (1, 20, 30, 1, 1)
+            assert numpy.allclose(uncertainty, expected)
+
+            # the input must not be modified
+            assert numpy.all(op.Input.value == pmap)
+
+    def testSingleChannel(self):
+        pmap = vigra.taggedView(numpy.ones((1, 20, 30, 1, 1), dtype=numpy.float32), 'txyzc')
+        op = OpEnsembleMargin(graph=Graph())
+        op.Input.setValue(pmap)
+        assert numpy.all(op.Output[:].wait() == 0)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    ret = nose.run(defaultTest=__file__)
+    if not ret: sys.exit(1)
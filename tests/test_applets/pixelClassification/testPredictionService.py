@@ -0,0 +1,148 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy
+import h5py
+
+from ilastik.utility.slicingtools import sl, slicing2shape
+from ilastik.shell.projectManager import ProjectManager
+from ilastik.shell.headless.headlessShell import HeadlessShell
+from ilastik.shell.headless.predictionService import PredictionService, send_request
+from ilastik.workflows.pixelClassification import PixelClassificationWorkflow
+from ilastik.applets.dataSelection.opDataSelection import DatasetInfo
+
+class TestPredictionService(object):
+
+    @classmethod
+    def setupClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.PROJECT_FILE = os.path.join(cls.dir, 'test_project.ilp')
+        cls.SAMPLE_DATA = []
+        for i in range(3):
+            path = os.path.join(cls.dir, 'random_data{}.npy'.format(i))
+            numpy.save(path, (numpy.random.random((1,50,50,10,1)) * 256).astype(numpy.uint8))
+            cls.SAMPLE_DATA.append(path)
+        cls.create_new_tst_project()
+
+        cls.shell = HeadlessShell()
+        cls.shell.openProjectFile(cls.PROJECT_FILE)
+
+    @classmethod
+    def teardownClass(cls):
+        cls.shell.closeCurrentProject()
+        shutil.rmtree(cls.dir)
+
+    @classmethod
+    def create_new_tst_project(cls):
+        shell = HeadlessShell()
+        newProjectFile = ProjectManager.createBlankProjectFile(cls.PROJECT_FILE, PixelClassificationWorkflow, [])
+        newProjectFile.close()
+        shell.openProjectFile(cls.PROJECT_FILE)
+        workflow = shell.workflow
+
+        info = DatasetInfo()
+        info.filePath = cls.SAMPLE_DATA[0]
+        opDataSelection = workflow.dataSelectionApplet.topLevelOperator
+        opDataSelection.DatasetGroup.resize(1)
+        opDataSelection.DatasetGroup[0][0].setValue(info)
+
+        opFeatures = workflow.featureSelectionApplet.topLevelOperator
+        opFeatures.Scales.setValue( [0.3, 0.7, 1, 1.6, 3.5, 5.0, 10.0] )
+        opFeatures.FeatureIds.setValue( [ 'GaussianSmoothing',
+                                          'LaplacianOfGaussian',
+                                          'StructureTensorEigenvalues',
+                                          'HessianOfGaussianEigenvalues',
+                                          'GaussianGradientMagnitude',
+                                          'DifferenceOfGaussians' ] )
+        selections = numpy.zeros( (6,7), dtype=bool )
+        selections[0:3, 0] = True
+        opFeatures.SelectionMatrix.setValue(selections)
+
+        opPixelClass = workflow.pcApplet.topLevelOperator
+        opPixelClass.LabelNames.setValue(['Label 1', 'Label 2'])
+        slicing1 = sl[0:1,0:10,0:10,0:1,0:1]
+        opPixelClass.LabelInputs[0][slicing1] = 1 * numpy.ones(slicing2shape(slicing1), dtype=numpy.uint8)
+        slicing2 = sl[0:1,0:10,10:20,0:1,0:1]
+        opPixelClass.LabelInputs[0][slicing2] = 2 * numpy.ones(slicing2shape(slicing2), dtype=numpy.uint8)
+
+        opPixelClass.FreezePredictions.setValue(False)
+        _ = opPixelClass.Classifier.value
+
+        shell.projectManager.saveProject()
+        shell.closeCurrentProject()
+
+    def _job_args(self, paths):
+        return [ "--output_format=hdf5",
+                 "--output_filename_format={dataset_dir}/{nickname}_served.h5",
+                 "--output_internal_path=volume/pred_volume",
+                 "--raw_data" ] + paths
+
+    def _check_output(self, path):
+        with h5py.File(path, 'r') as f:
+            pred_shape = f["/volume/pred_volume"].shape
+        assert pred_shape == (1,50,50,10,2), "Prediction volume has wrong shape: {}".format( pred_shape )
+
+    def testJobs(self):
+        service = PredictionService( self.shell, ('localhost', 0) )
+        thread = threading.Thread( target=service.serve )
+        thread.start()
+        try:
+            address = service.address
+
+            reply = send_request( address, 'process', args=self._job_args(self.SAMPLE_DATA) )
+            assert reply['status'] == 'ok', reply
+            assert reply['job'] == 1
+            assert reply['seconds'] > 0
+            assert len(reply['results']) == 3
+            for result, path in zip(reply['results'], self.SAMPLE_DATA):
+                assert result['output'] == path[:-4] + "_served.h5"
+                assert result['seconds'] > 0
+                self._check_output( result['output'] )
+                os.remove( result['output'] )
+
+            # A smaller job replaces the inputs of the previous one.
+            reply = send_request( address, 'process', args=self._job_args(self.SAMPLE_DATA[1:2]) )
+            assert reply['status'] == 'ok', reply
+            assert [result['output'] for result in reply['results']] == [self.SAMPLE_DATA[1][:-4] + "_served.h5"]
+            self._check_output( reply['results'][0]['output'] )
+            assert not os.path.exists( self.SAMPLE_DATA[0][:-4] + "_served.h5" )
+
+            reply = send_request( address, 'process', args=self._job_args(['/does/not/exist.npy']) )
+            assert reply['status'] == 'error', reply
+
+            reply = send_request( address, 'status' )
+            assert reply['status'] == 'ok', reply
+            assert reply['project'] == self.PROJECT_FILE
+            assert reply['jobs'] == 3
+        finally:
+            send_request( service.address, 'shutdown' )
+            thread.join()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
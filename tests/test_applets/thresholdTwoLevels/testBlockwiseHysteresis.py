@@ -0,0 +1,156 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import unittest
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
+from ilastik.applets.thresholdTwoLevels.blockwiseHysteresis import \
+    labelBlock, BlockSummary, HysteresisComponents
+from ilastik.applets.thresholdTwoLevels.thresholdingTools import OpBlockwiseHysteresis
+
+
+def hysteresisBlockwise(data, blockShape, low, high, minSize, maxSize):
+    shape = data.shape
+    blocks = {}
+    for blockStart in getIntersectingBlocks(blockShape, ((0, 0, 0), shape)):
+        start, stop = getBlockBounds(shape, blockShape, blockStart)
+        block = data[roiToSlice(start, stop)]
+        blocks[tuple(start)] = BlockSummary(labelBlock(block, low), labelBlock(block, high))
+    components = HysteresisComponents(blockShape, blocks)
+    lut = components.outputLut(minSize, maxSize)
+    result = numpy.zeros(shape, dtype=numpy.uint32)
+    for start in blocks:
+        stop = numpy.minimum(numpy.add(start, blockShape), shape)
+        labels = labelBlock(data[roiToSlice(start, stop)], low)
+        result[roiToSlice(start, stop)] = components.relabel(start, labels, lut)
+    return result
+
+def hysteresisWhole(data, low, high, minSize, maxSize):
+    lowLabels = labelBlock(data, low)
+    highLabels = labelBlock(data, high)
+    sizes = numpy.bincount(highLabels.ravel().astype(int))
+    passed = (sizes >= minSize) & (sizes <= maxSize)
+    passed[0] = False
+    selected = numpy.zeros((lowLabels.max() + 1,), dtype=bool)
+    selected[lowLabels[passed[highLabels]]] = True
+    sizes = numpy.bincount(lowLabels.ravel().astype(int))
+    selected &= (sizes >= minSize) & (sizes <= maxSize)
+    selected[0] = False
+    return selected[lowLabels]
+
+def assertSamePartition(a, b):
+    numpy.testing.assert_array_equal(a > 0, b > 0)
+    pairs = set(zip(a[a > 0].tolist(), b[b > 0].tolist()))
+    assert len(pairs) == len(set(p[0] for p in pairs)) == len(set(p[1] for p in pairs))
+
+
+class TestHysteresisComponents(unittest.TestCase):
+    def setUp(self):
+        numpy.random.seed(0)
+        self.data = vigra.filters.gaussianSmoothing(
+            numpy.random.rand(40, 33, 21).astype(numpy.float32), 1.0)
+        self.low = numpy.percentile(self.data, 40)
+        self.high = numpy.percentile(self.data, 90)
+
+    def testAgainstWholeVolume(self):
+        whole = hysteresisBlockwise(self.data, self.data.shape, self.low, self.high, 5, 5000)
+        numpy.testing.assert_array_equal(whole > 0, hysteresisWhole(self.data, self.low, self.high, 5, 5000))
+        for blockShape in [(10, 10, 10), (7, 33, 4), (40, 1, 21)]:
+            blockwise = hysteresisBlockwise(self.data, blockShape, self.low, self.high, 5, 5000)
+            assertSamePartition(whole, blockwise)
+            assert blockwise.max() == whole.max()
+
+    def testObjectAcrossBlocks(self):
+        data = numpy.zeros((30, 10, 1), dtype=numpy.float32)
+        data[2:28, 4, 0] = 0.5  # one object through three blocks...
+        data[22:27, 4, 0] = 1.0 # ...that has its core in the last one
+        data[2:5, 8, 0] = 1.0   # too small
+        result = hysteresisBlockwise(data, (10, 10, 1), 0.2, 0.8, 5, 100)
+        expected = numpy.zeros(data.shape, dtype=numpy.uint32)
+        expected[2:28, 4, 0] = 1
+        numpy.testing.assert_array_equal(result, expected)
+
+        # the combined size of the object exceeds MaxSize
+        result = hysteresisBlockwise(data, (10, 10, 1), 0.2, 0.8, 5, 20)
+        assert not result.any()
+
+
+class TestOpBlockwiseHysteresis(unittest.TestCase):
+    def setUp(self):
+        numpy.random.seed(1)
+        data = numpy.random.rand(2, 30, 31, 12, 1).astype(numpy.float32)
+        for t in range(2):
+            data[t, ..., 0] = vigra.filters.gaussianSmoothing(data[t, ..., 0], 1.0)
+        self.data = vigra.taggedView(data, axistags='txyzc')
+        self.low = float(numpy.percentile(data, 40))
+        self.high = float(numpy.percentile(data, 90))
+
+    def makeOp(self, blockShape=None):
+        op = OpBlockwiseHysteresis(graph=Graph())
+        op.InputImage.setValue(self.data)
+        op.LowThreshold.setValue(self.low)
+        op.HighThreshold.setValue(self.high)
+        op.MinSize.setValue(5)
+        op.MaxSize.setValue(5000)
+        if blockShape is not None:
+            op.BlockShape.setValue(blockShape)
+        return op
+
+    def testOutput(self):
+        op = self.makeOp()
+        whole = op.Output[:].wait()
+        expected = hysteresisWhole(self.data[0, ..., 0].view(numpy.ndarray), self.low, self.high, 5, 5000)
+        numpy.testing.assert_array_equal(whole[0, ..., 0] > 0, expected)
+
+        blockwiseOp = self.makeOp((8, 8, 5))
+        assert blockwiseOp.Output.meta.ideal_blockshape == (1, 8, 8, 5, 1)
+        blockwise = blockwiseOp.Output[:].wait()
+        for t in range(2):
+            assertSamePartition(whole[t, ..., 0], blockwise[t, ..., 0])
+
+        # any roi gives the same labels
+        roi = numpy.s_[1:2, 3:17, 5:29, 2:11, 0:1]
+        numpy.testing.assert_array_equal(blockwiseOp.Output[roi].wait(), blockwise[roi])
+
+    def testSizeChange(self):
+        op = self.makeOp((8, 8, 5))
+        op.Output[:].wait()
+        components = op._components[(0, 0)]
+        op.MaxSize.setValue(50)
+        result = op.Output[:].wait()
+        # the components are kept if only the size limits change
+        assert op._components[(0, 0)] is components
+        expected = hysteresisWhole(self.data[0, ..., 0].view(numpy.ndarray), self.low, self.high, 5, 50)
+        numpy.testing.assert_array_equal(result[0, ..., 0] > 0, expected)
+
+        op.LowThreshold.setValue(self.low + 0.01)
+        assert (0, 0) not in op._components
+
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")
+    sys.argv.append("--nologcapture")
+    nose.run(defaultTest=__file__)
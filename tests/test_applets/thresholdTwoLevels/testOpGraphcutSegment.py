@@ -37,6 +37,8 @@ from lazyflow.operators.opArrayPiper import OpArrayPiper
 if have_opengm:
     from ilastik.applets.thresholdTwoLevels.opGraphcutSegment\
         import OpObjectsSegment, OpGraphCut
+    from ilastik.applets.thresholdTwoLevels._OpGraphCut\
+        import segmentGC, segmentGCTiled, graphCutTileShape
 
 def getTestVolume():
     t, c = 3, 2
@@ -85,6 +87,42 @@ class TestOpGraphCut(unittest.TestCase):
         assert np.all(out[:, 22:38, 22:38, 22:38, :] > 0)
         assert np.all(out[:, 62:78, 62:78, 62:78, :] > 0)
 
+    def testTiled(self):
+        graph = Graph()
+        op = OpGraphCut(graph=graph)
+        piper = OpArrayPiper(graph=graph)
+        piper.Input.setValue(self.fullVolume)
+        op.Prediction.connect(piper.Output)
+        # the tile borders cut through both boxes
+        op.TileShape.setValue((30, 30, 70))
+
+        out = op.CachedOutput[...].wait()
+        out = vigra.taggedView(out, axistags=op.Output.meta.axistags)
+        assert_array_equal(out.shape, self.fullVolume.shape)
+
+        mask = np.where(self.labels > 0, 0, 1)
+        masked = out.view(np.ndarray) * mask
+        assert_array_equal(masked, 0*masked)
+
+        # the boxes are not split at the tile borders
+        for t in range(out.shape[0]):
+            for c in range(out.shape[4]):
+                box = out[t, 22:38, 22:38, 22:38, c]
+                assert np.all(box > 0)
+                assert len(np.unique(box)) == 1
+
+    def testSegmentGCTiled(self):
+        pred = self.fullVolume[0, ..., 0].withAxes(*'xyz')
+        untiled = segmentGC(pred, .2)
+        tiled = segmentGCTiled(pred, .2, (50, 45, 40))
+        assert_array_equal(tiled > 0, untiled > 0)
+
+        # uint8 predictions
+        pred8 = (np.asarray(pred)*255).astype(np.uint8)
+        assert_array_equal(segmentGC(pred8, .2) > 0, untiled > 0)
+
+        assert graphCutTileShape((10, 10, 10)) == (10, 10, 10)
+
     #TODO test dirty propagation
 
 
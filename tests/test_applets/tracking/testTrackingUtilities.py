@@ -0,0 +1,81 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+from ilastik.applets.tracking.base.trackingUtilities import relabel, relabelMergers, \
+                                                           relabel_lut, RelabelingTables
+
+def loop_relabel(volume, replace, default):
+    # reference implementation
+    result = numpy.zeros_like(volume)
+    for label in numpy.unique(volume):
+        if label > 0:
+            result[volume == label] = replace.get(label, default)
+    return result
+
+class TestRelabel(object):
+    def setUp(self):
+        numpy.random.seed(0)
+        self.volume = numpy.random.randint(0, 50, size=(20, 30, 10)).astype(numpy.uint32)
+
+    def test_relabel(self):
+        replace = {1: 7, 3: 0, 10: 12, 49: 100, 200: 5}
+        assert (relabel(self.volume, replace) == loop_relabel(self.volume, replace, 1)).all()
+
+    def test_relabel_mergers(self):
+        mergers = {2: 3, 5: 2}
+        assert (relabelMergers(self.volume, mergers) == loop_relabel(self.volume, mergers, 1)).all()
+
+    def test_labels_beyond_table(self):
+        lut = relabel_lut({0: 3, 2: 5}, numpy.uint32)
+        assert list(lut) == [0, 1, 5, 1]
+        volume = numpy.array([0, 1, 2, 3, 1000], dtype=numpy.uint32)
+        assert list(relabel(volume, {}, lut)) == [0, 1, 5, 1, 1]
+
+    def test_empty_mapping(self):
+        result = relabel(self.volume, {})
+        assert (result == (self.volume > 0)).all()
+        assert result.dtype == self.volume.dtype
+
+class TestRelabelingTables(object):
+    def test_reset(self):
+        tables = RelabelingTables()
+        tables.reset([{1: 2}, {1: 3}])
+        lut = tables.get(1, numpy.uint8)
+        assert list(lut) == [0, 3, 1]
+        assert tables.get(1, numpy.uint8) is lut
+
+        tables.reset([{1: 2}, {1: 4}])
+        assert list(tables.get(1, numpy.uint8)) == [0, 4, 1]
+
+    def test_max_bytes(self):
+        tables = RelabelingTables()
+        tables.reset([{i: i} for i in range(10)], max_bytes=100)
+        for t in range(10):
+            assert tables.get(t, numpy.uint32)[t] == t
+        assert tables._tables.nbytes <= 100 or len(tables._tables) == 1
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
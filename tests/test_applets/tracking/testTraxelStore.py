@@ -0,0 +1,72 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.applets.tracking.base.opTrackingBase import filter_traxels, _frame_traxels
+
+def frame_features():
+    # first row is the background object
+    rc = numpy.array([[0, 0, 0], [1, 1, 1], [5, 5, 5], [9, 2, 0]], dtype=numpy.float32)
+    ct = numpy.array([[0], [10], [3], [50]], dtype=numpy.float32)
+    return {default_features_key: {'RegionCenter': rc,
+                                   'Count': ct,
+                                   'Coord<Minimum>': rc,
+                                   'Coord<Maximum>': rc}}
+
+class TestFilterTraxels(object):
+    def test_ranges(self):
+        feats = frame_features()[default_features_key]
+        rc, ct = feats['RegionCenter'][1:], feats['Count'][1:]
+        keep = filter_traxels(rc, ct, (0, 6), (0, 6), (0, 6), (5, 100))
+        assert list(keep) == [True, False, False]
+        keep = filter_traxels(rc, ct, (0, 10), (0, 6), (0, 6), (0, 100))
+        assert list(keep) == [True, True, True]
+
+    def test_2d(self):
+        rc = numpy.array([[1, 1], [5, 5]])
+        ct = numpy.array([[1], [1]])
+        # z is 0 for 2d data
+        assert list(filter_traxels(rc, ct, (0, 10), (0, 10), (0, 1), (0, 10))) == [True, True]
+        assert list(filter_traxels(rc, ct, (0, 10), (0, 10), (1, 2), (0, 10))) == [False, False]
+
+class TestFrameTraxels(object):
+    def test_frame(self):
+        ranges = ((0, 6), (0, 6), (0, 6), (0, 100))
+        traxels, filtered, sizes, num_objects = _frame_traxels(3, frame_features(), (1.0, 1.0, 1.0), ranges)
+        assert num_objects == 3
+        assert [tr.Id for tr in traxels] == [1, 2]
+        assert all(tr.Timestep == 3 for tr in traxels)
+        assert filtered == [3]
+        assert list(sizes) == [10, 3]
+
+    def test_empty_frame(self):
+        feats = {default_features_key: {'RegionCenter': numpy.zeros((0,)), 'Count': numpy.zeros((0,)),
+                                        'Coord<Minimum>': numpy.zeros((0,)), 'Coord<Maximum>': numpy.zeros((0,))}}
+        traxels, filtered, sizes, num_objects = _frame_traxels(0, feats, (1.0, 1.0, 1.0), ((0, 1),) * 4)
+        assert traxels == [] and filtered == [] and num_objects == 0
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,143 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+import threading
+
+from ilastik.utility.batchExportScheduler import BatchExportScheduler
+
+class LaneRecorder(object):
+    """Records how many lanes (and how many bytes) are exported at the same time."""
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.lock = threading.Lock()
+        self.running = 0
+        self.running_bytes = 0
+        self.max_running = 0
+        self.max_running_bytes = 0
+        self.exported = []
+
+    def export(self, lane):
+        with self.lock:
+            self.running += 1
+            self.running_bytes += self.sizes[lane]
+            self.max_running = max(self.max_running, self.running)
+            self.max_running_bytes = max(self.max_running_bytes, self.running_bytes)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+            self.running_bytes -= self.sizes[lane]
+            self.exported.append(lane)
+
+class TestBatchExportScheduler(object):
+    def test_all_lanes_run(self):
+        sizes = dict( (lane, 10) for lane in range(10) )
+        recorder = LaneRecorder(sizes)
+
+        progress = []
+        scheduler = BatchExportScheduler(num_workers=3, ram_budget_bytes=1000)
+        scheduler.progressSignal.subscribe(progress.append)
+        results = scheduler.run(range(10), recorder.export, sizes.get)
+
+        assert [r.lane for r in results] == range(10)
+        assert all(r.success and r.nbytes == 10 and r.seconds > 0 for r in results)
+        assert sorted(recorder.exported) == range(10)
+        assert recorder.max_running == 3
+        assert sorted(progress) == progress and progress[-1] == 100
+
+    def test_ram_budget(self):
+        sizes = {0: 60, 1: 30, 2: 30, 3: 50, 4: 10, 5: 150, 6: 10}
+        recorder = LaneRecorder(sizes)
+        scheduler = BatchExportScheduler(num_workers=4, ram_budget_bytes=100)
+        results = scheduler.run(range(7), recorder.export, sizes.get)
+
+        assert all(r.success for r in results)
+        assert sorted(recorder.exported) == range(7)
+        # Lane 5 exceeds the budget on its own, so it must have run alone.
+        assert recorder.max_running_bytes == 150
+        assert recorder.max_running > 1
+
+    def test_shared_output_file(self):
+        # Lanes 0, 2 and 4 write the same file, they must not overlap
+        sizes = dict( (lane, 10) for lane in range(6) )
+        files = {0: 'a.h5', 1: 'b.h5', 2: 'a.h5', 3: 'c.h5', 4: 'a.h5', 5: 'd.h5'}
+        shared = [0, 2, 4]
+        lock = threading.Lock()
+        running = []
+        overlaps = []
+        recorder = LaneRecorder(sizes)
+        def export(lane):
+            with lock:
+                if lane in shared and any(other in shared for other in running):
+                    overlaps.append(lane)
+                running.append(lane)
+            recorder.export(lane)
+            with lock:
+                running.remove(lane)
+
+        scheduler = BatchExportScheduler(num_workers=4, ram_budget_bytes=1000)
+        results = scheduler.run(range(6), export, sizes.get, lane_output_file=files.get)
+
+        assert all(r.success for r in results)
+        assert sorted(recorder.exported) == range(6)
+        assert not overlaps
+        assert [lane for lane in recorder.exported if lane in shared] == shared
+        assert recorder.max_running > 1
+
+    def test_failure(self):
+        def export(lane):
+            if lane == 1:
+                raise ValueError("lane 1 failed")
+            time.sleep(0.01)
+
+        exported = []
+        def record(lane):
+            export(lane)
+            exported.append(lane)
+
+        scheduler = BatchExportScheduler(num_workers=2, ram_budget_bytes=100)
+        try:
+            scheduler.run(range(20), record, lambda lane: 1)
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected the failure of lane 1 to be raised"
+        # No lanes are started after the failure.
+        assert len(exported) < 19
+
+    def test_output_bytes_failure(self):
+        def lane_output_bytes(lane):
+            raise ValueError("no output size")
+
+        # Lane 1 can only start after lane 0 released its RAM.
+        scheduler = BatchExportScheduler(num_workers=2, ram_budget_bytes=100)
+        try:
+            scheduler.run(range(2), lambda lane: None, lambda lane: 100, lane_output_bytes)
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected the failure of lane_output_bytes to be raised"
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
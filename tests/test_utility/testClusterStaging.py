@@ -0,0 +1,140 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy
+import nose
+
+from lazyflow.utility.timer import Timer
+from ilastik.clusterStaging import stageFile, unstageFile, STAGED_SUFFIX
+
+import logging
+logger = logging.getLogger(__name__)
+
+COMPRESSION_CMD = "gzip -c {uncompressed_file} > {compressed_file}"
+DECOMPRESSION_CMD = "gzip -dc {compressed_file} > {uncompressed_file}"
+
+class TestStageFile(object):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.shared = tempfile.mkdtemp()
+        self.data = numpy.zeros((1000,), dtype=numpy.uint8).tostring() + b"some data"
+        self.localPath = os.path.join(self.scratch, "block.h5")
+        with open(self.localPath, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+        shutil.rmtree(self.shared)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def testUncompressed(self):
+        sharedPath = os.path.join(self.shared, "block.h5")
+        assert stageFile(self.localPath, sharedPath) == sharedPath
+        assert self._read(sharedPath) == self.data
+        assert os.listdir(self.shared) == ["block.h5"], "temporary files were left behind"
+
+    def testCompressed(self):
+        sharedPath = os.path.join(self.shared, "block.h5")
+        stagedPath = stageFile(self.localPath, sharedPath, COMPRESSION_CMD)
+        assert stagedPath == sharedPath + STAGED_SUFFIX
+        assert not os.path.exists(sharedPath)
+        assert os.path.getsize(stagedPath) < len(self.data)
+
+        assert unstageFile(sharedPath, DECOMPRESSION_CMD)
+        assert self._read(sharedPath) == self.data
+        assert os.listdir(self.shared) == ["block.h5"]
+
+        # Nothing left to unpack
+        assert not unstageFile(sharedPath, DECOMPRESSION_CMD)
+
+def _writeDirect(args):
+    sharedDir, index, nbytes, chunk = args
+    data = numpy.random.randint(0, 4, size=(nbytes,)).astype(numpy.uint8).tostring()
+    with open(os.path.join(sharedDir, "block{}.dat".format(index)), 'wb') as f:
+        for start in range(0, nbytes, chunk):
+            f.write(data[start:start+chunk])
+            f.flush()
+            os.fsync(f.fileno())
+
+def _writeStaged(args):
+    sharedDir, index, nbytes, chunk = args
+    scratchDir = tempfile.mkdtemp()
+    try:
+        localPath = os.path.join(scratchDir, "block{}.dat".format(index))
+        _writeDirect((scratchDir, index, nbytes, nbytes))
+        stageFile(localPath, os.path.join(sharedDir, "block{}.dat".format(index)), COMPRESSION_CMD)
+    finally:
+        shutil.rmtree(scratchDir)
+
+class TestStagingBenchmark(object):
+    """
+    Compare N worker processes writing their blocks to a (simulated) 
+    shared directory directly with writing them via local scratch + compression.
+    """
+    NUM_WORKERS = 8
+    NUM_BLOCKS = 32
+    BLOCK_BYTES = 32 * 2**20
+    CHUNK_BYTES = 2**20
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def setUp(self):
+        self.shared = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.shared)
+
+    def test(self):
+        args = [(self.shared, i, self.BLOCK_BYTES, self.CHUNK_BYTES) for i in range(self.NUM_BLOCKS)]
+        pool = multiprocessing.Pool(self.NUM_WORKERS)
+        try:
+            with Timer() as timer:
+                pool.map(_writeDirect, args)
+            logger.info("Direct writes to the shared directory took {} seconds".format(timer.seconds()))
+            shutil.rmtree(self.shared)
+            os.mkdir(self.shared)
+
+            with Timer() as timer:
+                pool.map(_writeStaged, args)
+            logger.info("Writes staged via local scratch took {} seconds".format(timer.seconds()))
+        finally:
+            pool.close()
+            pool.join()
+
+        assert len(os.listdir(self.shared)) == self.NUM_BLOCKS
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
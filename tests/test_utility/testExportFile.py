@@ -0,0 +1,228 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+import logging
+
+import numpy
+import vigra
+import h5py
+
+import nose
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+from lazyflow.utility.timer import Timer
+from ilastik.utility import exportFile
+from ilastik.utility.exportFile import ExportFile, StreamingExportFile, Mode, Default, \
+                                       objects_per_frame, ilastik_ids, create_slicing, extract_rois
+
+logger = logging.getLogger(__name__)
+
+class FeatureTable(object):
+    """
+    Minimal stand-in for an object feature slot: slot(list_of_times).wait() -> {t: features}
+    """
+    class Meta(object):
+        pass
+
+    class Request(object):
+        def __init__(self, result):
+            self.result = result
+
+        def wait(self):
+            return self.result
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.meta = FeatureTable.Meta()
+        self.meta.shape = (labels.shape[0],)
+        self.requested = []
+
+    def __call__(self, times):
+        times = list(times) or range(self.meta.shape[0])
+        self.requested.append(times)
+        return FeatureTable.Request(dict((t, self._features(t)) for t in times))
+
+    def _features(self, t):
+        frame = self.labels[t, ..., 0]
+        n = frame.max() + 1
+        counts = numpy.bincount(frame.flat, minlength=n).astype(numpy.float32)[:, None]
+        mins = numpy.zeros((n, 3), dtype=numpy.float32)
+        maxs = numpy.zeros((n, 3), dtype=numpy.float32)
+        for o in range(1, n):
+            coords = numpy.transpose(numpy.nonzero(frame == o))
+            mins[o] = coords.min(axis=0)
+            maxs[o] = coords.max(axis=0) + 1
+        return {"Default features": {"Count": counts, "Coord<Minimum>": mins, "Coord<Maximum>": maxs},
+                "Standard Object Features": {"Mean": 2 * counts, "Variance": counts}}
+
+class TestStreamingExportFile(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        labels = numpy.zeros((3, 30, 20, 4, 1), dtype=numpy.uint32)
+        labels[0, 1:5, 2:8, 0:2] = 1
+        labels[0, 10:20, 10:15, 1:4] = 2
+        labels[1, 5:6, 5:6, 0:1] = 1
+        labels[2, 0:30, 0:3, 0:4] = 1
+        labels[2, 20:25, 15:20, 2:3] = 2
+        labels[2, 2:3, 10:11, 0:4] = 3
+        self.labels = vigra.taggedView(labels, 'txyzc')
+        raw = numpy.random.random(labels.shape).astype(numpy.float32)
+        self.raw = vigra.taggedView(raw, 'txyzc')
+
+        graph = Graph()
+        self.opLabels = OpArrayPiper(graph=graph)
+        self.opLabels.Input.setValue(self.labels)
+        self.opRaw = OpArrayPiper(graph=graph)
+        self.opRaw.Input.setValue(self.raw)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _export(self, export_class, file_name, file_type, include_raw=False):
+        obj_count = list(objects_per_frame(self.opLabels.Output))
+        assert obj_count == [2, 1, 3]
+        features = FeatureTable(self.labels)
+
+        export_file = export_class(os.path.join(self.tmpdir, file_name))
+        export_file.add_columns("table", range(sum(obj_count)), Mode.List, Default.KnimeId)
+        export_file.add_columns("table", list(ilastik_ids(obj_count)), Mode.List, Default.IlastikId)
+        export_file.add_columns("table", features, Mode.IlastikFeatureTable, {"selection": ["Mean"]})
+        export_file.add_columns("divisions", [(1, 2), (3, 4)], Mode.List, {"names": ("a", "b")})
+        if file_type == "h5":
+            export_file.add_rois(Default.LabelRoiPath, self.opLabels.Output, "table", 1, "labeling")
+            if include_raw:
+                export_file.add_image(Default.RawPath, self.opRaw.Output)
+            else:
+                export_file.add_rois(Default.RawRoiPath, self.opRaw.Output, "table", 1)
+        export_file.write_all(file_type, {"compression": "gzip"})
+        return features
+
+    def _assertEqualGroups(self, a, b):
+        assert set(a.keys()) == set(b.keys())
+        for key in a.keys():
+            if isinstance(a[key], h5py.Group):
+                self._assertEqualGroups(a[key], b[key])
+            else:
+                assert a[key].dtype == b[key].dtype, key
+                assert (a[key][...] == b[key][...]).all(), key
+                assert dict(a[key].attrs) == dict(b[key].attrs), key
+
+    def testH5(self):
+        for include_raw in (False, True):
+            self._export(ExportFile, "expected.h5", "h5", include_raw)
+            features = self._export(StreamingExportFile, "streamed.h5", "h5", include_raw)
+            assert all(len(times) == 1 for times in features.requested), "features must be requested frame by frame"
+
+            with h5py.File(os.path.join(self.tmpdir, "expected.h5"), 'r') as expected:
+                with h5py.File(os.path.join(self.tmpdir, "streamed.h5"), 'r') as streamed:
+                    self._assertEqualGroups(expected, streamed)
+                    assert streamed["table"].shape == (6,)
+
+    def testCsv(self):
+        self._export(ExportFile, "expected.csv", "csv")
+        self._export(StreamingExportFile, "streamed.csv", "csv")
+        for table in ("table", "divisions"):
+            with open(os.path.join(self.tmpdir, "expected_{}.csv".format(table))) as f:
+                expected = f.read()
+            with open(os.path.join(self.tmpdir, "streamed_{}.csv".format(table))) as f:
+                streamed = f.read()
+            assert expected == streamed
+
+def syntheticObjects(shape, n_objects, max_size):
+    """
+    A 'txyzc' label volume with n_objects random boxes per frame, and the matching feature table columns
+    """
+    numpy.random.seed(0)
+    labels = numpy.zeros(shape, dtype=numpy.uint32)
+    rows = []
+    for t in range(shape[0]):
+        for o in range(1, n_objects + 1):
+            start = [numpy.random.randint(0, s - 1) for s in shape[1:4]]
+            stop = [min(s, a + numpy.random.randint(1, max_size)) for s, a in zip(shape[1:4], start)]
+            labels[t, start[0]:stop[0], start[1]:stop[1], start[2]:stop[2], 0] = o
+            rows.append((t,) + tuple(start) + tuple(stop))
+    rows = numpy.array(rows, dtype=numpy.int32)
+    table = {Default.TimeColumnName: rows[:, 0]}
+    for i in range(3):
+        table["Coord<Minimum>_{}".format(i)] = rows[:, 1 + i]
+        table["Coord<Maximum>_{}".format(i)] = rows[:, 4 + i]
+    return vigra.taggedView(labels, 'txyzc'), table
+
+class TestExtractRois(object):
+    def setUp(self):
+        self.tile_size, self.batch_size = exportFile.ROI_TILE_SIZE, exportFile.ROI_BATCH_SIZE
+
+    def tearDown(self):
+        exportFile.ROI_TILE_SIZE, exportFile.ROI_BATCH_SIZE = self.tile_size, self.batch_size
+
+    def test(self):
+        # Small tiles and batches, so that there are many groups and several batches
+        exportFile.ROI_TILE_SIZE = 8
+        exportFile.ROI_BATCH_SIZE = 7
+
+        labels, table = syntheticObjects((2, 40, 30, 10, 1), 20, 10)
+        op = OpArrayPiper(graph=Graph())
+        op.Input.setValue(labels)
+        slicings = list(create_slicing(op.Output.meta.axistags, op.Output.meta.shape, 2, table))
+
+        for binarize in (False, True):
+            rois = list(extract_rois(op.Output, slicings, binarize))
+            assert len(rois) == len(slicings)
+            for (slicing, oid), roi in zip(slicings, rois):
+                expected = labels[tuple(slicing)]
+                if binarize:
+                    expected = (expected == oid)
+                assert roi.shape == expected.shape
+                assert (roi == expected).all()
+
+class TestExtractRoisBenchmark(object):
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def test(self):
+        labels, table = syntheticObjects((2, 1000, 1000, 20, 1), 5000, 15)
+        op = OpArrayPiper(graph=Graph())
+        op.Input.setValue(labels)
+        slicings = list(create_slicing(op.Output.meta.axistags, op.Output.meta.shape, 2, table))
+
+        with Timer() as timer:
+            rois = list(extract_rois(op.Output, slicings, binarize=True))
+        logger.info("Batched extraction of {} rois took {} seconds".format(len(slicings), timer.seconds()))
+
+        with Timer() as timer:
+            for (slicing, oid), roi in zip(slicings, rois):
+                expected = op.Output(slicing).wait()
+                expected = numpy.vectorize(lambda v: 1 if v == oid else 0)(expected)
+                assert (roi == expected).all()
+        logger.info("Per-object extraction of {} rois took {} seconds".format(len(slicings), timer.seconds()))
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,110 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+
+from ilastik.clusterScheduler import LocalTaskScheduler
+
+class TaskInfo(object):
+    def __init__(self, taskName, command):
+        self.taskName = taskName
+        self.command = command
+
+class TestLocalTaskScheduler(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_all_tasks_run(self):
+        taskInfos = {}
+        for i in range(10):
+            roi = ((i,), (i+1,))
+            taskInfos[roi] = TaskInfo("J{:02}".format(i), "touch block{}".format(i))
+
+        progress = []
+        scheduler = LocalTaskScheduler(3, self.tmpdir, poll_interval=0.01)
+        scheduler.progressSignal.subscribe(progress.append)
+        results = scheduler.run(taskInfos)
+
+        assert len(results) == 10
+        assert all(r.success and r.attempts == 1 for r in results)
+        assert sorted(progress) == progress and progress[-1] == 100
+        for i in range(10):
+            assert os.path.exists(os.path.join(self.tmpdir, "block{}".format(i)))
+
+    def test_retry(self):
+        # This task only succeeds on its second attempt.
+        taskInfos = {((0,), (1,)) : TaskInfo("flaky", "test -e marker || (touch marker; exit 1)")}
+        reset_rois = []
+        scheduler = LocalTaskScheduler(2, self.tmpdir, max_retries=1, reset_task=reset_rois.append, poll_interval=0.01)
+        results = scheduler.run(taskInfos)
+        assert results[0].success
+        assert results[0].attempts == 2
+        assert reset_rois == [((0,), (1,))]
+
+    def test_failure_and_timeout(self):
+        taskInfos = {((0,), (1,)) : TaskInfo("failing", "exit 1"),
+                     ((1,), (2,)) : TaskInfo("slow", "sleep 10"),
+                     ((2,), (3,)) : TaskInfo("unfinished", "true")}
+        check_finished = lambda roi: roi != ((2,), (3,))
+        scheduler = LocalTaskScheduler(3, self.tmpdir, timeout_secs=0.5, max_retries=1, 
+                                       check_finished=check_finished, poll_interval=0.01)
+        results = scheduler.run(taskInfos)
+        assert len(results) == 3
+        for r in results:
+            assert not r.success
+            assert r.attempts == 2
+        slow = [r for r in results if r.taskName == "slow"][0]
+        assert slow.seconds < 5
+
+    def test_exceptions(self):
+        def check_finished(roi):
+            raise RuntimeError("check_finished failed")
+        def reset_task(roi):
+            raise RuntimeError("reset_task failed")
+        taskInfos = {((0,), (1,)) : TaskInfo("checked", "true"),
+                     ((1,), (2,)) : TaskInfo("reset", "exit 1")}
+        scheduler = LocalTaskScheduler(2, self.tmpdir, max_retries=1, 
+                                       check_finished=check_finished, reset_task=reset_task, poll_interval=0.01)
+        results = scheduler.run(taskInfos)
+        assert len(results) == 2
+        for r in results:
+            assert not r.success
+            # The failed reset prevents a retry.
+            assert r.attempts == 1
+
+        # A working directory that doesn't exist makes Popen raise.
+        taskInfos = {((0,), (1,)) : TaskInfo("nowhere", "true")}
+        scheduler = LocalTaskScheduler(1, os.path.join(self.tmpdir, "missing"), max_retries=1, poll_interval=0.01)
+        results = scheduler.run(taskInfos)
+        assert len(results) == 1
+        assert not results[0].success
+        assert results[0].attempts == 2
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)